@@ -2,8 +2,16 @@
 # AUTHOR: William Stafford Noble
 # CREATE DATE: 30 Aug 2022
 import sys
+import argparse
+import multiprocessing
+import os
+import numpy as np
+import instrument
+import mgf_index
+import mgf_io
 
-USAGE = """USAGE: annotate_mgf.py <threshold> <log> <percolator> <mgf>
+USAGE = """USAGE: annotate_mgf.py [options] <threshold>[,<threshold>...] <log>
+                       <percolator> <mgf>+
 
 Use Percolator PSM-level output to annotate a given MGF file,
 including only PSMs with q-value better than the specified threshold.
@@ -16,6 +24,19 @@ Inputs are
 
 The resulting annotated MGF is printed to stdout.
 
+With --output_dir, any number of MGF files can be given (batch mode).
+The log and Percolator files are then read only once, the MGFs are
+annotated by a pool of worker processes, and each annotated MGF is
+written to the output directory under the same name.  Outputs with
+fewer than --min_psms PSMs are deleted, and the number of PSMs in each
+output is written to <output_dir>.annotation-counts.txt, next to the
+output directory, so that the directory holds only MGFs.
+Existing outputs are not recomputed.
+
+Several comma-separated thresholds may be given in batch mode.  Each MGF
+is then read once, and the output for each threshold is written to a
+subdirectory of the output directory named after the threshold.
+
 Note that spectra with no assigned charge state are skipped.
 
 Searches the log file for the assigned file index in a line like this:
@@ -27,40 +48,83 @@ Assumes that the Percolator file has PSM IDs of the form
 
 """
 
-###########################################################################
-# MAIN
-###########################################################################
-def main():
-    global USAGE
+def annotate_spectrum(spectrum_text, psms):
+    """Add the peptide to a spectrum that has a PSM.  Returns the annotated
+    spectrum, or None if the spectrum should not be printed because it
+    has no PSM, charge state or precursor mass, along with the annotated
+    scan number."""
 
-    # Parse the command line.
-    if (len(sys.argv) != 5):
-        sys.stderr.write(USAGE)
-        sys.exit(1)
-    fdr_threshold = float(sys.argv[1])
-    log_filename = sys.argv[2]
-    percolator_filename = sys.argv[3]
-    mgf_filename = sys.argv[4]
+    annotated = []
+    annotated_scan = None
+    print_me = False
+    has_charge = False
+    has_mass = False
+    for line in spectrum_text.splitlines(keepends=True):
 
-    # Get the file index from the log file.
-    target_file_index = None
+        # Check for charge state.
+        if (line[:6] == "CHARGE"):
+            has_charge = True
+        if (line[:7] == "PEPMASS"):
+            has_mass = True
+
+        # Add to this spectrum, possibly including annotation.
+        annotated.append(line)
+
+        words = line.split("=")
+        if (words[0] == "SCANS"):
+            scan_number = int(words[1])
+            if (scan_number in psms):
+                # Strip flanking amino acids.
+                annotated.append(f"SEQ={psms[scan_number][2:-2]}\n")
+                print_me = True
+                annotated_scan = scan_number
+
+        # Extract scan number from title line.
+        if (words[0] == "TITLE"):
+            scan_number = mgf_index.get_title_scan(line.encode())
+            if (scan_number in psms):
+                annotated.append(f"SCANS={scan_number}\n")
+                # Strip flanking amino acids.
+                annotated.append(f"SEQ={psms[scan_number][2:-2]}\n")
+                print_me = True
+                annotated_scan = scan_number
+
+    if print_me and has_charge and has_mass:
+        return "".join(annotated), annotated_scan
+    return None, None
+
+def read_file_indices(log_filename):
+    """Read the file indices assigned by Crux from the log file.  Returns a
+    dictionary from MGF filename to file index."""
+
+    file_indices = {}
     with open(log_filename, "r") as log_file:
         for line in log_file:
             words = line.rstrip().split()
             if ( (len(words) == 6) and
                  (words[0] == "INFO:") and
                  (words[1] == "Assigning") and
-                 (words[2] == "index") and
-                 (words[5][:-1] == mgf_filename) ): # Remove trailing period.
-                target_file_index = int(words[3])
-                break
-    if (target_file_index == None):
-        print(f"Cannot find {mgf_filename} in {log_filename}.", file=sys.stderr)
-        sys.exit(1)
-    print(f"File index: {target_file_index}.", file=sys.stderr)
+                 (words[2] == "index") ):
+                # Remove trailing period.
+                file_indices[words[5][:-1]] = int(words[3])
+    return file_indices
 
-    # Read the Percolator PSMs into a dictionary.
-    psms = {} # Key = scan number, value = peptide
+def find_file_index(file_indices, mgf_filename):
+    "Return the file index of an MGF, or None if it is not in the log."
+    if mgf_filename in file_indices:
+        return file_indices[mgf_filename]
+    for log_filename, file_index in file_indices.items():
+        if os.path.abspath(log_filename) == os.path.abspath(mgf_filename):
+            return file_index
+    return None
+
+def read_psms(percolator_filename, fdr_threshold, target_file_indices):
+    """Read the Percolator PSMs with q-value at most fdr_threshold for the
+    given file indices.  Returns a dictionary from file index to arrays of
+    scan numbers, q-values and peptides, sorted by scan number.  PSMs for
+    the same scan keep their order in the Percolator file."""
+
+    rows = {file_index: ([], [], []) for file_index in target_file_indices}
     with open(percolator_filename, "r") as percolator_file:
 
         header = percolator_file.readline().rstrip().split("\t")
@@ -82,63 +146,339 @@ def main():
                       file=sys.stderr)
                 continue
 
-            if ( (file_index == target_file_index) and 
+            if ( (file_index in rows) and
                  (qvalue <= fdr_threshold) ):
-                psms[scan_number] = peptide
-    print(f"Read {len(psms)} PSMs from {percolator_filename} " +
-          f"at q<{fdr_threshold}.", file=sys.stderr)
+                scans, qvalues, peptides = rows[file_index]
+                scans.append(scan_number)
+                qvalues.append(qvalue)
+                peptides.append(peptide)
 
-    # Write the annotated MGF.
-    num_printed = 0
-    with open(mgf_filename, "r") as mgf_file:
-        this_spectrum = ""
-        print_me = False
-        has_charge = False
-        has_mass = False
-        for line in mgf_file:
-
-            # Starting a new spectrum? Then print and reset.
-            if (line == "BEGIN IONS\n"):
-                if print_me and has_charge and has_mass:
-                    print(this_spectrum)
-                    num_printed += 1
-                print_me = False
-                has_charge = False
-                has_mass = False
-                this_spectrum = line
+    psms = {}
+    for file_index, (scans, qvalues, peptides) in rows.items():
+        scans = np.array(scans, dtype=np.int64)
+        order = np.argsort(scans, kind="stable")
+        psms[file_index] = (scans[order],
+                            np.array(qvalues, dtype=np.float64)[order],
+                            np.array(peptides, dtype=object)[order])
+    return psms
+
+def get_peptides(psms, fdr_threshold):
+    """Convert PSM arrays (see read_psms) to a dictionary from scan number
+    to peptide, for PSMs with q-value at most fdr_threshold.  If a scan
+    has several such PSMs, the last one is used."""
+
+    scans, qvalues, peptides = psms
+    keep = qvalues <= fdr_threshold
+    return dict(zip(scans[keep].tolist(), peptides[keep]))
+
+def annotate_mgf(mgf_filename, psms, output_files, fdr_thresholds):
+    """Write the annotated spectra of an MGF file to one open text file per
+    FDR threshold.  Only the spectra whose scans have PSMs are read, as
+    found by the sidecar index of the MGF (see mgf_index.py).  Spectra are
+    separated by blank lines.  Returns the number of spectra written to
+    each file."""
+
+    # Annotate with the most permissive threshold, and then check whether
+    # the stricter thresholds give the same peptide.
+    by_threshold = [get_peptides(psms, fdr_threshold)
+                    for fdr_threshold in fdr_thresholds]
+    loosest = int(np.argmax(fdr_thresholds))
+
+    num_printed = [0] * len(output_files)
+    index = mgf_index.open_index(mgf_filename)
+    offsets = index["offsets"]
+    scans = list(by_threshold[loosest])
+    selected = np.flatnonzero(np.isin(index["scans"], scans)
+                              | np.isin(index["title_scans"], scans))
+    blocks = mgf_io.iter_ranges(mgf_filename,
+                                zip(offsets[selected].tolist(),
+                                    offsets[selected + 1].tolist()))
+    for spectrum_index, block in zip(selected.tolist(), blocks):
+        spectrum_text = block.decode()
+        spectrum_text = spectrum_text.replace("\r\n", "\n")
+        annotated, scan = annotate_spectrum(spectrum_text,
+                                            by_threshold[loosest])
+        if annotated is None:
+            continue
+        for threshold_index, output_file in enumerate(output_files):
+            peptide = by_threshold[threshold_index].get(scan)
+            if peptide is None:
+                continue
+            if peptide == by_threshold[loosest][scan]:
+                output_file.write(annotated)
             else:
+                output_file.write(annotate_spectrum(spectrum_text,
+                                                    {scan: peptide})[0])
+            if spectrum_index < len(offsets) - 2:
+                output_file.write("\n")
+            num_printed[threshold_index] += 1
+    return num_printed
+
+def get_output_dirs(output_dir, fdr_thresholds):
+    """Return the output directory for each threshold: output_dir itself
+    for a single threshold, or one subdirectory per threshold."""
+    if len(fdr_thresholds) == 1:
+        return [output_dir]
+    return [os.path.join(output_dir, f"{fdr_threshold:g}")
+            for fdr_threshold in fdr_thresholds]
+
+def annotate_mgf_star(args):
+    """Annotate one MGF in batch mode, writing to temporary files that are
+    renamed when complete, or deleted if they have too few PSMs.  Returns
+    the MGF filename and number of PSMs at each threshold."""
+
+    mgf_filename, output_filenames, psms, fdr_thresholds, min_psms = args
+    output_files = [mgf_io.open_output(f"{output_filename}.tmp", "w", 1 << 22,
+                                       mgf_io.get_compression(output_filename))
+                    for output_filename in output_filenames]
+    try:
+        num_printed = annotate_mgf(mgf_filename, psms, output_files,
+                                   fdr_thresholds)
+    finally:
+        for output_file in output_files:
+            output_file.close()
+    for output_filename, count in zip(output_filenames, num_printed):
+        if count < min_psms:
+            os.remove(f"{output_filename}.tmp")
+        else:
+            os.replace(f"{output_filename}.tmp", output_filename)
+    return mgf_filename, num_printed
+
+def annotate_batch(fdr_thresholds, log_filename, percolator_filename,
+                   mgf_filenames, output_dir, min_psms=100, workers=1):
+    """Annotate a set of MGFs at one or more FDR thresholds, writing them
+    to output_dir (see get_output_dirs).  Returns a list, parallel to
+    fdr_thresholds, of dictionaries from MGF filename to number of PSMs."""
+
+    output_dirs = get_output_dirs(output_dir, fdr_thresholds)
+    for threshold_dir in output_dirs:
+        os.makedirs(threshold_dir, exist_ok=True)
+    file_indices = read_file_indices(log_filename)
+    targets = {} # Key = MGF filename, value = file index
+    for mgf_filename in mgf_filenames:
+        if all(os.path.exists(os.path.join(threshold_dir,
+                                           os.path.basename(mgf_filename)))
+               for threshold_dir in output_dirs):
+            continue
+        file_index = find_file_index(file_indices, mgf_filename)
+        if (file_index == None):
+            print(f"Cannot find {mgf_filename} in {log_filename}.",
+                  file=sys.stderr)
+            continue
+        targets[mgf_filename] = file_index
+    print(f"Annotating {len(targets)} of {len(mgf_filenames)} MGFs.",
+          file=sys.stderr)
 
-                # Check for charge state.
-                if (line[:6] == "CHARGE"):
-                    has_charge = True
-                if (line[:7] == "PEPMASS"):
-                    has_mass = True
-
-                # Add to this spectrum, possibly including annotation.
-                this_spectrum += line
-
-                words = line.split("=")
-                if (words[0] == "SCANS"):
-                    scan_number = int(words[1])
-                    if (scan_number in psms):
-                        # Strip flanking amino acids.
-                        this_spectrum += f"SEQ={psms[scan_number][2:-2]}\n"
-                        print_me = True
-
-                # Ugly hack to extract scan number from title line.
-                if (words[0] == "TITLE"):
-                    scan_number = int(words[-1][:-2]) # Strip trailing "
-                    if (scan_number in psms):
-                        this_spectrum += f"SCANS={scan_number}\n"
-                        # Strip flanking amino acids.
-                        this_spectrum += f"SEQ={psms[scan_number][2:-2]}\n"
-                        print_me = True
-
-        # Print the final spectrum.
-        if print_me and has_charge and has_mass:
-            print(this_spectrum, end='')
-            num_printed += 1
+    psms = read_psms(percolator_filename, max(fdr_thresholds),
+                     set(targets.values()))
+    print(f"Read {sum(len(file_psms[0]) for file_psms in psms.values())} "
+          + f"PSMs from {percolator_filename} at q<{max(fdr_thresholds)}.",
+          file=sys.stderr)
+
+    tasks = [(mgf_filename,
+              [os.path.join(threshold_dir, os.path.basename(mgf_filename))
+               for threshold_dir in output_dirs],
+              psms[file_index], fdr_thresholds, min_psms)
+             for mgf_filename, file_index in targets.items()]
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    results = (pool.imap_unordered(annotate_mgf_star, tasks)
+               if pool is not None else map(annotate_mgf_star, tasks))
+
+    counts = [{} for fdr_threshold in fdr_thresholds]
+    progress = instrument.Progress(len(tasks), "annotate_mgf", "files")
+    for mgf_filename, num_printed in results:
+        progress.update()
+        for index, count in enumerate(num_printed):
+            counts[index][mgf_filename] = count
+            if count < min_psms:
+                print(f"Deleting {os.path.basename(mgf_filename)} with "
+                      + f"{count} PSMs at q<{fdr_thresholds[index]}.",
+                      file=sys.stderr)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return counts
+
+def get_counts_filename(output_dir):
+    "Return the name of the counts file of an output directory."
+    return os.path.normpath(output_dir) + ".annotation-counts.txt"
+
+def write_counts(counts, counts_filename):
+    """Add the PSM counts of a batch to the counts file, replacing any
+    previous counts for the same MGFs."""
+
+    all_counts = {}
+    if os.path.exists(counts_filename):
+        with open(counts_filename, "r") as counts_file:
+            for line in counts_file:
+                mgf_filename, num_psms = line.rstrip("\n").split("\t")
+                all_counts[mgf_filename] = num_psms
+    for mgf_filename, num_psms in counts.items():
+        all_counts[os.path.basename(mgf_filename)] = num_psms
+    with open(counts_filename, "w") as counts_file:
+        for mgf_filename, num_psms in sorted(all_counts.items()):
+            counts_file.write(f"{mgf_filename}\t{num_psms}\n")
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global USAGE
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(
+        description=USAGE, usage=argparse.SUPPRESS,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('threshold', type=str,
+                        help="FDR threshold, or comma-separated thresholds "
+                        + "(batch mode only)")
+    parser.add_argument('log', type=str, help="Crux percolator log file")
+    parser.add_argument('percolator', type=str,
+                        help="PSM-level Percolator output")
+    parser.add_argument('mgfs', nargs='+', help="MGF files to annotate")
+    parser.add_argument('--output_dir', type=str, default=None,
+                        help="Output directory (batch mode)")
+    parser.add_argument('--min_psms', type=int, default=100,
+                        help="In batch mode, delete outputs with fewer PSMs "
+                        + "(default=100)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes (default=1)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    fdr_thresholds = [float(word) for word in args.threshold.split(",")]
+    if args.output_dir is not None:
+        with instrument.stage("annotate_batch") as my_stage:
+            counts = annotate_batch(fdr_thresholds, args.log,
+                                    args.percolator, args.mgfs,
+                                    args.output_dir, args.min_psms,
+                                    args.workers)
+            my_stage.add(psms=sum(counts[0].values()),
+                         bytes=sum(os.path.getsize(mgf_filename)
+                                   for mgf_filename in counts[0]))
+        for threshold_dir, threshold_counts in zip(
+                get_output_dirs(args.output_dir, fdr_thresholds), counts):
+            write_counts(threshold_counts, get_counts_filename(threshold_dir))
+        return
+    if (len(args.mgfs) != 1) or (len(fdr_thresholds) != 1):
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+    fdr_threshold = fdr_thresholds[0]
+    log_filename = args.log
+    percolator_filename = args.percolator
+    mgf_filename = args.mgfs[0]
+
+    # Get the file index from the log file.
+    target_file_index = find_file_index(read_file_indices(log_filename),
+                                        mgf_filename)
+    if (target_file_index == None):
+        print(f"Cannot find {mgf_filename} in {log_filename}.", file=sys.stderr)
+        sys.exit(1)
+    print(f"File index: {target_file_index}.", file=sys.stderr)
+
+    # Read the Percolator PSMs into a dictionary.
+    psms = read_psms(percolator_filename, fdr_threshold,
+                     [target_file_index])[target_file_index]
+    print(f"Read {len(get_peptides(psms, fdr_threshold))} PSMs from "
+          + f"{percolator_filename} at q<{fdr_threshold}.", file=sys.stderr)
+
+    # Write the annotated MGF.
+    with instrument.stage("annotate") as my_stage:
+        num_printed = annotate_mgf(mgf_filename, psms, [sys.stdout],
+                                   [fdr_threshold])[0]
+        my_stage.add(psms=num_printed,
+                     bytes=os.path.getsize(mgf_filename))
     print(f"Printed {num_printed} PSMs.", file=sys.stderr)
 
 if __name__ == '__main__':
     main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+import io
+
+def test_annotate_batch():
+
+    # Two MGFs with three spectra each; the second MGF has one PSM.
+    work_dir = tempfile.mkdtemp()
+    mgf_filenames = [os.path.join(work_dir, f"{name}.mgf")
+                     for name in ("a", "b")]
+    for mgf_filename in mgf_filenames:
+        with open(mgf_filename, "w") as mgf_file:
+            for scan in range(1, 4):
+                mgf_file.write("BEGIN IONS\nTITLE=run.1.1.2 File:\"run.raw\", "
+                               + "NativeID:\"controllerType=0 "
+                               + f"controllerNumber=1 scan={scan}\"\n"
+                               + "PEPMASS=500.0\nCHARGE=2+\n100.0 1.0\n"
+                               + "END IONS\n\n")
+    log_filename = os.path.join(work_dir, "percolator.log.txt")
+    with open(log_filename, "w") as log_file:
+        for file_index, mgf_filename in enumerate(mgf_filenames):
+            log_file.write(f"INFO: Assigning index {file_index} to "
+                           + f"{mgf_filename}.\n")
+    percolator_filename = os.path.join(work_dir, "percolator.txt")
+    with open(percolator_filename, "w") as percolator_file:
+        percolator_file.write("PSMId\tq-value\tpeptide\n")
+        for psm_id, qvalue in (("0_1", 0.001), ("0_2", 0.005),
+                               ("0_3", 0.5), ("1_2", 0.001)):
+            percolator_file.write(f"target_{psm_id}_2_1\t{qvalue}\t"
+                                  + "K.PEPTIDEK.A\n")
+
+    # The same output as in single-file mode.
+    output_dir = tempfile.mkdtemp()
+    counts = annotate_batch([0.01], log_filename, percolator_filename,
+                            mgf_filenames, output_dir, min_psms=2, workers=2)
+    assert(counts == [{mgf_filenames[0]: 2, mgf_filenames[1]: 1}])
+    assert(os.listdir(output_dir) == ["a.mgf"])
+    write_counts(counts[0], get_counts_filename(output_dir + "/"))
+    with open(f"{output_dir}.annotation-counts.txt") as counts_file:
+        assert(counts_file.read() == "a.mgf\t2\nb.mgf\t1\n")
+    psms = read_psms(percolator_filename, 0.01, [0])[0]
+    assert(get_peptides(psms, 0.01) == {1: "K.PEPTIDEK.A", 2: "K.PEPTIDEK.A"})
+    single = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    annotate_mgf(mgf_filenames[0], psms, [single], [0.01])
+    single.close()
+    with open(single.name) as single_file, \
+         open(os.path.join(output_dir, "a.mgf")) as batch_file:
+        assert(single_file.read() == batch_file.read())
+
+def test_thresholds():
+
+    # The PSMs for scan 1 are K.PEPTIDEK.A (q=0.001) and then K.PEPTLDEK.A
+    # (q=0.02); scan 2 has K.AAAK.A (q=0.04).
+    work_dir = tempfile.mkdtemp()
+    mgf_filename = os.path.join(work_dir, "a.mgf")
+    with open(mgf_filename, "w") as mgf_file:
+        for scan in range(1, 4):
+            mgf_file.write(f"BEGIN IONS\nPEPMASS=500.0\nCHARGE=2+\n"
+                           + f"SCANS={scan}\n100.0 1.0\nEND IONS\n\n")
+    psms = (np.array([1, 1, 2]), np.array([0.001, 0.02, 0.04]),
+            np.array(["K.PEPTIDEK.A", "K.PEPTLDEK.A", "K.AAAK.A"],
+                     dtype=object))
+
+    # One pass gives the same output as one pass per threshold.
+    thresholds = [0.01, 0.05, 0.001]
+    outputs = [io.StringIO() for fdr_threshold in thresholds]
+    assert(annotate_mgf(mgf_filename, psms, outputs, thresholds)
+           == [1, 2, 1])
+    for fdr_threshold, output in zip(thresholds, outputs):
+        single = io.StringIO()
+        annotate_mgf(mgf_filename, psms, [single], [fdr_threshold])
+        assert(output.getvalue() == single.getvalue())
+    assert("SEQ=PEPTIDEK\n" in outputs[0].getvalue())
+
+    # A compressed MGF gives the same output.
+    with open(mgf_filename) as mgf_file, \
+         mgf_io.open_output(f"{mgf_filename}.gz") as compressed_file:
+        compressed_file.write(mgf_file.read())
+    compressed = io.StringIO()
+    annotate_mgf(f"{mgf_filename}.gz", psms, [compressed], [0.01])
+    assert(compressed.getvalue() == outputs[0].getvalue())
+    assert("SEQ=PEPTLDEK\n" in outputs[1].getvalue())
+    assert(get_output_dirs("out", thresholds)
+           == ["out/0.01", "out/0.05", "out/0.001"])
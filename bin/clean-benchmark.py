@@ -3,10 +3,13 @@
 # CREATE DATE: 23 Sep 2022
 import sys
 import argparse
+import multiprocessing
 import os
-import random
-import re
-from pyteomics import mgf
+import instrument
+import manifest
+import mgf_io
+import peptide_table
+import peptides
 
 DESCRIPTION = """
 Clean up the 9-species benchmark to eliminate peptides that are shared
@@ -15,44 +18,291 @@ subdirectory per species, with annotated MGFs in each subdirectory.
 The script creates a copy of that directory structure in the specified
 new location.  For any peptide that appears in more than one species,
 one species is selected at random, and all PSMs associated with that
-peptide in other species are removed.
+peptide in other species are removed.  The random selection is made by
+hashing the peptide with a seed, so it does not depend on the order in
+which the files are read or on the number of worker processes.
 
 At the same time, convert PTMs from Tide format to Casanovo format.
+
+With --manifest, no MGFs are written.  Instead, the new root contains
+a manifest that lists, for each retained spectrum, its location in the
+old benchmark and its converted SEQ (see manifest.py).
+
+With --exclude, the peptides listed in the given file (one peptide and
+species per line, tab-delimited, with isoleucines changed to leucines,
+as written by detect_leakage.py) are first removed from those species.
 """
 
-def convert_ptms (peptide):
+def convert_ptms(peptide):
     "Convert PTMs in a peptide from Tide to Casanovo format."
+    return peptides.convert(peptide, "casanovo", "tide")
+
+def clean_peptide(peptide, do_i2l):
+    "Remove PTMs and, optionally, change isoleucines to leucines."
+    return peptides.convert(peptide, "i2l" if do_i2l else "stripped", "tide")
+
+def write_cleaned_mgf(old_mgf_filename, new_mgf_filename, species,
+                      species_mapping, do_i2l):
+    """Write the spectra whose peptides are assigned to the given species,
+    converting PTMs to Casanovo format.  Each spectrum is parsed and
+    written again.  Returns the number of spectra printed and skipped.
+    Raises KeyError if a peptide is missing from the mapping."""
+
+    num_printed = 0
+    num_skipped = 0
+    with mgf_io.open_output(new_mgf_filename) as new_mgf:
+        for spectrum in mgf_io.read(old_mgf_filename):
+            peptide = spectrum['params']['seq']
+            if (species_mapping[clean_peptide(peptide, do_i2l)] == species):
+                # Convert PTM format.
+                spectrum['params']['seq'] = convert_ptms(peptide)
+                mgf_io.write_spectrum(new_mgf, spectrum)
+                num_printed += 1
+            else:
+                num_skipped += 1
+    return num_printed, num_skipped
+
+def select_spectra(mgf_map, species, species_mapping, do_i2l):
+    """Iterate over the spectra of a mapped MGF (or of a chunk of one; see
+    mgf_io.iter_chunks) without parsing them.
+    Yields (start, seq_start, seq_end, end, peptide) for each spectrum,
+    where the bytes [seq_start, seq_end) hold its SEQ value and peptide is
+    None if the spectrum is assigned to another species."""
+
+    offsets = mgf_io.find_spectra(mgf_map).tolist()
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        seq_start = mgf_map.find(b"\nSEQ=", start, end) + 5
+        if seq_start == 4:
+            raise KeyError(f"spectrum at byte {start}")
+        seq_end = mgf_map.find(b"\n", seq_start, end)
+        if seq_end == -1:
+            seq_end = end
+        peptide = mgf_map[seq_start:seq_end].decode()
+        if peptide.endswith("\r"):
+            peptide = peptide[:-1]
+            seq_end -= 1
+        if (species_mapping[clean_peptide(peptide, do_i2l)] == species):
+            yield start, seq_start, seq_end, end, peptide
+        else:
+            yield start, seq_start, seq_end, end, None
+
+def copy_cleaned_mgf(old_mgf_filename, new_mgf_filename, species,
+                     species_mapping, do_i2l):
+    """Same as write_cleaned_mgf, but without parsing the spectra.  Each
+    retained spectrum is copied verbatim, except for its SEQ line."""
+
+    num_printed = 0
+    num_skipped = 0
+    with mgf_io.open_output(new_mgf_filename, "wb", 1 << 22) as new_mgf:
+        for offset, chunk in mgf_io.iter_chunks(old_mgf_filename):
+            with memoryview(chunk) as chunk_view:
+                for start, seq_start, seq_end, end, peptide in \
+                    select_spectra(chunk, species, species_mapping,
+                                   do_i2l):
+                    if peptide is not None:
+                        new_mgf.write(chunk_view[start:seq_start])
+                        new_mgf.write(convert_ptms(peptide).encode())
+                        new_mgf.write(chunk_view[seq_end:end])
+                        num_printed += 1
+                    else:
+                        num_skipped += 1
+    return num_printed, num_skipped
+
+def list_cleaned_spectra(old_mgf_filename, species, species_mapping, do_i2l):
+    """Same as copy_cleaned_mgf, but returns manifest rows (offset, length,
+    seq) for the retained spectra instead of copying them.  The seq
+    column is empty if the SEQ line does not change."""
+
+    rows = []
+    num_skipped = 0
+    for offset, chunk in mgf_io.iter_chunks(old_mgf_filename):
+        for start, seq_start, seq_end, end, peptide in select_spectra(
+                chunk, species, species_mapping, do_i2l):
+            if peptide is not None:
+                new_peptide = convert_ptms(peptide)
+                rows.append((offset + start, end - start,
+                             new_peptide if new_peptide != peptide else ""))
+            else:
+                num_skipped += 1
+    return rows, num_skipped
+
+def extract_peptides(mgf_filename, do_i2l):
+    "List the distinct cleaned peptides in an MGF, in order of appearance."
+    return list(dict.fromkeys(
+        clean_peptide(seq, do_i2l)
+        for seq in mgf_io.iter_field(mgf_filename, "SEQ")
+    ))
+
+def extract_peptides_star(args):
+    "Unpack arguments for use with Pool.imap."
+    return extract_peptides(*args)
 
-    # Handle internal modifications.
-    mod_dict = {"C":"C+57.021",
-                "M[15.9949]":"M+15.995",
-                "[0.9840]":"+0.984"}
-    for dn_mod in mod_dict.keys():
-        peptide = peptide.replace(dn_mod, mod_dict[dn_mod])
+def read_exclusions(exclude_filename):
+    """Read a file of (peptide, species) pairs to remove.  Returns a
+    dictionary from species to the set of its excluded peptides."""
 
-    # Handle terminal modifications.
-    n_term_mods = { "[-17.0265]":"-17.027",
-                    "[42.0106]":"+42.011",
-                    "[43.0058]":"+43.006",
-                    "[25.9803]":"+43.006-17.027"}
-    for n_mod in n_term_mods.keys():
-        if n_mod in peptide:
-            peptide = n_term_mods[n_mod]+peptide.replace(n_mod, "")
+    exclusions = {}
+    with open(exclude_filename, "r") as exclude_file:
+        for line in exclude_file:
+            if line.strip():
+                peptide, species = line.rstrip("\r\n").split("\t")
+                exclusions.setdefault(species, set()).add(peptide)
+    return exclusions
 
-    return peptide
+# Peptide-to-species mapping used by clean_mgf (set by init_worker).
+SPECIES_MAPPING = {}
 
-def i2l(peptide):
-    "Leucines to isoleucines."
-    return re.sub("I", "L", peptide)
+def init_worker(species_mapping):
+    "Give a worker process the peptide-to-species mapping."
+    global SPECIES_MAPPING
+    SPECIES_MAPPING = species_mapping
 
-def clean_peptide (peptide, do_i2l):
-    "Remove flanking amino acids and PTMs."
+def clean_mgf(task):
+    """Write one cleaned MGF (or list its manifest rows).  Returns the
+    number of spectra printed and skipped, the missing peptide (or None)
+    and the manifest rows (or None)."""
+    global SPECIES_MAPPING
+
+    (old_mgf_filename, new_mgf_filename, species, do_i2l, block_copy,
+     make_manifest) = task
+    try:
+        if make_manifest:
+            rows, num_skipped = list_cleaned_spectra(
+                old_mgf_filename, species, SPECIES_MAPPING, do_i2l
+            )
+            return len(rows), num_skipped, None, rows
+        write_function = copy_cleaned_mgf if block_copy else write_cleaned_mgf
+        num_printed, num_skipped = write_function(
+            old_mgf_filename, new_mgf_filename, species, SPECIES_MAPPING,
+            do_i2l
+        )
+    except KeyError as error:
+        return 0, 0, str(error), None
+    return num_printed, num_skipped, None, None
+
+def list_mgfs(species_dir):
+    """List the MGF files of one species, in a fixed order, skipping
+    other files such as sidecar indexes and peptides.txt."""
+    return sorted(f.name for f in os.scandir(species_dir) if f.is_file()
+                  and mgf_io.is_mgf(f.name))
+
+def clean_benchmark(old_root, new_root, do_i2l, block_copy=False, workers=1,
+                    seed=7718, make_manifest=False, exclude_filename=None):
+    """Create the cleaned copy of old_root (or its manifest) in new_root.
+    Files are read and written by a pool of worker processes; the output
+    does not depend on the number of workers.  Returns False if a peptide
+    is missing from the mapping."""
+
+    # Get the list of species.
+    species_list = sorted(f.name for f in os.scandir(old_root) if f.is_dir())
+    mgf_files = [(species, mgf_file) for species in species_list
+                 for mgf_file in list_mgfs(os.path.join(old_root, species))]
+
+    num_bytes = sum(os.path.getsize(os.path.join(old_root, species,
+                                                 mgf_file))
+                    for species, mgf_file in mgf_files)
+
+    # Construct the peptide-to-species mapping.  Results are merged in file
+    # order, so the mapping is the same for any number of workers.
+    with instrument.stage("extract_peptides") as my_stage:
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        peptide_lists = (pool.imap if pool else map)(
+            extract_peptides_star,
+            [(os.path.join(old_root, species, mgf_file), do_i2l)
+             for species, mgf_file in mgf_files]
+        )
+        species_mapping = peptide_table.PeptideTable(species_list)
+        previous_species = None
+        progress = instrument.Progress(len(mgf_files), "extract_peptides",
+                                       "files")
+        for (species, mgf_file), file_peptides in zip(mgf_files,
+                                                      peptide_lists):
+            if species != previous_species:
+                print(f"Extracting peptides from {species}.", file=sys.stderr)
+                previous_species = species
+            species_mapping.add(file_peptides, species)
+            my_stage.add(peptides=len(file_peptides))
+            progress.update()
+        print(f"Found {len(species_mapping)} peptides.", file=sys.stderr)
+        if pool:
+            pool.close()
+            pool.join()
+        my_stage.add(bytes=num_bytes)
+
+    # Remove the peptides that leak between species.
+    if exclude_filename is not None:
+        exclusions = read_exclusions(exclude_filename)
+        for species in species_list:
+            excluded = exclusions.get(species, set())
+            species_mapping.remove(
+                [peptide for peptide in species_mapping.peptides
+                 if peptide.replace("I", "L") in excluded], species
+            )
+        print(f"Excluded {sum(map(len, exclusions.values()))} peptides.",
+              file=sys.stderr)
+
+    # If a peptide appears in more than one species, select one randomly.
+    with instrument.stage("assign_peptides"):
+        num_duplicates = species_mapping.assign(
+            lambda peptide, species: peptide_table.choose_species(
+                peptide, species, seed
+            )
+        )
+    print(f"Found {num_duplicates} duplicated peptides.", file=sys.stderr)
 
-    no_mods = re.sub(r"[0-9\.\[\]\+\-]+", "", peptide)
+    # Print the peptides for each species.
+    for species, species_peptides in \
+        species_mapping.group_by_species().items():
+        os.makedirs(os.path.join(new_root, species), exist_ok=True)
+        with open(os.path.join(new_root, species, "peptides.txt"), "w") \
+             as peptide_filename:
+            peptide_filename.write("".join(f"{peptide}\n"
+                                           for peptide in species_peptides))
+        print(f"{len(species_peptides)} distinct peptides in {species}.", 
+              file=sys.stderr)
 
-    if do_i2l:
-        return i2l(no_mods)
-    return no_mods
+    # Create the cleaned MGFs.
+    with instrument.stage("write_mgfs", block_copy=bool(block_copy),
+                          manifest=bool(make_manifest)) as my_stage:
+        tasks = [(os.path.join(old_root, species, mgf_file),
+                  os.path.join(new_root, species, mgf_file),
+                  species, do_i2l, block_copy, make_manifest)
+                 for species, mgf_file in mgf_files]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                        initargs=(species_mapping,))
+            results = pool.imap(clean_mgf, tasks)
+        else:
+            init_worker(species_mapping)
+            results = map(clean_mgf, tasks)
+        success = True
+        manifest_rows = []
+        progress = instrument.Progress(len(tasks), "write_mgfs", "files")
+        for (species, mgf_file), (num_printed, num_skipped, missing, rows) \
+            in zip(mgf_files, results):
+            progress.update()
+            if missing is not None:
+                print(f"Cannot find {missing} from {mgf_file}.",
+                      file=sys.stderr)
+                success = False
+                break
+            print(f"Created {species}/{mgf_file}: printed {num_printed} "
+                  + f"spectra and skipped {num_skipped}.", file=sys.stderr)
+            my_stage.add(spectra=num_printed + num_skipped)
+            if rows:
+                old_mgf_filename = os.path.join(old_root, species, mgf_file)
+                manifest_rows += [(species, mgf_file, old_mgf_filename) + row
+                                  for row in rows]
+        if workers > 1:
+            pool.terminate()
+            pool.join()
+        if success and make_manifest:
+            manifest.write_manifest(
+                os.path.join(new_root, manifest.MANIFEST_FILENAME),
+                manifest_rows
+            )
+        my_stage.add(bytes=num_bytes)
+    return success
 
 ###########################################################################
 # MAIN
@@ -60,8 +310,6 @@ def clean_peptide (peptide, do_i2l):
 def main():
     global DESCRIPTION
 
-    random.seed(7718)
-
     # Parse the command line.
     parser = argparse.ArgumentParser(description=DESCRIPTION)
     parser.add_argument('--old_root', type=str, required=True,
@@ -70,90 +318,28 @@ def main():
                         help="Directory of new benchmark")
     parser.add_argument('--i2l', action=argparse.BooleanOptionalAction,
                         help="Isoleucine to leucine")
+    parser.add_argument('--block_copy', action=argparse.BooleanOptionalAction,
+                        help="Copy spectra verbatim, rewriting only the SEQ "
+                        + "lines, instead of parsing and re-writing them")
+    parser.add_argument('--manifest', action=argparse.BooleanOptionalAction,
+                        help="Write a manifest of the retained spectra "
+                        + "instead of MGFs")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes (default=1)")
+    parser.add_argument('--seed', type=int, default=7718,
+                        help="Seed for assigning shared peptides to species "
+                        + "(default=7718)")
+    parser.add_argument('--exclude', type=str, default=None,
+                        help="Tab-delimited peptides and species to remove "
+                        + "(see detect_leakage.py)")
+    instrument.add_arguments(parser)
     args = parser.parse_args()
-    
-    # Get the list of species.
-    species_list = [ f.name for f in os.scandir(args.old_root) if f.is_dir() ]
-
-    # Construct the peptide-to-species mapping.
-    species_mapping = {} # key = peptide, value = list of species
-    for species in species_list:
-        print(f"Extracting peptides from {species}.", file=sys.stderr)
-        mgf_list = [ f.name for f in os.scandir(os.path.join(args.old_root, 
-                                                             species))
-                     if f.is_file() ]
-        for mgf_filename in mgf_list:
-            with open(os.path.join(args.old_root, species, 
-                                   mgf_filename), "r") as mgf_file:
-                for line in mgf_file:
-                    if (line[:4] == "SEQ="):
-                        peptide = clean_peptide(line[4:-1], args.i2l)
-                        if (peptide not in species_mapping):
-                            species_mapping[peptide] = [species]
-                        elif (species not in species_mapping[peptide]):
-                            species_mapping[peptide].append(species)
-        print(f"Found {len(species_mapping)} peptides.", file=sys.stderr)
-
-    # If a peptide appears in more than one species, select one randomly.
-    num_duplicates = 0
-    eliminated_psms = 0
-    for peptide in species_mapping.keys():
-        if (len(species_mapping[peptide]) > 1):
-            selected_species = random.choice(species_mapping[peptide])
-            species_mapping[peptide] = selected_species
-            num_duplicates += 1
-        else:
-            species_mapping[peptide] = species_mapping[peptide][0]
-    print(f"Found {num_duplicates} duplicated peptides.", file=sys.stderr)
-
-    # Create the new benchmark.
-    for species in species_list:
-        os.makedirs(os.path.join(args.new_root, species), exist_ok=True)
-
-        # Print the peptides for that species.
-        with open(os.path.join(args.new_root, species, "peptides.txt"), "w") \
-             as peptide_filename:
-            num_peptides = 0
-            for peptide in species_mapping.keys():
-                if species_mapping[peptide] == species:
-                    peptide_filename.write(f"{peptide}\n")
-                    num_peptides += 1
-        print(f"{num_peptides} distinct peptides in {species}.", 
-              file=sys.stderr)
+    instrument.setup(args)
 
-        print(f"Creating cleaned MGFs for {species}.", file=sys.stderr)
-        mgf_list = [
-            f.name for f in os.scandir(os.path.join(args.old_root, species))
-            if f.is_file()
-        ]
-        for mgf_file in mgf_list:
-            old_mgf_filename = os.path.join(args.old_root, species, mgf_file)
-            new_mgf_filename = os.path.join(args.new_root, species, mgf_file)
-            print(f"Creating {mgf_file}.", file=sys.stderr)
-            num_printed = 0
-            num_skipped = 0
-            with mgf.read(source=old_mgf_filename, use_header=False,
-                          read_charges=False, use_index=False) as reader, \
-                 open(new_mgf_filename, "w") as new_mgf:
-                for spectrum in reader:
-                    peptide = spectrum['params']['seq']
-                    unmod_peptide = clean_peptide(peptide, args.i2l)
-
-                    try:
-                        if (species_mapping[unmod_peptide] == species):
-                            # Convert PTM format.
-                            spectrum['params']['seq'] = convert_ptms(peptide)
-                            mgf.write([spectrum], output=new_mgf)
-                            num_printed += 1
-                        else:
-                            num_skipped += 1
-                    except:
-                        print(f"Cannot find {peptide} from {mgf_file}.",
-                              file=sys.stderr)
-                        sys.exit(1)
-                        
-            print(f"Printed {num_printed} spectra and skipped {num_skipped}.",
-                  file=sys.stderr)
+    if not clean_benchmark(args.old_root, args.new_root, args.i2l,
+                           args.block_copy, args.workers, args.seed,
+                           args.manifest, args.exclude):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -169,3 +355,120 @@ def test_convert_ptms():
     assert("+43.006HHVLHHQTVDK" == convert_ptms("H[43.0058]HVLHHQTVDK"))
     assert("+43.006IIQ+0.984N+0.984AYK"
            == convert_ptms("I[43.0058]IQ[0.9840]N[0.9840]AYK"))
+
+annotated_mgf = """BEGIN IONS
+TITLE=controllerType=0 controllerNumber=1 scan=2475
+PEPMASS=561.798400878906
+RTINSECONDS=832.4328
+CHARGE=2+
+SCANS=2475
+SEQ=I[43.0058]IQ[0.9840]N[0.9840]AYK
+100.0757 10
+147.1124878 10
+END IONS
+
+BEGIN IONS
+TITLE=controllerType=0 controllerNumber=1 scan=2476
+PEPMASS=561.798400878906
+CHARGE=2+
+SCANS=2476
+SEQ=PEPTLDEK
+1033.7346191 10
+END IONS
+"""
+
+def test_copy_cleaned_mgf():
+    global annotated_mgf
+
+    old_mgf = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    old_mgf.write(annotated_mgf)
+    old_mgf.close()
+    new_mgf = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    new_mgf.close()
+
+    # Only the SEQ line changes.
+    species_mapping = {"LLQNAYK": "yeast", "PEPTLDEK": "human"}
+    assert(copy_cleaned_mgf(old_mgf.name, new_mgf.name, "yeast",
+                            species_mapping, True) == (1, 1))
+    with open(new_mgf.name, "r") as mgf_file:
+        assert(mgf_file.read()
+               == annotated_mgf[:annotated_mgf.index("BEGIN IONS", 1)]
+               .replace("I[43.0058]IQ[0.9840]N[0.9840]AYK",
+                        "+43.006IIQ+0.984N+0.984AYK"))
+
+    # Same spectra as when parsing and re-writing.
+    parsed_mgf = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    parsed_mgf.close()
+    assert(write_cleaned_mgf(old_mgf.name, parsed_mgf.name, "yeast",
+                             species_mapping, True) == (1, 1))
+    assert(list(mgf_io.read(parsed_mgf.name))[0]['params']
+           == list(mgf_io.read(new_mgf.name))[0]['params'])
+
+    with pytest.raises(KeyError):
+        copy_cleaned_mgf(old_mgf.name, new_mgf.name, "yeast", {}, True)
+
+def test_clean_benchmark():
+    global annotated_mgf
+
+    # Both species contain LLQNAYK (after I->L).
+    old_root = tempfile.mkdtemp()
+    for species, mgf_text in (
+            ("yeast", annotated_mgf),
+            ("human", annotated_mgf.replace("PEPTLDEK", "LIQNAYK"))):
+        os.makedirs(os.path.join(old_root, species))
+        for i in range(3):
+            with open(os.path.join(old_root, species, f"{i}.mgf"), "w") \
+                 as mgf_file:
+                mgf_file.write(mgf_text)
+        with open(os.path.join(old_root, species, "peptides.txt"), "w") \
+             as peptide_file:
+            peptide_file.write("PEPTLDEK\t1\n")
+
+    # The output is the same with one or more workers.
+    outputs = []
+    for workers, block_copy in ((1, False), (2, False), (2, True)):
+        new_root = tempfile.mkdtemp()
+        assert(clean_benchmark(old_root, new_root, True, block_copy,
+                               workers))
+        output = {}
+        for species in ("yeast", "human"):
+            with open(os.path.join(new_root, species, "peptides.txt")) \
+                 as peptide_file:
+                output[species] = peptide_file.read()
+            for i in range(3):
+                output[species, i] = list(mgf_io.read(
+                    os.path.join(new_root, species, f"{i}.mgf"), peaks=False
+                ))
+        outputs.append(output)
+        assert(sorted(os.listdir(os.path.join(new_root, "yeast")))
+               == ["0.mgf", "1.mgf", "2.mgf", "peptides.txt"])
+    assert(outputs[0] == outputs[1] == outputs[2])
+
+    # A manifest gives the same spectra as the block copy.
+    manifest_root = tempfile.mkdtemp()
+    assert(clean_benchmark(old_root, manifest_root, True, workers=2,
+                           make_manifest=True))
+    assert(not os.path.exists(os.path.join(manifest_root, "yeast", "0.mgf")))
+    manifest.materialize(manifest_root, manifest_root)
+    for i in range(3):
+        with open(os.path.join(new_root, "yeast", f"{i}.mgf")) as mgf_file, \
+             open(os.path.join(manifest_root, "yeast", f"{i}.mgf")) \
+             as manifest_mgf:
+            assert(mgf_file.read() == manifest_mgf.read())
+    peptides = outputs[0]["yeast"] + outputs[0]["human"]
+    assert(sorted(peptides.split()) == ["LLQNAYK", "PEPTLDEK"])
+
+    # Excluded peptides are removed from the given species only.
+    exclude_filename = os.path.join(old_root, "exclude.txt")
+    with open(exclude_filename, "w") as exclude_file:
+        exclude_file.write("PEPTLDEK\tyeast\nLLQNAYK\thuman\n")
+    exclude_root = tempfile.mkdtemp()
+    assert(clean_benchmark(old_root, exclude_root, False,
+                           exclude_filename=exclude_filename))
+    for species, expected in (("yeast", ["IIQNAYK"]), ("human", [])):
+        with open(os.path.join(exclude_root, species, "peptides.txt")) \
+             as peptide_file:
+            assert(peptide_file.read().split() == expected)
+        assert([spectrum["params"]["seq"] for spectrum in mgf_io.read(
+            os.path.join(exclude_root, species, "0.mgf"), peaks=False
+        )] == ["+43.006IIQ+0.984N+0.984AYK"] * len(expected))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# CREATE DATE: 18 Oct 2026
+import sys
+import argparse
+import contextlib
+import os
+import instrument
+import mgf_io
+
+DESCRIPTION = """Compress or decompress MGF files.
+
+Each MGF is rewritten next to itself, with the extension of the requested
+compression (e.g., a.mgf becomes a.mgf.gz), in the block format written
+by mgf_io.open_output: blocks are compressed by a pool of threads, can be
+decompressed in parallel, and let single spectra be read through the
+sidecar index (see mgf_index.py).  Compressed files written by the
+standard tools are converted in the same way, and "none" decompresses.
+The new file is checked against the old one, a block at a time, before
+the old one is removed (with --remove)."""
+
+EXTENSIONS = {compression: extension
+              for extension, compression in mgf_io.COMPRESSIONS.items()}
+
+def get_output_filename(mgf_filename, compression):
+    "Return the name of an MGF file with another compression (or none)."
+    mgf_filename = mgf_io.strip_compression(mgf_filename)
+    return mgf_filename + EXTENSIONS[compression] if compression \
+        else mgf_filename
+
+def iter_pieces(mgf_filename):
+    """Iterate over the uncompressed bytes of an MGF file in pieces of at
+    most BLOCK_SIZE bytes (see mgf_io.iter_chunks)."""
+    for offset, chunk in mgf_io.iter_chunks(mgf_filename):
+        for start in range(0, len(chunk), mgf_io.BLOCK_SIZE):
+            yield chunk[start:start + mgf_io.BLOCK_SIZE]
+
+def same_content(mgf_filename1, mgf_filename2):
+    """Check whether two MGF files, compressed or not, have the same
+    uncompressed bytes, reading both a piece at a time."""
+
+    with contextlib.closing(iter_pieces(mgf_filename1)) as pieces1, \
+         contextlib.closing(iter_pieces(mgf_filename2)) as pieces2:
+        rest1 = rest2 = b""
+        while True:
+            if len(rest1) == 0:
+                rest1 = next(pieces1, None)
+            if len(rest2) == 0:
+                rest2 = next(pieces2, None)
+            if (rest1 is None) or (rest2 is None):
+                return (rest1 is None) and (rest2 is None)
+            length = min(len(rest1), len(rest2))
+            if rest1[:length] != rest2[:length]:
+                return False
+            rest1 = rest1[length:]
+            rest2 = rest2[length:]
+
+def convert_mgf(mgf_filename, compression, threads=None):
+    """Atomically write a copy of an MGF file with the given compression
+    (or None), and check it.  Returns the name of the copy and the number
+    of uncompressed bytes."""
+
+    output_filename = get_output_filename(mgf_filename, compression)
+    if output_filename == mgf_filename:
+        raise ValueError(f"{mgf_filename} is already in that format.")
+    num_bytes = 0
+    with mgf_io.open_output(f"{output_filename}.tmp", "wb",
+                            compression=compression,
+                            threads=threads) as output_file:
+        for piece in iter_pieces(mgf_filename):
+            output_file.write(piece)
+            num_bytes += len(piece)
+    os.replace(f"{output_filename}.tmp", output_filename)
+
+    if not same_content(mgf_filename, output_filename):
+        os.remove(output_filename)
+        raise ValueError(f"Cannot convert {mgf_filename}.")
+    return output_filename, num_bytes
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global DESCRIPTION
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('mgfs', nargs="+", help="MGF files")
+    parser.add_argument('--compression', type=str, default="gzip",
+                        choices=list(EXTENSIONS) + ["none"],
+                        help="Output compression (default=gzip)")
+    parser.add_argument('--remove', action="store_true", default=False,
+                        help="Remove each input once it is converted")
+    parser.add_argument('--threads', type=int,
+                        default=mgf_io.COMPRESSION_THREADS,
+                        help="Number of compression threads (default="
+                        + f"{mgf_io.COMPRESSION_THREADS})")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+    compression = None if args.compression == "none" else args.compression
+    try:
+        mgf_io.check_compression(compression or "gzip")
+    except ValueError as error:
+        parser.error(str(error))
+
+    with instrument.stage("compress_mgf") as my_stage:
+        progress = instrument.Progress(len(args.mgfs), "compress_mgf",
+                                       "files")
+        for mgf_filename in args.mgfs:
+            output_filename, num_bytes = convert_mgf(mgf_filename,
+                                                     compression,
+                                                     args.threads)
+            old_size = os.path.getsize(mgf_filename)
+            new_size = os.path.getsize(output_filename)
+            print(f"Wrote {output_filename} ({old_size} to {new_size} "
+                  + "bytes).", file=sys.stderr)
+            if args.remove:
+                os.remove(mgf_filename)
+            my_stage.add(bytes=num_bytes)
+            progress.update()
+
+if __name__ == "__main__":
+    main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+import gzip
+
+def test_convert_mgf():
+    mgf_filename = os.path.join(tempfile.mkdtemp(), "a.mgf")
+    text = "".join(f"BEGIN IONS\nSCANS={scan}\nPEPMASS=500.0\n100.0 1.0\n"
+                   + "END IONS\n\n" for scan in range(1000))
+    with open(mgf_filename, "w") as mgf_file:
+        mgf_file.write(text)
+
+    # To and between compressions, and back.
+    gzip_filename, num_bytes = convert_mgf(mgf_filename, "gzip")
+    assert((gzip_filename == f"{mgf_filename}.gz")
+           and (num_bytes == len(text)))
+    assert(os.path.getsize(gzip_filename) < len(text) / 5)
+    with gzip.open(gzip_filename, "rt") as gzip_file:
+        assert(gzip_file.read() == text)
+    assert(convert_mgf(gzip_filename, "bz2")[0] == f"{mgf_filename}.bz2")
+    os.remove(mgf_filename)
+    assert(convert_mgf(f"{mgf_filename}.bz2", None)[0] == mgf_filename)
+    with open(mgf_filename) as mgf_file:
+        assert(mgf_file.read() == text)
+    with pytest.raises(ValueError):
+        convert_mgf(mgf_filename, None)
+
+    # Files with the same bytes in different pieces are the same.
+    assert(same_content(mgf_filename, f"{mgf_filename}.gz"))
+    with open(mgf_filename, "a") as mgf_file:
+        mgf_file.write("\n")
+    assert(not same_content(mgf_filename, f"{mgf_filename}.gz"))
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# CREATE DATE: 18 Oct 2026
+import sys
+import argparse
+import collections
+import multiprocessing
+import os
+import re
+import numpy as np
+import instrument
+import mgf_io
+import peptide_table
+import peptides
+import spectrum_store
+
+DESCRIPTION = """Find peptides that leak between the species of a
+benchmark even though no peptide string is shared.  Two kinds of leakage
+are reported:
+
+ o containment: a peptide of one species is a substring of a peptide of
+   another species, and
+ o isobaric: two peptides of different species have the same residue
+   composition up to isobaric swaps (I vs L, N vs GG, Q vs AG or GA and,
+   with --low_resolution, K vs Q).
+
+Peptides are compared after removing PTMs and mapping each residue to a
+canonical string (I to L, N to GG, Q to AG and, with --low_resolution,
+K to AG).  Containment is found with a prefix-doubling substring index
+over all canonical peptides, so the running time grows as n log n in the
+total length of the peptides rather than with the number of pairs.  For
+isobaric collisions, runs of A and G are also sorted, so that GA and AG
+compare equal.
+
+The benchmark root contains one directory of MGFs (or one spectrum
+store) per species.  The report lists one pair of peptides per line.
+With --exclude_filename, the leakage is resolved: each group of
+peptides connected by reported pairs is kept in one species, selected by
+hashing the group with a seed, and the peptide/species pairs to drop are
+written in the format read by clean-benchmark.py --exclude."""
+
+# Residue replacements that preserve substrings and mass.
+CANONICAL_RESIDUES = {"I": "L", "N": "GG", "Q": "AG"}
+LOW_RESOLUTION_RESIDUES = {"K": "AG"}
+
+REPORT_COLUMNS = ["kind", "peptide", "species", "other_peptide",
+                  "other_species"]
+
+def get_translation(low_resolution):
+    "Return the str.translate table that canonicalizes residues."
+    residues = dict(CANONICAL_RESIDUES)
+    if low_resolution:
+        residues.update(LOW_RESOLUTION_RESIDUES)
+    return str.maketrans(residues)
+
+def canonicalize(peptide, translation):
+    """Map each residue of a stripped peptide to its canonical string.  A
+    substring of a peptide maps to a substring of its canonical form."""
+    return peptide.translate(translation)
+
+def sort_runs(match):
+    "Put the A's of a run of A's and G's first."
+    run = match.group(0)
+    return "A" * run.count("A") + "G" * run.count("G")
+
+def collision_key(canonical_peptide):
+    """Return the key shared by peptides that differ only by isobaric
+    swaps, given the canonical form of a peptide."""
+    if "GA" not in canonical_peptide:
+        return canonical_peptide # Runs are already sorted.
+    return re.sub(r"[AG]{2,}", sort_runs, canonical_peptide)
+
+def list_species_files(root):
+    """Return a dictionary from species name to the list of its MGF files
+    (or its spectrum store), for each species directory in root."""
+
+    species_files = {}
+    for species in sorted(f.name for f in os.scandir(root) if f.is_dir()):
+        species_dir = os.path.join(root, species)
+        if spectrum_store.is_store(species_dir):
+            species_files[species] = [species_dir]
+        else:
+            species_files[species] = sorted(
+                f.path for f in os.scandir(species_dir)
+                if f.is_file() and mgf_io.is_mgf(f.name)
+            )
+    return species_files
+
+def extract_peptides(mgf_filename):
+    """List the distinct stripped peptides, with I changed to L, in an MGF
+    file or spectrum store."""
+    return list(dict.fromkeys(peptides.convert(seq, "i2l") for seq
+                              in peptide_table.iter_seqs(mgf_filename)))
+
+def read_peptides(species_files, workers=1):
+    "Return a PeptideTable of the peptides in each species."
+
+    mgf_files = [(species, mgf_filename)
+                 for species, mgf_filenames in species_files.items()
+                 for mgf_filename in mgf_filenames]
+    table = peptide_table.PeptideTable(list(species_files))
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    peptide_lists = (pool.imap if pool else map)(
+        extract_peptides, [mgf_filename for _, mgf_filename in mgf_files]
+    )
+    progress = instrument.Progress(len(mgf_files), "read_peptides", "files")
+    for (species, _), file_peptides in zip(mgf_files, peptide_lists):
+        table.add(file_peptides, species)
+        progress.update()
+    if pool:
+        pool.close()
+        pool.join()
+    return table
+
+def pair_classes(classes, shift):
+    """Combine the class of each position with the class of the position
+    shift places later into one integer key.  Positions past the end get
+    class 0."""
+
+    shifted = np.zeros_like(classes)
+    shifted[:len(classes) - shift] = classes[shift:]
+    return classes * (int(classes.max()) + 1) + shifted
+
+def find_containment(sequences, min_length=1):
+    """Return two arrays (inner, outer) of indices into a list of distinct
+    sequences, such that sequences[inner[i]] is a proper substring of
+    sequences[outer[i]] and is at least min_length long.  Each pair is
+    listed once, sorted.
+
+    The sequences are concatenated with separators, and the substrings of
+    length 1, 2, 4, ... are numbered by repeated sorting (Karp, Miller and
+    Rosenberg), as when building a suffix array by prefix doubling.  A
+    substring of length between w and 2w is then identified by the numbers
+    of its first and last w characters, so the occurrences of all the
+    sequences of one length are found with one sorted search."""
+
+    if len(sequences) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    text = "\0".join(sequences) + "\0"
+    classes = np.frombuffer(text.encode("ascii"), dtype=np.uint8) \
+        .astype(np.int64)
+    lengths = np.array([len(sequence) for sequence in sequences],
+                       dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths + 1)[:-1]))
+    max_length = int(lengths.max())
+    num_classes = 256
+
+    inner = []
+    outer = []
+    width = 1
+    while True:
+        for length in range(max(width, min_length),
+                            min(2 * width, max_length + 1)):
+            patterns = np.flatnonzero(lengths == length)
+            if len(patterns) == 0:
+                continue
+            # Only positions whose first w characters start some sequence
+            # of this length can match one.
+            first_halves = classes[starts[patterns]]
+            is_first_half = np.zeros(num_classes, dtype=bool)
+            is_first_half[first_halves] = True
+            positions = np.flatnonzero(is_first_half[classes])
+            pattern_keys = first_halves * num_classes \
+                + classes[starts[patterns] + length - width]
+            keys = classes[positions] * num_classes \
+                + classes[positions + length - width]
+            order = np.argsort(pattern_keys, kind="stable")
+            sorted_keys = pattern_keys[order]
+            index = np.minimum(np.searchsorted(sorted_keys, keys),
+                               len(sorted_keys) - 1)
+            matches = sorted_keys[index] == keys
+            positions = positions[matches]
+            found = patterns[order[index[matches]]]
+            containers = np.searchsorted(starts, positions, side="right") - 1
+            keep = found != containers
+            inner.append(found[keep])
+            outer.append(containers[keep])
+        if 2 * width > max_length:
+            break
+        # Class 0 stays the class of a run of separators, because the text
+        # ends with one.
+        _, classes = np.unique(pair_classes(classes, width),
+                               return_inverse=True)
+        classes = classes.reshape(-1).astype(np.int64)
+        num_classes = int(classes.max()) + 1
+        width *= 2
+
+    if len(inner) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs = np.unique(np.stack((np.concatenate(inner),
+                                np.concatenate(outer)), axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+def spans_species(table, peptide_id, other_id):
+    "Are two peptides, together, found in more than one species?"
+    mask = int(table.masks[peptide_id] | table.masks[other_id])
+    return mask & (mask - 1) != 0
+
+def find_leakage(table, low_resolution=False, min_length=7):
+    """Find the pairs of peptides in a PeptideTable that leak between
+    species.  Returns a list of (kind, peptide ID, other peptide ID), where
+    kind is "containment" (the peptide is a substring of the other) or
+    "isobaric"."""
+
+    translation = get_translation(low_resolution)
+    canonical_ids = collections.defaultdict(list) # Key = canonical peptide
+    for peptide_id, peptide in enumerate(table.peptides):
+        canonical_ids[canonicalize(peptide, translation)].append(peptide_id)
+    canonical_peptides = list(canonical_ids)
+
+    leaks = []
+    with instrument.stage("find_containment") as my_stage:
+        inner, outer = find_containment(canonical_peptides, min_length)
+        for inner_index, outer_index in zip(inner.tolist(), outer.tolist()):
+            for peptide_id in canonical_ids[canonical_peptides[inner_index]]:
+                if len(table.peptides[peptide_id]) < min_length:
+                    continue
+                for other_id in \
+                    canonical_ids[canonical_peptides[outer_index]]:
+                    if spans_species(table, peptide_id, other_id):
+                        leaks.append(("containment", peptide_id, other_id))
+        my_stage.add(peptides=len(table), bytes=sum(
+            len(peptide) + 1 for peptide in canonical_peptides
+        ))
+
+    with instrument.stage("find_isobaric") as my_stage:
+        collisions = collections.defaultdict(list)
+        for canonical_peptide, peptide_ids in canonical_ids.items():
+            collisions[collision_key(canonical_peptide)] += peptide_ids
+        for peptide_ids in collisions.values():
+            for index, peptide_id in enumerate(peptide_ids):
+                for other_id in peptide_ids[index + 1:]:
+                    if spans_species(table, peptide_id, other_id):
+                        leaks.append(("isobaric", peptide_id, other_id))
+        my_stage.add(peptides=len(table))
+    return leaks
+
+def resolve_leakage(table, leaks, seed=7718):
+    """Group the peptides connected by leaks, and keep each group in one
+    species.  Returns a list of (peptide, species) pairs to remove, in
+    peptide ID order."""
+
+    parents = {}
+    def find(peptide_id):
+        root = peptide_id
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while peptide_id != root:
+            parents[peptide_id], peptide_id = root, parents[peptide_id]
+        return root
+    for _, peptide_id, other_id in leaks:
+        parents.setdefault(peptide_id, peptide_id)
+        parents.setdefault(other_id, other_id)
+        parents[find(peptide_id)] = find(other_id)
+
+    groups = collections.defaultdict(list) # Key = root ID
+    for peptide_id in sorted(parents):
+        groups[find(peptide_id)].append(peptide_id)
+    removals = []
+    for peptide_ids in groups.values():
+        species_list = sorted({species for peptide_id in peptide_ids
+                               for species in table.species_of(
+                                   table.peptides[peptide_id])})
+        keep = peptide_table.choose_species(
+            min(table.peptides[peptide_id] for peptide_id in peptide_ids),
+            species_list, seed
+        )
+        removals += [(peptide_id, species) for peptide_id in peptide_ids
+                     for species in table.species_of(
+                         table.peptides[peptide_id])
+                     if species != keep]
+    return [(table.peptides[peptide_id], species)
+            for peptide_id, species in sorted(removals)]
+
+def write_report(table, leaks, report_filename):
+    "Write one line per leaking pair of peptides."
+    with open(report_filename, "w") as report_file:
+        report_file.write("\t".join(REPORT_COLUMNS) + "\n")
+        for kind, peptide_id, other_id in leaks:
+            peptide = table.peptides[peptide_id]
+            other_peptide = table.peptides[other_id]
+            report_file.write(
+                f"{kind}\t{peptide}\t{','.join(table.species_of(peptide))}"
+                + f"\t{other_peptide}\t"
+                + f"{','.join(table.species_of(other_peptide))}\n"
+            )
+
+def write_exclusions(removals, exclude_filename):
+    "Write the peptide/species pairs to remove, one per line."
+    with open(exclude_filename, "w") as exclude_file:
+        exclude_file.write("".join(f"{peptide}\t{species}\n"
+                                   for peptide, species in removals))
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global DESCRIPTION
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--root', type=str, required=True,
+                        help="Benchmark directory, with one MGF directory "
+                        + "or spectrum store per species")
+    parser.add_argument('--report_filename', type=str, required=True,
+                        help="Tab-delimited list of leaking peptide pairs")
+    parser.add_argument('--exclude_filename', type=str, default=None,
+                        help="Resolve the leakage, and write the peptides "
+                        + "to remove from each species to this file")
+    parser.add_argument('--low_resolution',
+                        action=argparse.BooleanOptionalAction,
+                        help="Treat K and Q as isobaric")
+    parser.add_argument('--min_length', type=int, default=7,
+                        help="Shortest peptide reported as contained in "
+                        + "another (default=7)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes (default=1)")
+    parser.add_argument('--seed', type=int, default=7718,
+                        help="Seed for choosing the species that keeps a "
+                        + "group of leaking peptides (default=7718)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    with instrument.stage("read_peptides") as my_stage:
+        table = read_peptides(list_species_files(args.root), args.workers)
+        my_stage.add(peptides=len(table))
+    print(f"Found {len(table)} peptides.", file=sys.stderr)
+
+    leaks = find_leakage(table, args.low_resolution, args.min_length)
+    for kind in ("containment", "isobaric"):
+        print(f"Found {sum(leak[0] == kind for leak in leaks)} {kind} "
+              + "pairs.", file=sys.stderr)
+    write_report(table, leaks, args.report_filename)
+
+    if args.exclude_filename is not None:
+        removals = resolve_leakage(table, leaks, args.seed)
+        write_exclusions(removals, args.exclude_filename)
+        print(f"Wrote {len(removals)} exclusions to "
+              + f"{args.exclude_filename}.", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+
+def test_canonicalize():
+
+    translation = get_translation(False)
+    assert(canonicalize("LINQK", translation) == "LLGGAGK")
+    assert(canonicalize("LINQK", get_translation(True)) == "LLGGAGAG")
+    assert(collision_key(canonicalize("PEPQK", translation))
+           == collision_key(canonicalize("PEPGAK", translation))
+           == collision_key(canonicalize("PEPAGK", translation)))
+    assert(collision_key(canonicalize("PENK", translation))
+           == collision_key(canonicalize("PEGGK", translation)))
+    assert(collision_key("PEAGK") != collision_key("PEAGGK"))
+
+def test_find_containment():
+
+    # Same pairs as comparing every pair of random sequences.
+    rng = np.random.default_rng(1)
+    sequences = list(dict.fromkeys(
+        "".join(rng.choice(list("AGL"), rng.integers(1, 12)))
+        for _ in range(300)
+    ))
+    inner, outer = find_containment(sequences, 3)
+    expected = sorted((i, j) for i, inner_sequence in enumerate(sequences)
+                      for j, outer_sequence in enumerate(sequences)
+                      if (i != j) and (len(inner_sequence) >= 3)
+                      and (inner_sequence in outer_sequence))
+    assert(list(zip(inner.tolist(), outer.tolist())) == expected)
+    assert(len(find_containment([])[0]) == 0)
+
+    # Single characters, in a text shorter than their character codes.
+    inner, outer = find_containment(["PEPK", "PEPKR", "K"], 1)
+    assert(list(zip(inner.tolist(), outer.tolist()))
+           == [(0, 1), (2, 0), (2, 1)])
+
+def test_detect_leakage():
+
+    # Yeast PEPTLDEK is inside a human peptide, mouse LLGGAYK is isobaric
+    # with yeast LINAYK, and SAMPLER is shared as is.
+    root = tempfile.mkdtemp()
+    for species, seqs in (("yeast", ["PEPTLDEK", "L[43.0058]INAYK"]),
+                          ("human", ["AAPEPTIDEKR", "SAMPLER"]),
+                          ("mouse", ["LLGGAYK", "SAMPLER"])):
+        os.makedirs(os.path.join(root, species))
+        with open(os.path.join(root, species, "0.mgf"), "w") as mgf_file:
+            for seq in seqs:
+                mgf_file.write(f"BEGIN IONS\nSEQ={seq}\n100 1\nEND IONS\n")
+
+    table = read_peptides(list_species_files(root), workers=2)
+    leaks = [(kind, table.peptides[peptide_id], table.peptides[other_id])
+             for kind, peptide_id, other_id in find_leakage(table)]
+    assert(sorted(leaks) == [("containment", "PEPTLDEK", "AAPEPTLDEKR"),
+                             ("isobaric", "LLGGAYK", "LLNAYK")])
+
+    # Each group is kept in one species; SAMPLER is left to clean-benchmark.
+    removals = resolve_leakage(table, find_leakage(table))
+    assert(len(removals) == 2)
+    assert({peptide for peptide, _ in removals} < {
+        "PEPTLDEK", "AAPEPTLDEKR", "LLNAYK", "LLGGAYK"
+    })
+    assert(resolve_leakage(table, find_leakage(table), 7718) == removals)
@@ -2,20 +2,35 @@
 # AUTHOR: William Stafford Noble
 # CREATE DATE: 30 Aug 2022
 import sys
+import argparse
+import concurrent.futures
 import datetime
+import instrument
 import os
 import ppx
+import queue
 import subprocess
+import threading
 
-USAGE = """USAGE: construct-benchmark.py <listing> <output dir>
+USAGE = """USAGE: construct-benchmark.py [options] <listing> <output dir>
 
 Download the raw files associated with the DeepNovo benchmark dataset
 from Tran et al., PNAS, 2017.  The input listing is a two-column text
 file containing PRIDE IDs and species names.  The raw files are
 downloaded into the specified output directory in subdirectories named
 by species.
+
+Each raw file is converted to MGF and then deleted.  Downloads run in a
+pool of threads and conversions in a pool of processes, so that network
+transfers and conversions overlap.  At most --max_pending raw files are
+being downloaded, waiting for conversion or being converted at any time,
+which limits the disk space held by unconverted raw files.
 """
 
+# How to convert a raw file to MGF.
+CONVERT_COMMAND = "mono {thermorfp} --output_file={mgf} --logging=0 " \
+    + "--format=0 --input={raw}"
+
 # The location of the Thermo RAW file parser.
 THERMORFP = "/Users/wnoble/opt/miniconda3/bin/thermorawfileparser"
 if not os.path.exists(THERMORFP):
@@ -43,6 +58,141 @@ def run_command(command, outputFileName):
         sys.stderr.write("Execution failed: %s\n" % e)
         sys.exit(1)
 
+def convert_raw_file(command_template, raw_filename, mgf_filename):
+    """Convert a raw file to MGF and delete the raw file.  Returns True if
+    the MGF was created."""
+
+    command = command_template.format(thermorfp=THERMORFP, mgf=mgf_filename,
+                                      raw=raw_filename)
+    run_command(command, mgf_filename)
+    if os.path.exists(mgf_filename):
+        os.remove(raw_filename)
+        return True
+    print(f"Failed to convert {raw_filename}.", file=sys.stderr)
+    return False
+
+def list_raw_files(prides, output_dir, find_project):
+    """Find the raw files of each project.  Returns a list of (project,
+    raw file, local raw file, MGF file) tuples for the raw files that have
+    not yet been converted."""
+
+    jobs = []
+    for species in prides.keys():
+        print(f"Listing {species} from {prides[species]}.", file=sys.stderr)
+        local_dir = os.path.join(output_dir, species)
+        os.makedirs(local_dir, exist_ok=True)
+
+        # Locate this project on PRIDE.
+        proj = find_project(prides[species], local=local_dir)
+        try:
+            raw_files = proj.remote_files("*.raw")
+        except:
+            sys.stderr.write(f"Error accessing {prides[species]}.\n")
+            continue
+        print(f"Found {len(raw_files)} files in {prides[species]}.",
+              file=sys.stderr)
+
+        for raw_file in raw_files:
+            local_raw_file = os.path.join(local_dir, raw_file)
+            mgf_file = os.path.join(local_dir, raw_file[:-3] + "mgf")
+            if os.path.exists(mgf_file):
+                print(f"Skipping {raw_file}.", file=sys.stderr)
+                continue
+            jobs.append((proj, raw_file, local_raw_file, mgf_file))
+    return jobs
+
+def run_pipeline(jobs, download_workers=4, convert_workers=2, max_pending=4,
+                 command_template=CONVERT_COMMAND):
+    """Download and convert the raw files (see list_raw_files).  At most
+    max_pending raw files are being downloaded, waiting for conversion or
+    being converted at any time (so conversions also run at most
+    max_pending at a time).  Returns the number of files downloaded,
+    converted and failed."""
+
+    counts = {"downloaded": 0, "converted": 0, "failed": 0}
+    lock = threading.Lock()
+    downloads = instrument.Progress(len(jobs), "download", "files")
+    conversions = instrument.Progress(len(jobs), "convert", "files")
+
+    def count(stage, *progresses):
+        "Count a job that finished a stage, from any thread."
+        with lock:
+            counts[stage] += 1
+            for progress in progresses:
+                progress.update()
+
+    # A download takes a slot, which is given back when the raw file has
+    # been converted (and deleted), or has failed.
+    slots = threading.Semaphore(max_pending)
+    downloaded = queue.Queue()
+    finished = object() # Put on the queue after the last download.
+
+    def download(job):
+        "Download one raw file (unless present) and queue it."
+        proj, raw_file, local_raw_file, mgf_file = job
+        slots.acquire()
+        if not os.path.exists(local_raw_file):
+            sys.stderr.write(f"Downloading {raw_file}.\n")
+            try:
+                proj.download(raw_file)
+            except:
+                sys.stderr.write(f"Can't download {raw_file}.\n")
+                count("failed", downloads, conversions)
+                slots.release()
+                return
+        count("downloaded", downloads)
+        downloaded.put(job)
+
+    with concurrent.futures.ThreadPoolExecutor(download_workers) \
+         as downloader, \
+         concurrent.futures.ProcessPoolExecutor(convert_workers) \
+         as converter:
+        download_futures = [downloader.submit(download, job) for job in jobs]
+        threading.Thread(
+            target=lambda: (concurrent.futures.wait(download_futures),
+                            downloaded.put(finished)),
+            daemon=True
+        ).start()
+
+        # Only take files off the queue when a converter is free.  Give
+        # back the slot of every file, even if its conversion fails (e.g.,
+        # if the process pool breaks), so that no download waits forever.
+        converting = set()
+        downloads_done = False
+        while True:
+            while (not downloads_done) and (len(converting) < convert_workers):
+                job = downloaded.get()
+                if job is finished:
+                    downloads_done = True
+                    break
+                proj, raw_file, local_raw_file, mgf_file = job
+                try:
+                    converting.add(converter.submit(
+                        convert_raw_file, command_template, local_raw_file,
+                        mgf_file
+                    ))
+                except Exception as error:
+                    print(f"Cannot convert {local_raw_file}: {error}",
+                          file=sys.stderr)
+                    count("failed", conversions)
+                    slots.release()
+            if len(converting) == 0:
+                if downloads_done:
+                    break
+                continue
+            done, converting = concurrent.futures.wait(
+                converting, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                try:
+                    converted = future.result()
+                except Exception as error:
+                    print(f"Conversion failed: {error}", file=sys.stderr)
+                    converted = False
+                count("converted" if converted else "failed", conversions)
+                slots.release()
+    return counts
+
 ###########################################################################
 # MAIN
 ###########################################################################
@@ -50,11 +200,26 @@ def main():
     global USAGE
 
     # Parse the command line.
-    if (len(sys.argv) != 3):
-        sys.stderr.write(USAGE)
-        sys.exit(1)
-    listing_filename = sys.argv[1]
-    output_dir = sys.argv[2]
+    parser = argparse.ArgumentParser(
+        description=USAGE, usage=argparse.SUPPRESS,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('listing', type=str,
+                        help="File of PRIDE IDs and species names")
+    parser.add_argument('output_dir', type=str, help="Output directory")
+    parser.add_argument('--download_workers', type=int, default=4,
+                        help="Number of concurrent downloads (default=4)")
+    parser.add_argument('--convert_workers', type=int, default=2,
+                        help="Number of concurrent conversions (default=2)")
+    parser.add_argument('--max_pending', type=int, default=4,
+                        help="Maximum number of raw files being "
+                        + "downloaded or waiting for or in conversion "
+                        + "(default=4)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+    listing_filename = args.listing
+    output_dir = args.output_dir
 
     # Read the PRIDE IDs.
     prides = {} # Key = species, value = PRIDE identifier
@@ -72,53 +237,81 @@ def main():
         readme.write("https://github.com/Noble-Lab/2021_melih_ms-chimera/tree/main/bin\n")
               
 
-    # Download all raw files from each project.
-    for species in prides.keys():
-        print(f"Downloading {species} from {prides[species]}.",
-              file=sys.stderr)
-        local_dir = os.path.join(output_dir, species)
-        os.makedirs(local_dir, exist_ok=True)
+    # Download and convert all raw files from each project.
+    with instrument.stage("list_raw_files"):
+        jobs = list_raw_files(prides, output_dir, ppx.find_project)
+    with instrument.stage("download_and_convert") as my_stage:
+        counts = run_pipeline(jobs, args.download_workers,
+                              args.convert_workers, args.max_pending)
+        my_stage.add(files=counts["converted"],
+                     bytes=sum(os.path.getsize(mgf_file)
+                               for proj, raw_file, local_raw_file, mgf_file
+                               in jobs if os.path.exists(mgf_file)))
+    print(f"Converted {counts['converted']} of {len(jobs)} raw files.",
+          file=sys.stderr)
 
-        # Locate this project on PRIDE.
-        proj = ppx.find_project(prides[species], local=local_dir)
-        try:
-            raw_files = proj.remote_files("*.raw")
-        except:
-            sys.stderr.write(f"Error accessing {prides[species]}.\n")
-            continue
-        print(f"Downloading {len(raw_files)} files from {prides[species]}.",
-              file=sys.stderr)
 
-        # Traverse all the raw files in this project.
-        for raw_file in raw_files:
-            local_raw_file = f"{local_dir}/{raw_file}"
+if __name__ == '__main__':
+    main()
 
-            # Skip download if file already exists.
-            local_raw_file = os.path.join(local_dir, raw_file)
-            mgf_file = os.path.join(local_dir, raw_file[:-3] + "mgf")
-            if ( os.path.exists(mgf_file) or os.path.exists(local_raw_file) ):
-                sys.stderr.write(f"Skipping {raw_file}.\n")
-            else:
-                sys.stderr.write(f"Downloading {raw_file}.")
-                try:
-                    proj.download(raw_file)
-                except:
-                    sys.stderr.write(f"Can't download {raw_file}.\n")
-                    continue
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+import time
 
-            # Convert raw file to mgf
-            if os.path.exists(mgf_file):
-                print(f"Skipping conversion of {raw_file}.", file=sys.stderr)
-            else:
-                command = f"mono {THERMORFP} --output_file={mgf_file} "
-                command += f"--logging=0 --format=0 --input={local_raw_file}"
-                run_command(command, mgf_file)
-                if os.path.exists(mgf_file):
-                    os.remove(local_raw_file)
-                else:
-                    print(f"Failed to convert {local_raw_file}.",
-                          file=sys.stderr)
+class FakeProject:
+    "Stands in for a ppx project, without network access."
 
+    def __init__(self, pride, local):
+        self.pride = pride
+        self.local = local
 
-if __name__ == '__main__':
-    main()
+    def remote_files(self, pattern):
+        if self.pride == "PXD_missing":
+            raise ValueError("No such project.")
+        return [f"{self.pride}_{i}.raw" for i in range(5)] + ["bad.raw"]
+
+    def download(self, raw_file):
+        if raw_file == "bad.raw":
+            raise ConnectionError("Download failed.")
+        time.sleep(0.01)
+        with open(os.path.join(self.local, raw_file), "w") as local_file:
+            local_file.write(raw_file)
+        FakeProject.max_raw_files = max(
+            FakeProject.max_raw_files,
+            sum(name.endswith(".raw") for name in os.listdir(self.local))
+        )
+
+FakeProject.max_raw_files = 0 # Most raw files on disk in one directory.
+
+def test_run_pipeline():
+
+    output_dir = tempfile.mkdtemp()
+    prides = {"yeast": "PXD1", "human": "PXD2", "mouse": "PXD_missing"}
+    os.makedirs(os.path.join(output_dir, "yeast"))
+    with open(os.path.join(output_dir, "yeast", "PXD1_0.mgf"), "w"):
+        pass
+    jobs = list_raw_files(prides, output_dir, FakeProject)
+    assert(len(jobs) == 11)
+
+    # The stub converter copies the raw file, slowly enough that raw files
+    # would pile up without the limit.
+    counts = run_pipeline(jobs, download_workers=3, convert_workers=2,
+                          max_pending=2,
+                          command_template="sleep 0.1; cp {raw} {mgf}")
+    assert(counts == {"downloaded": 9, "converted": 9, "failed": 2})
+    assert(FakeProject.max_raw_files <= 2)
+    assert(sorted(os.listdir(os.path.join(output_dir, "human")))
+           == [f"PXD2_{i}.mgf" for i in range(5)])
+    with open(os.path.join(output_dir, "human", "PXD2_3.mgf")) as mgf_file:
+        assert(mgf_file.read() == "PXD2_3.raw")
+
+    # Conversions that raise are failures, and do not stall the downloads.
+    for mgf_filename in os.listdir(os.path.join(output_dir, "human")):
+        os.remove(os.path.join(output_dir, "human", mgf_filename))
+    jobs = list_raw_files({"human": "PXD2"}, output_dir, FakeProject)
+    counts = run_pipeline(jobs, download_workers=3, convert_workers=1,
+                          max_pending=1, command_template="cp {missing}")
+    assert(counts == {"downloaded": 5, "converted": 0, "failed": 6})
@@ -4,20 +4,125 @@
 import sys
 import argparse
 import random
-import pyteomics.mgf
+import re
+import instrument
+import manifest
+import mgf_io
 import os
-import glob
 import shutil
 
 DESCRIPTION = """Select from a collection of sets of MGF files so that
 each set has approximately the same number of spectra. This is done by
 randomly permuting the order of MGFs within each set and then
 accepting files in order until at least a specified number of spectra
-is obtained."""
+is obtained.
+
+With --by_spectrum, individual spectra are sampled instead, so that each
+set has exactly the specified number of spectra (or all of its spectra,
+if it has fewer).  Each MGF is read once, and a uniform sample of spectra
+is kept by reservoir sampling.  The sample may be stratified by
+precursor charge and/or peptide length, in which case each stratum
+receives a share of the sample proportional to its size.  Selected
+spectra are copied verbatim, into files with the same names as the
+files they come from, or, with --manifest, listed in a manifest (see
+manifest.py) in the output directory."""
+
+# Peptide lengths are grouped into bins of this width for stratification.
+LENGTH_BIN_WIDTH = 5
 
 def count_spectra(mgf_filename):
     """Count the number of spectra in an MGF file."""
-    return(len(pyteomics.mgf.read(mgf_filename)))
+    return(mgf_io.count_spectra(mgf_filename))
+
+def get_stratum(mgf_map, start, end, stratify):
+    """Return the stratum of the spectrum in bytes [start, end) of a mapped
+    MGF, as a tuple of the requested properties ("charge", "length")."""
+
+    stratum = []
+    for field in stratify:
+        key = b"\nCHARGE=" if field == "charge" else b"\nSEQ="
+        value_start = mgf_map.find(key, start, end)
+        if value_start == -1:
+            stratum.append(None)
+            continue
+        value_start += len(key)
+        value_end = mgf_map.find(b"\n", value_start, end)
+        value = mgf_map[value_start:value_end].strip().decode()
+        if field == "charge":
+            stratum.append(value)
+        else:
+            length = len(re.sub(r"[^A-Z]", "", value))
+            stratum.append(length // LENGTH_BIN_WIDTH)
+    return tuple(stratum)
+
+def allocate(stratum_sizes, num_spectra):
+    """Divide num_spectra among strata in proportion to their sizes, using
+    the largest remainder method.  Returns a dictionary from stratum to
+    number of spectra."""
+
+    total = sum(stratum_sizes.values())
+    if total <= num_spectra:
+        return dict(stratum_sizes)
+    shares = {stratum: size * num_spectra / total
+              for stratum, size in stratum_sizes.items()}
+    quotas = {stratum: int(share) for stratum, share in shares.items()}
+    by_remainder = sorted(shares, key=lambda stratum:
+                          (quotas[stratum] - shares[stratum], str(stratum)))
+    for stratum in by_remainder[:num_spectra - sum(quotas.values())]:
+        quotas[stratum] += 1
+    return quotas
+
+def sample_spectra(mgf_filenames, num_spectra, stratify=(), rng=random):
+    """Select a uniform random sample of num_spectra spectra (stratified by
+    the given properties) from a list of MGF files, reading each file
+    once.  Returns a list, parallel to mgf_filenames, of sorted lists of
+    (start, end) byte ranges."""
+
+    # Keep one reservoir of up to num_spectra spectra per stratum.
+    reservoirs = {} # Key = stratum, value = list of (file index, start, end)
+    num_seen = {} # Key = stratum, value = number of spectra seen
+    for file_index, mgf_filename in enumerate(mgf_filenames):
+        for offset, chunk in mgf_io.iter_chunks(mgf_filename):
+            offsets = mgf_io.find_spectra(chunk).tolist()
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                stratum = (get_stratum(chunk, start, end, stratify)
+                           if stratify else ())
+                start += offset
+                end += offset
+                seen = num_seen.get(stratum, 0)
+                num_seen[stratum] = seen + 1
+                if seen < num_spectra:
+                    reservoirs.setdefault(stratum, []).append(
+                        (file_index, start, end)
+                    )
+                else:
+                    replace = rng.randrange(seen + 1)
+                    if replace < num_spectra:
+                        reservoirs[stratum][replace] = (file_index, start, end)
+
+    # Each reservoir is a uniform sample of its stratum, and so is a random
+    # subset of it.
+    sample = [[] for mgf_filename in mgf_filenames]
+    for stratum, quota in allocate(num_seen, num_spectra).items():
+        for file_index, start, end in rng.sample(reservoirs[stratum], quota):
+            sample[file_index].append((start, end))
+    return [sorted(ranges) for ranges in sample]
+
+def write_sample(mgf_filenames, sample, out_dir):
+    """Copy the selected byte ranges of each MGF to a file of the same name
+    in out_dir.  Returns the number of spectra written."""
+
+    num_written = 0
+    for mgf_filename, ranges in zip(mgf_filenames, sample):
+        if len(ranges) == 0:
+            continue
+        with mgf_io.open_output(os.path.join(out_dir,
+                                             os.path.basename(mgf_filename)),
+                                "wb") as new_mgf:
+            for block in mgf_io.iter_ranges(mgf_filename, ranges):
+                new_mgf.write(block)
+        num_written += len(ranges)
+    return num_written
 
 ###########################################################################
 # MAIN
@@ -34,10 +139,26 @@ def main():
                         help="Random number seed")
     parser.add_argument('--root', type=str, required=True, 
                         help="Output directory name")
+    parser.add_argument('--by_spectrum', action=argparse.BooleanOptionalAction,
+                        help="Sample exactly --num_spectra spectra per set, "
+                        + "instead of whole MGF files")
+    parser.add_argument('--stratify', nargs='*', default=[],
+                        choices=["charge", "length"],
+                        help="With --by_spectrum, stratify the sample by "
+                        + "precursor charge and/or peptide length")
+    parser.add_argument('--manifest', action=argparse.BooleanOptionalAction,
+                        help="With --by_spectrum, write a manifest of the "
+                        + "selected spectra instead of copying them")
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.setup(args)
+
+    if args.manifest and not args.by_spectrum:
+        parser.error("--manifest requires --by_spectrum")
 
     random.seed(args.seed)
     os.makedirs(args.root, exist_ok=True)
+    manifest_rows = []
 
     for mgf_dir in args.mgf_dirs:
 
@@ -46,24 +167,112 @@ def main():
         if os.path.isfile(out_dir):
             print(f"Skipping {mgf_dir}.", file=sys.stderr)
             continue
-        os.makedirs(out_dir, exist_ok=True)
-        mgf_filenames = glob.glob(os.path.join(mgf_dir, "*.mgf"))
-        random.shuffle(mgf_filenames)
-        total_spectra = 0
-        for mgf_filename in mgf_filenames:
-            new_filename = os.path.join(args.root,
-                                        os.path.basename(mgf_dir),
-                                        os.path.basename(mgf_filename))
-            shutil.copy(mgf_filename, new_filename)
-            num_spectra = count_spectra(mgf_filename)
-            print(f"Read {num_spectra} from {mgf_filename}.")
-            total_spectra += num_spectra
-            if (total_spectra > args.num_spectra):
-                print(f"Limit reached ({total_spectra} > {args.num_spectra})"
-                      + f" for {mgf_dir}.",
+        with instrument.stage("downsample",
+                              species=os.path.basename(mgf_dir)) \
+             as my_stage:
+            os.makedirs(out_dir, exist_ok=True)
+            mgf_filenames = mgf_io.glob_mgfs(mgf_dir)
+            if args.by_spectrum:
+                mgf_filenames = sorted(mgf_filenames)
+                sample = sample_spectra(mgf_filenames, args.num_spectra,
+                                        args.stratify)
+                if args.manifest:
+                    manifest_rows += [
+                        (os.path.basename(mgf_dir),
+                         os.path.basename(mgf_filename), mgf_filename,
+                         start, end - start, "")
+                        for mgf_filename, ranges in zip(mgf_filenames, sample)
+                        for start, end in ranges
+                    ]
+                    num_written = sum(len(ranges) for ranges in sample)
+                else:
+                    num_written = write_sample(mgf_filenames, sample,
+                                               out_dir)
+                print(f"Selected {num_written} spectra from {mgf_dir}.",
                       file=sys.stderr)
-                break
+                my_stage.add(spectra=num_written,
+                             bytes=sum(os.path.getsize(mgf_filename)
+                                       for mgf_filename in mgf_filenames))
+                continue
+
+            random.shuffle(mgf_filenames)
+            total_spectra = 0
+            for mgf_filename in mgf_filenames:
+                new_filename = os.path.join(args.root,
+                                            os.path.basename(mgf_dir),
+                                            os.path.basename(mgf_filename))
+                shutil.copy(mgf_filename, new_filename)
+                num_spectra = count_spectra(mgf_filename)
+                print(f"Read {num_spectra} from {mgf_filename}.")
+                total_spectra += num_spectra
+                my_stage.add(spectra=num_spectra,
+                             bytes=os.path.getsize(mgf_filename))
+                if (total_spectra > args.num_spectra):
+                    print(f"Limit reached ({total_spectra} > "
+                          + f"{args.num_spectra}) for {mgf_dir}.",
+                          file=sys.stderr)
+                    break
+
+    if args.manifest:
+        manifest.write_manifest(
+            os.path.join(args.root, manifest.MANIFEST_FILENAME), manifest_rows
+        )
 
 if __name__ == "__main__":
     main()
     sys.exit(0)
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+
+def write_mgfs(mgf_dir, num_files, num_per_file):
+    "Write MGFs whose spectra alternate between charges 2 and 3."
+    mgf_filenames = []
+    for file_index in range(num_files):
+        mgf_filename = os.path.join(mgf_dir, f"{file_index}.mgf")
+        with open(mgf_filename, "w") as mgf_file:
+            for index in range(num_per_file):
+                mgf_file.write(f"BEGIN IONS\nTITLE={file_index}.{index}\n"
+                               + f"CHARGE={2 + index % 2}+\n"
+                               + f"SEQ=PEPT{'I' * (index % 7)}DEK\n"
+                               + "100.0 1.0\nEND IONS\n\n")
+        mgf_filenames.append(mgf_filename)
+    return mgf_filenames
+
+def test_allocate():
+    assert(allocate({"a": 30, "b": 10}, 20) == {"a": 15, "b": 5})
+    assert(sum(allocate({"a": 1, "b": 1, "c": 1}, 2).values()) == 2)
+    assert(allocate({"a": 3, "b": 1}, 20) == {"a": 3, "b": 1})
+
+def test_sample_spectra():
+    mgf_dir = tempfile.mkdtemp()
+    mgf_filenames = write_mgfs(mgf_dir, 5, 40)
+
+    # The target is hit exactly, and the copies are verbatim.
+    rng = random.Random(7718)
+    for stratify in ([], ["charge"], ["charge", "length"]):
+        sample = sample_spectra(mgf_filenames, 51, stratify, rng)
+        assert(sum(len(ranges) for ranges in sample) == 51)
+    out_dir = tempfile.mkdtemp()
+    assert(write_sample(mgf_filenames, sample, out_dir) == 51)
+    spectra = [spectrum for mgf_filename in os.listdir(out_dir)
+               for spectrum in mgf_io.read(os.path.join(out_dir, mgf_filename),
+                                           peaks=False)]
+    assert(len(spectra) == 51)
+    assert(len({spectrum['params']['title'] for spectrum in spectra}) == 51)
+
+    # Stratification preserves the proportion of each charge.
+    sample = sample_spectra(mgf_filenames, 20, ["charge"], rng)
+    charges = []
+    for mgf_filename, ranges in zip(mgf_filenames, sample):
+        with mgf_io.open_mgf(mgf_filename) as mgf_map:
+            charges += [get_stratum(mgf_map, start, end, ["charge"])
+                        for start, end in ranges]
+    assert(charges.count(("2+",)) == charges.count(("3+",)) == 10)
+
+    # Small sets are copied in full.
+    sample = sample_spectra(mgf_filenames, 1000, [], rng)
+    assert(sum(len(ranges) for ranges in sample) == 200)
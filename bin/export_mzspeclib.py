@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# CREATE DATE: 18 Oct 2026
+import sys
+import argparse
+import collections
+import multiprocessing
+import os
+import numpy as np
+import pyteomics.mass
+import instrument
+import mgf_index
+import mgf_io
+import peptides
+import spectrum_store
+
+DESCRIPTION = """Convert the annotated (cleaned) MGFs of one species into
+a spectral library in mzSpecLib text format, in the same form as the
+mgf2mzSpecLib tool in bin/mgf_annotate.
+
+Each peak is annotated with the b- or y-ion, with or without the loss
+of water or ammonia, at a charge up to one less than the precursor
+charge (or up to 2 for doubly charged precursors) whose theoretical m/z
+is closest to it within the fragment tolerance.  As in mgf2mzSpecLib,
+peaks within 1 Da of the precursor are not annotated, nor are peaks
+below 1% of the most intense peak.  All fragments of a spectrum are
+matched at once with NumPy.
+
+The inputs may be MGFs, directories of MGFs or spectrum stores.  They
+are split into chunks of spectra that are annotated by a pool of worker
+processes, and the output is written in order as the chunks finish,
+with a bounded number of chunks in memory at a time."""
+
+# Parameters of the annotation, as in MGFUtils.java.
+FRAGMENT_TOLERANCE = 0.05 # Da
+PRECURSOR_TOLERANCE = 1.0 # Da
+INTENSITY_CUTOFF = 0.01 # Fraction of the most intense peak
+ION_TYPES = "by"
+
+PROTON_MASS = pyteomics.mass.nist_mass["H+"][0][0]
+WATER_MASS = pyteomics.mass.calculate_mass(formula="H2O")
+AMMONIA_MASS = pyteomics.mass.calculate_mass(formula="NH3")
+NEUTRAL_LOSSES = {"": 0.0, "-H2O": WATER_MASS, "-NH3": AMMONIA_MASS}
+
+AA_MASS = np.zeros(128) # Indexed by ASCII code.
+for aa, aa_mass in pyteomics.mass.std_aa_mass.items():
+    AA_MASS[ord(aa)] = aa_mass
+
+# Number of chunks submitted to the pool, per worker, before the first
+# one is written.
+CHUNKS_PER_WORKER = 2
+
+def get_masses(parsed):
+    """Return the (modified) residue masses of a parsed peptide, plus the
+    mass of its N-terminal modifications."""
+
+    masses = AA_MASS[[ord(residue) for residue in parsed.residues]]
+    nterm_mass = 0.0
+    for position, mod in zip(parsed.positions, parsed.mods):
+        if position == -1:
+            nterm_mass += mod.mass
+        else:
+            masses[position] += mod.mass
+    return masses, nterm_mass
+
+def get_fragment_charges(precursor_charge):
+    "List the fragment charges considered for a precursor charge."
+    if precursor_charge <= 1:
+        return [precursor_charge]
+    return list(range(1, max(2, precursor_charge - 1) + 1))
+
+def get_fragments(masses, nterm_mass, charges):
+    """Compute the m/z of every b- and y-ion, with and without each
+    neutral loss, at each charge.  Returns the m/z values, plus arrays
+    giving the ion type (index into ION_TYPES), ion number, neutral loss
+    (index into NEUTRAL_LOSSES) and charge of each."""
+
+    prefix_masses = np.cumsum(masses)[:-1]
+    numbers = np.arange(1, len(masses))
+    ladders = [prefix_masses + nterm_mass,
+               masses.sum() - prefix_masses[::-1] + WATER_MASS]
+    neutral_masses = np.stack(ladders)[:, np.newaxis, :] \
+        - np.array(list(NEUTRAL_LOSSES.values()))[np.newaxis, :, np.newaxis]
+    charges = np.array(charges)
+    shape = (len(charges),) + neutral_masses.shape
+    fragment_mz = (neutral_masses[np.newaxis] + (charges * PROTON_MASS)
+                   .reshape(-1, 1, 1, 1)) / charges.reshape(-1, 1, 1, 1)
+
+    grid = np.indices(shape)
+    return (fragment_mz.ravel(), grid[1].ravel(), numbers[grid[3].ravel()],
+            grid[2].ravel(), charges[grid[0].ravel()])
+
+def annotate_peaks(mz, intensity, precursor_mz, fragments):
+    """Match fragments to peaks.  Each fragment is matched to the closest
+    peak within the tolerance, and each peak takes the closest of the
+    fragments matched to it.  Returns a list with, for each peak, None or
+    a pair (index into the fragment arrays, m/z error)."""
+
+    fragment_mz = fragments[0]
+    annotations = [None] * len(mz)
+    candidates = np.flatnonzero(np.abs(mz - precursor_mz)
+                                > PRECURSOR_TOLERANCE)
+    if (len(candidates) == 0) or (len(fragment_mz) == 0):
+        return annotations
+    order = candidates[np.argsort(mz[candidates], kind="stable")]
+    sorted_mz = mz[order]
+
+    # The closest peak to each fragment.
+    right = np.minimum(np.searchsorted(sorted_mz, fragment_mz),
+                       len(sorted_mz) - 1)
+    left = np.maximum(right - 1, 0)
+    closest = np.where(np.abs(sorted_mz[left] - fragment_mz)
+                       <= np.abs(sorted_mz[right] - fragment_mz),
+                       left, right)
+    errors = sorted_mz[closest] - fragment_mz
+    peaks = order[closest]
+    cutoff = INTENSITY_CUTOFF * intensity[candidates].max()
+    matched = np.flatnonzero((np.abs(errors) <= FRAGMENT_TOLERANCE)
+                             & (intensity[peaks] >= cutoff))
+
+    # The closest fragment to each peak.
+    matched = matched[np.lexsort((np.abs(errors[matched]),
+                                  peaks[matched]))]
+    first = np.ones(len(matched), dtype=bool)
+    first[1:] = peaks[matched][1:] != peaks[matched][:-1]
+    for fragment_index in matched[first].tolist():
+        annotations[peaks[fragment_index]] = (fragment_index,
+                                              errors[fragment_index])
+    return annotations
+
+def format_annotation(fragments, fragment_index, error):
+    "Write a peak annotation such as b3-H2O^2/0.0012."
+    _, ion_types, numbers, losses, charges = fragments
+    charge = charges[fragment_index]
+    return (f"{ION_TYPES[ion_types[fragment_index]]}"
+            + f"{numbers[fragment_index]}"
+            + f"{list(NEUTRAL_LOSSES)[losses[fragment_index]]}"
+            + (f"^{charge}" if charge > 1 else "") + f"/{error:.4f}")
+
+def format_modified_peptide(parsed):
+    """Write a parsed peptide with the masses of its modifications in
+    brackets, as in mgf2mzSpecLib (e.g., [43.0060]PEPM[15.9949]K)."""
+
+    mod_masses = collections.defaultdict(float) # Key = position
+    for position, mod in zip(parsed.positions, parsed.mods):
+        mod_masses[position] += mod.mass
+    residues = list(parsed.residues)
+    for position, mass in mod_masses.items():
+        if position == -1:
+            residues[0] = f"[{mass:.4f}]" + residues[0]
+        else:
+            residues[position] += f"[{mass:.4f}]"
+    return "".join(residues)
+
+def format_spectrum(spectrum, spectrum_number):
+    "Annotate one spectrum and write it as an mzSpecLib entry."
+
+    params = spectrum['params']
+    mz = np.asarray(spectrum['m/z array'], dtype=np.float64)
+    intensity = np.asarray(spectrum['intensity array'], dtype=np.float64)
+    precursor_mz = params['pepmass'][0]
+    precursor_charge = params['charge'][0]
+    parsed = peptides.parse(params['seq'])
+    masses, nterm_mass = get_masses(parsed)
+    fragments = get_fragments(masses, nterm_mass,
+                              get_fragment_charges(precursor_charge))
+    annotations = annotate_peaks(mz, intensity, precursor_mz, fragments)
+    num_matched = sum(annotation is not None for annotation in annotations)
+
+    lines = [f"<Spectrum={spectrum_number}>",
+             f"MS:1003061|library spectrum name={params.get('title', '')}",
+             "MS:1003208|experimental precursor monoisotopic m/z="
+             + f"{precursor_mz}"]
+    if "rtinseconds" in params:
+        lines.append("MS:1000894|retention time="
+                     + f"{params['rtinseconds'] / 60:.4f}")
+    lines += [f"MS:1003059|number of peaks={len(mz)}",
+              "<Analyte=1>",
+              f"MS:1000888|stripped peptide sequence={parsed.residues}",
+              "[1]MS:1003275|other attribute name=SEQ",
+              f"[1]MS:1003276|other attribute value={params['seq']}",
+              "[2]MS:1003275|other attribute name=Modified Peptide",
+              "[2]MS:1003276|other attribute value="
+              + format_modified_peptide(parsed),
+              f"MS:1000041|charge state={precursor_charge}",
+              "<Interpretation=1>",
+              f"MS:1001121|number of matched peaks={num_matched}",
+              f"MS:1001362|number of unmatched peaks={len(mz) - num_matched}",
+              "<Peaks>"]
+    for peak_mz, peak_intensity, annotation in zip(mz.tolist(),
+                                                   intensity.tolist(),
+                                                   annotations):
+        if annotation is None:
+            lines.append(f"{peak_mz} {peak_intensity} ?")
+        else:
+            lines.append(f"{peak_mz} {peak_intensity} "
+                         + format_annotation(fragments, *annotation))
+    return "\n".join(lines) + "\n\n"
+
+def list_inputs(input_paths):
+    """Expand directories of MGFs into their MGF files, in a fixed order.
+    Spectrum stores and MGF files are kept as they are."""
+
+    inputs = []
+    for path in input_paths:
+        if os.path.isdir(path) and not spectrum_store.is_store(path):
+            inputs += sorted(f.path for f in os.scandir(path)
+                             if f.is_file() and mgf_io.is_mgf(f.name))
+        else:
+            inputs.append(path)
+    return inputs
+
+def make_chunks(mgf_filenames, chunk_size):
+    """Split MGFs (or spectrum stores) into chunks of at most chunk_size
+    spectra.  Each chunk is a tuple (MGF name, start, end, number of its
+    first spectrum in the library), where start and end are byte offsets
+    in an MGF or spectrum indices in a store.  Compressed MGFs are split
+    using their sidecar indexes, and must be compressed in blocks (see
+    mgf_index.find_chunk_offsets)."""
+
+    chunks = []
+    spectrum_number = 1
+    for mgf_filename in mgf_filenames:
+        if spectrum_store.is_store(mgf_filename):
+            offsets = list(range(spectrum_store.count_spectra(
+                spectrum_store.open_store(mgf_filename)
+            ) + 1))
+        else:
+            offsets = mgf_index.find_chunk_offsets(mgf_filename).tolist()
+        for first in range(0, len(offsets) - 1, chunk_size):
+            last = min(first + chunk_size, len(offsets) - 1)
+            chunks.append((mgf_filename, offsets[first], offsets[last],
+                           spectrum_number))
+            spectrum_number += last - first
+    return chunks
+
+def format_chunk(chunk):
+    """Annotate the spectra of one chunk.  Returns the text of their
+    entries and the number of spectra.  Only the blocks of a compressed
+    MGF that hold the chunk are decompressed."""
+
+    mgf_filename, start, end, spectrum_number = chunk
+    if spectrum_store.is_store(mgf_filename):
+        spectra = spectrum_store.read(mgf_filename, start, end)
+    else:
+        spectra = mgf_index.read(mgf_filename,
+                                 fields=("title", "pepmass", "charge",
+                                         "rtinseconds", "seq"),
+                                 start=start, end=end)
+    entries = [format_spectrum(spectrum, spectrum_number + index)
+               for index, spectrum in enumerate(spectra)]
+    return "".join(entries), len(entries)
+
+def imap_bounded(pool, function, tasks, window):
+    """Same as pool.imap, but with at most window tasks submitted and not
+    yet consumed, so that finished results do not pile up in memory."""
+
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(function, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+def write_library(input_paths, library_filename, library_name=None,
+                  workers=1, chunk_size=1000):
+    """Write the spectra of the given MGFs (or directories or spectrum
+    stores) to one mzSpecLib file.  The output does not depend on the
+    number of workers.  Returns the number of spectra written."""
+
+    if library_name is None:
+        library_name = os.path.basename(library_filename) \
+            .removesuffix(".txt").removesuffix(".mzlib")
+    os.makedirs(os.path.dirname(os.path.abspath(library_filename)),
+                exist_ok=True)
+    chunks = make_chunks(list_inputs(input_paths), chunk_size)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    results = imap_bounded(pool, format_chunk, chunks,
+                           CHUNKS_PER_WORKER * workers) if pool \
+        else map(format_chunk, chunks)
+
+    num_spectra = 0
+    progress = instrument.Progress(len(chunks), "export_mzspeclib", "chunks")
+    with open(f"{library_filename}.tmp", "w", buffering=1 << 22) \
+         as library_file:
+        library_file.write("<mzSpecLib 1.0>\n"
+                           + f"MS:1003188|library name={library_name}\n")
+        for text, num_chunk_spectra in results:
+            library_file.write(text)
+            num_spectra += num_chunk_spectra
+            progress.update()
+    os.replace(f"{library_filename}.tmp", library_filename)
+    if pool:
+        pool.close()
+        pool.join()
+    return num_spectra
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global DESCRIPTION
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--output', type=str, required=True,
+                        help="Output library (e.g., Species.mzlib.txt)")
+    parser.add_argument('--library_name', type=str, default=None,
+                        help="Library name (default=output file name, "
+                        + "without .mzlib.txt)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes (default=1)")
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help="Spectra per chunk of work (default=1000)")
+    parser.add_argument('inputs', nargs="+",
+                        help="Annotated MGFs, MGF directories or spectrum "
+                        + "stores")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    with instrument.stage("export_mzspeclib") as my_stage:
+        num_spectra = write_library(args.inputs, args.output,
+                                    args.library_name, args.workers,
+                                    args.chunk_size)
+        my_stage.add(spectra=num_spectra,
+                     bytes=os.path.getsize(args.output))
+    print(f"Wrote {num_spectra} spectra to {args.output}.", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+
+def test_get_fragments():
+
+    # b- and y-ions of PEK, at charge 1, without losses.
+    parsed = peptides.parse("PEK")
+    fragment_mz, ion_types, numbers, losses, charges = get_fragments(
+        *get_masses(parsed), get_fragment_charges(1)
+    )
+    assert(len(fragment_mz) == 2 * len(NEUTRAL_LOSSES) * 2)
+    unmodified = (losses == 0)
+    expected = [pyteomics.mass.fast_mass(fragment, ion_type=ion_type,
+                                         charge=1)
+                for fragment, ion_type in (("P", "b"), ("PE", "b"),
+                                           ("K", "y"), ("EK", "y"))]
+    assert(np.allclose(fragment_mz[unmodified], expected))
+    assert(numbers[unmodified].tolist() == [1, 2, 1, 2])
+
+    # Charges as in MGFUtils.java.
+    assert(get_fragment_charges(2) == [1, 2])
+    assert(get_fragment_charges(4) == [1, 2, 3])
+
+    # N-terminal modifications shift the b-ions only.
+    modified = get_fragments(*get_masses(peptides.parse("+42.011PEK")), [1])
+    assert(np.allclose(modified[0] - fragment_mz,
+                       np.where(ion_types == 0, 42.011, 0)))
+
+def test_format_spectrum():
+
+    # A peak near b2, a peak near y1-H2O at charge 1 and the precursor.
+    parsed = peptides.parse("PEM+15.995K")
+    b2 = pyteomics.mass.fast_mass("PE", ion_type="b", charge=1)
+    y1 = pyteomics.mass.fast_mass("K", ion_type="y", charge=1)
+    spectrum = {
+        'params': {'title': "scan=7", 'pepmass': (268.6, None),
+                   'charge': [2], 'rtinseconds': 120.0,
+                   'seq': "PEM+15.995K"},
+        'm/z array': np.array([b2 + 0.01, y1 - WATER_MASS - 0.02, 268.6,
+                               300.0]),
+        'intensity array': np.array([100.0, 50.0, 1000.0, 20.0]),
+    }
+    entry = format_spectrum(spectrum, 3).split("\n")
+    assert(entry[:4] == ["<Spectrum=3>",
+                         "MS:1003061|library spectrum name=scan=7",
+                         "MS:1003208|experimental precursor monoisotopic "
+                         + "m/z=268.6",
+                         "MS:1000894|retention time=2.0000"])
+    assert("[2]MS:1003276|other attribute value=PEM[15.9949]K" in entry)
+    assert("MS:1001121|number of matched peaks=2" in entry)
+    peaks = entry[entry.index("<Peaks>") + 1:]
+    assert(peaks[0].endswith(" 100.0 b2/0.0100"))
+    assert(peaks[1].endswith(" 50.0 y1-H2O/-0.0200"))
+    assert(peaks[2:] == ["268.6 1000.0 ?", "300.0 20.0 ?", "", ""])
+
+annotated_mgf = """BEGIN IONS
+TITLE=scan={scan}
+PEPMASS=401.2
+CHARGE=3+
+RTINSECONDS=60.0
+SEQ=+43.006-17.027PEPTLDEK
+98.06 10
+227.10 20
+END IONS
+"""
+
+def test_write_library():
+
+    # The output is the same for any number of workers and chunk size,
+    # and for a spectrum store or compressed MGFs.
+    mgf_dir = tempfile.mkdtemp()
+    gzip_dir = tempfile.mkdtemp()
+    for file_index in range(2):
+        for mgf_filename in [os.path.join(mgf_dir, f"{file_index}.mgf"),
+                             os.path.join(gzip_dir, f"{file_index}.mgf.gz")]:
+            with mgf_io.open_output(mgf_filename) as mgf_file:
+                mgf_file.write("\n".join(annotated_mgf.format(scan=scan)
+                                         for scan in range(5)))
+    store_dir = os.path.join(tempfile.mkdtemp(), "store")
+    spectrum_store.write_store(list_inputs([mgf_dir]), store_dir,
+                               verify=False)
+    outputs = []
+    for inputs, workers, chunk_size in (([mgf_dir], 1, 1000),
+                                        ([mgf_dir], 3, 2),
+                                        ([store_dir], 2, 3),
+                                        ([gzip_dir], 2, 2)):
+        library_filename = os.path.join(tempfile.mkdtemp(),
+                                        "yeast.mzlib.txt")
+        assert(write_library(inputs, library_filename, workers=workers,
+                             chunk_size=chunk_size) == 10)
+        with open(library_filename) as library_file:
+            outputs.append(library_file.read())
+    assert(outputs[0] == outputs[1] == outputs[2] == outputs[3])
+    assert(outputs[0].startswith("<mzSpecLib 1.0>\n"
+                                 + "MS:1003188|library name=yeast\n"
+                                 + "<Spectrum=1>\n"))
+    assert("<Spectrum=10>" in outputs[0])
+    assert("[2]MS:1003276|other attribute value=[25.9800]PEPTLDEK"
+           in outputs[0])
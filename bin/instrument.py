@@ -0,0 +1,256 @@
+"""Shared instrumentation for the scripts in bin/.
+
+A script calls add_arguments() on its parser and setup() on the parsed
+arguments, and then wraps each stage of its work in a stage() block:
+
+    with instrument.stage("write_mgfs", species=species) as my_stage:
+        ...
+        my_stage.add(spectra=num_spectra, bytes=num_bytes)
+
+With --metrics_out, one JSON object per line is appended to the given
+file for each stage (wall and CPU time, spectra and bytes per second,
+peak RSS), for each cache report and, periodically, for long-running
+progress counters.  A summary line is written when the script exits.
+With --profile, a table of the stages and cache hit rates is also
+printed to stderr.
+
+Live progress with an ETA is shown on stderr by Progress when stderr is
+a terminal or --profile is given.  CPU times and peak RSS include worker
+processes that have finished.  Without setup(), stages are timed but
+nothing is written.
+"""
+import argparse
+import atexit
+import json
+import os
+import resource
+import sys
+import time
+
+# Seconds between updates of the live progress display.
+PROGRESS_INTERVAL = 1.0
+
+# Seconds between progress records in the metrics file.
+METRICS_PROGRESS_INTERVAL = 60.0
+
+class Recorder:
+    "Where metrics go, and the stages recorded so far."
+
+    def __init__(self, script, metrics_filename=None, profile=False):
+        self.script = script
+        self.metrics_filename = metrics_filename
+        self.profile = profile
+        self.stages = []
+        self.caches = []
+        self.start_wall = time.time()
+        self.start_cpu = get_cpu_seconds()
+
+    def emit(self, event, fields):
+        "Append one JSON line to the metrics file, if there is one."
+        if self.metrics_filename is None:
+            return
+        record = {"event": event, "script": self.script, "pid": os.getpid(),
+                  "time": time.time()}
+        record.update(fields)
+        with open(self.metrics_filename, "a") as metrics_file:
+            metrics_file.write(json.dumps(record) + "\n")
+
+def get_cpu_seconds():
+    "Return the CPU time of this process and its finished children."
+    times = os.times()
+    return (times.user + times.system + times.children_user
+            + times.children_system)
+
+def get_peak_rss_mb():
+    """Return the peak resident set size, in MB, of this process and of its
+    largest finished child."""
+    scale = 1 if sys.platform == "darwin" else 1024 # ru_maxrss is in KB
+    return tuple(resource.getrusage(who).ru_maxrss * scale / 1e6
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+RECORDER = Recorder(os.path.basename(sys.argv[0]))
+
+def add_arguments(parser):
+    "Add the --profile and --metrics_out options to an argument parser."
+    parser.add_argument('--profile', action=argparse.BooleanOptionalAction,
+                        help="Print the time, throughput and memory use of "
+                        + "each stage to stderr, and show live progress")
+    parser.add_argument('--metrics_out', '--metrics-out', type=str,
+                        default=None, dest="metrics_out",
+                        help="Append metrics to this file as JSON lines")
+
+def setup(args, script=None):
+    """Start recording, given the parsed --profile and --metrics_out
+    options.  A summary is written when the program exits."""
+    global RECORDER
+
+    RECORDER = Recorder(script or os.path.basename(sys.argv[0]),
+                        args.metrics_out, bool(args.profile))
+    RECORDER.emit("start", {"argv": sys.argv})
+    atexit.register(finish)
+
+class Stage:
+    "A timed part of a script, with counts of the work done."
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.counts = {"spectra": 0, "bytes": 0}
+
+    def add(self, **counts):
+        "Add to the counts (e.g., spectra=..., bytes=...) of this stage."
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def __enter__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = get_cpu_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.start_wall
+        fields = {"stage": self.name, "labels": self.labels,
+                  "wall_seconds": wall,
+                  "cpu_seconds": get_cpu_seconds() - self.start_cpu,
+                  "failed": exc_type is not None}
+        fields.update(self.counts)
+        for key in ("spectra", "bytes"):
+            fields[f"{key}_per_second"] = (self.counts[key] / wall
+                                           if wall > 0 else None)
+        fields["peak_rss_mb"], fields["children_peak_rss_mb"] = \
+            get_peak_rss_mb()
+        RECORDER.stages.append(fields)
+        RECORDER.emit("stage", fields)
+        return False
+
+def stage(name, **labels):
+    """Time a block of code as a stage.  Labels (e.g., species=...) are
+    recorded with it."""
+    return Stage(name, labels)
+
+def record(event, **fields):
+    "Write an event of another kind to the metrics file."
+    RECORDER.emit(event, fields)
+
+def record_cache(name, hits, misses, **labels):
+    "Record the hit rate of a cache."
+    total = hits + misses
+    fields = {"cache": name, "labels": labels, "hits": hits,
+              "misses": misses, "hit_rate": hits / total if total else None}
+    RECORDER.caches.append(fields)
+    RECORDER.emit("cache", fields)
+
+def format_seconds(seconds):
+    "Format a duration as h:mm:ss."
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+class Progress:
+    """Count units of work (e.g., files or chunks) done out of a known
+    total, showing the rate and the estimated time remaining."""
+
+    def __init__(self, total, label, unit="items"):
+        self.total = total
+        self.label = label
+        self.unit = unit
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last_display = 0.0
+        self.last_emit = self.start
+        self.visible = RECORDER.profile or sys.stderr.isatty()
+
+    def update(self, count=1):
+        self.done += count
+        now = time.perf_counter()
+        if self.visible and ( (now - self.last_display >= PROGRESS_INTERVAL)
+                              or (self.done == self.total) ):
+            self.last_display = now
+            self.display(now)
+        if now - self.last_emit >= METRICS_PROGRESS_INTERVAL:
+            self.last_emit = now
+            RECORDER.emit("progress", {"label": self.label,
+                                       "unit": self.unit, "done": self.done,
+                                       "total": self.total,
+                                       "elapsed_seconds": now - self.start})
+
+    def display(self, now):
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        message = f"{self.label}: {self.done}/{self.total} {self.unit}"
+        if 0 < self.done < self.total and rate > 0:
+            message += (f", {rate:.1f}/s, ETA "
+                        + format_seconds((self.total - self.done) / rate))
+        elif self.done >= self.total:
+            message += f" in {format_seconds(elapsed)}"
+        end = "\n" if (self.done >= self.total
+                       or not sys.stderr.isatty()) else ""
+        print(f"\r{message}\033[K" if sys.stderr.isatty() else message,
+              end=end, file=sys.stderr, flush=True)
+
+def finish():
+    "Write the summary of the run, and the profile table if requested."
+    peak_rss, children_peak_rss = get_peak_rss_mb()
+    RECORDER.emit("summary", {
+        "wall_seconds": time.time() - RECORDER.start_wall,
+        "cpu_seconds": get_cpu_seconds() - RECORDER.start_cpu,
+        "peak_rss_mb": peak_rss, "children_peak_rss_mb": children_peak_rss,
+        "num_stages": len(RECORDER.stages)
+    })
+    if not RECORDER.profile:
+        return
+    print(f"{'stage':<32} {'wall(s)':>9} {'cpu(s)':>9} {'spectra/s':>11} "
+          + f"{'MB/s':>8} {'RSS(MB)':>8}", file=sys.stderr)
+    for fields in RECORDER.stages:
+        name = fields["stage"]
+        if fields["labels"]:
+            name += " " + ",".join(f"{value}" for value
+                                   in fields["labels"].values())
+        spectra_rate = fields["spectra_per_second"] or 0
+        byte_rate = (fields["bytes_per_second"] or 0) / 1e6
+        print(f"{name[:32]:<32} {fields['wall_seconds']:>9.2f} "
+              + f"{fields['cpu_seconds']:>9.2f} {spectra_rate:>11.1f} "
+              + f"{byte_rate:>8.1f} {fields['peak_rss_mb']:>8.1f}",
+              file=sys.stderr)
+    for fields in RECORDER.caches:
+        hit_rate = fields["hit_rate"] or 0
+        print(f"{fields['cache']}: {fields['hits']} hits, {fields['misses']} "
+              + f"misses ({hit_rate:.1%}).", file=sys.stderr)
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+
+def test_metrics(monkeypatch):
+
+    # setup replaces the global recorder and registers finish to run at
+    # exit; undo both after the test.
+    monkeypatch.setattr(sys.modules[__name__], "RECORDER", RECORDER)
+    monkeypatch.setattr(atexit, "register", lambda function: function)
+
+    metrics_filename = os.path.join(tempfile.mkdtemp(), "metrics.jsonl")
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args(["--metrics-out", metrics_filename])
+    setup(args, "test")
+
+    with stage("count", species="yeast") as my_stage:
+        my_stage.add(spectra=1000, bytes=10 ** 6)
+        sum(range(10 ** 5))
+    record_cache("fragments", 3, 1)
+    progress = Progress(2, "files", "files")
+    progress.update()
+    progress.update()
+    finish()
+
+    with open(metrics_filename) as metrics_file:
+        records = [json.loads(line) for line in metrics_file]
+    assert([record["event"] for record in records]
+           == ["start", "stage", "cache", "summary"])
+    assert(records[1]["labels"] == {"species": "yeast"})
+    assert(records[1]["spectra"] == 1000)
+    assert(records[1]["spectra_per_second"] > 0)
+    assert(records[1]["peak_rss_mb"] > 0)
+    assert(records[2]["hit_rate"] == 0.75)
+    assert(records[3]["num_stages"] == 1)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# CREATE DATE: 18 Oct 2026
+import argparse
+import os
+import numpy as np
+import pyteomics.mass
+import instrument
+
+DESCRIPTION = """Generate a synthetic multi-species dataset with the same
+structure as the inputs to the benchmark pipeline, for testing and
+timing.  The output directory contains
+
+ o driver.txt, in the format of nine-species.txt,
+ o data/<species>/*.mgf, unannotated MGFs with ThermoRawFileParser-style
+   titles, and
+ o <species>/percolator.log.txt and <species>/percolator.target.psms.txt,
+   in the format produced by Crux.
+
+Peptides carry Tide-style modifications (oxidation, deamidation and
+N-terminal modifications), and a fraction of them are shared between
+species, some only up to isoleucine/leucine.  Each spectrum contains the
+singly charged b and y ions of its peptide plus random noise peaks.  The
+output depends only on the parameters and the seed."""
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+PROTON_MASS = pyteomics.mass.nist_mass["H+"][0][0]
+WATER_MASS = pyteomics.mass.calculate_mass(formula="H2O")
+
+# Tide modifications, with their probabilities.
+RESIDUE_MODS = {"M": ("[15.9949]", 15.9949, 0.3),
+                "N": ("[0.9840]", 0.9840, 0.05),
+                "Q": ("[0.9840]", 0.9840, 0.05)}
+NTERM_MODS = [("[42.0106]", 42.0106), ("[43.0058]", 43.0058),
+              ("[-17.0265]", -17.0265)]
+NTERM_MOD_PROBABILITY = 0.05
+FIXED_MODS = {"C": 57.02146}
+
+def make_peptide(rng, min_length=7, max_length=20):
+    "Generate a random tryptic peptide, without modifications."
+    length = rng.integers(min_length, max_length + 1)
+    residues = rng.choice(list(AMINO_ACIDS), size=length - 1)
+    return "".join(residues) + rng.choice(["K", "R"])
+
+def add_mods(rng, peptide):
+    """Add random Tide-style modifications to a peptide.  Returns the
+    modified peptide and the mass of each residue."""
+
+    residues = []
+    masses = []
+    for residue in peptide:
+        mass = pyteomics.mass.std_aa_mass[residue] + FIXED_MODS.get(residue, 0)
+        if (residue in RESIDUE_MODS) and \
+           (rng.random() < RESIDUE_MODS[residue][2]):
+            residue += RESIDUE_MODS[residue][0]
+            mass += RESIDUE_MODS[peptide[len(residues)]][1]
+        residues.append(residue)
+        masses.append(mass)
+
+    # Tide reports N-terminal modifications after the first residue.
+    if rng.random() < NTERM_MOD_PROBABILITY:
+        mod, delta = NTERM_MODS[rng.integers(len(NTERM_MODS))]
+        if "[" not in residues[0]:
+            residues[0] += mod
+            masses[0] += delta
+    return "".join(residues), np.array(masses)
+
+def make_peptide_pools(rng, species_list, peptides_per_species,
+                       shared_fraction):
+    """Assign peptides to species.  A fraction of each species' peptides
+    come from a shared pool, some of them with isoleucines changed to
+    leucines."""
+
+    num_shared = int(peptides_per_species * shared_fraction)
+    shared = [make_peptide(rng) for index in range(max(num_shared, 1) * 2)]
+    pools = {}
+    for species in species_list:
+        pool = [make_peptide(rng)
+                for index in range(peptides_per_species - num_shared)]
+        for index in rng.choice(len(shared), size=num_shared, replace=False):
+            peptide = shared[index]
+            if rng.random() < 0.2:
+                peptide = peptide.replace("I", "L")
+            pool.append(peptide)
+        pools[species] = pool
+    return pools
+
+def make_spectrum(rng, masses, charge, num_peaks):
+    """Return the precursor m/z and sorted peak arrays of a spectrum of a
+    peptide with the given residue masses."""
+
+    precursor_mz = (masses.sum() + WATER_MASS + charge * PROTON_MASS) / charge
+    prefix = np.cumsum(masses)[:-1]
+    fragments = np.concatenate((prefix + PROTON_MASS,
+                                masses.sum() - prefix + WATER_MASS
+                                + PROTON_MASS))
+    fragments = fragments[rng.random(len(fragments)) < 0.7]
+    num_noise = max(num_peaks - len(fragments), 0)
+    mz = np.concatenate((fragments + rng.normal(0, 0.005, len(fragments)),
+                         rng.uniform(100, precursor_mz * charge, num_noise)))
+    intensity = np.concatenate((rng.uniform(1000, 100000, len(fragments)),
+                                rng.uniform(10, 5000, num_noise)))
+    order = np.argsort(mz)
+    return precursor_mz, mz[order], intensity[order]
+
+def write_species(rng, output_dir, species, file_index_base, pool,
+                  num_spectra, num_files, num_peaks):
+    """Write the MGFs and Percolator files of one species.  Most spectra
+    receive a PSM at q < 0.01."""
+
+    data_dir = os.path.join(output_dir, "data", species)
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(os.path.join(output_dir, species), exist_ok=True)
+    log_lines = []
+    psm_lines = ["PSMId\tscore\tq-value\tposterior_error_prob\tpeptide"
+                 + "\tproteinIds\n"]
+    file_sizes = np.full(num_files, num_spectra // num_files)
+    file_sizes[:num_spectra % num_files] += 1
+    for file_number, file_size in enumerate(file_sizes):
+        file_index = file_index_base + file_number
+        mgf_filename = os.path.join(data_dir, f"{species}-{file_number}.mgf")
+        log_lines.append(f"INFO: Assigning index {file_index} to "
+                         + f"{mgf_filename}.\n")
+        lines = []
+        for scan in range(1, file_size + 1):
+            peptide, masses = add_mods(rng, pool[rng.integers(len(pool))])
+            charge = int(rng.choice([2, 2, 2, 3, 3, 4]))
+            precursor_mz, mz, intensity = make_spectrum(rng, masses, charge,
+                                                        num_peaks)
+            lines.append(
+                f"BEGIN IONS\nTITLE={species}-{file_number}.{scan}.{scan}."
+                + f"{charge} File:\"{species}-{file_number}.raw\", NativeID:"
+                + f"\"controllerType=0 controllerNumber=1 scan={scan}\"\n"
+                + f"RTINSECONDS={scan * 0.5:.4f}\n"
+                + f"PEPMASS={precursor_mz:.6f}\nCHARGE={charge}+\n"
+                + "".join(f"{mz_value:.4f} {intensity_value:.1f}\n"
+                          for mz_value, intensity_value
+                          in zip(mz.tolist(), intensity.tolist()))
+                + "END IONS\n\n"
+            )
+            qvalue = (rng.uniform(0, 0.01) if rng.random() < 0.9
+                      else rng.uniform(0.01, 0.1))
+            psm_lines.append(f"target_{file_index}_{scan}_{charge}_1\t"
+                             + f"{1 - qvalue:.4f}\t{qvalue:.6f}\t0.01\t"
+                             + f"K.{peptide}.A\tprotein\n")
+        with open(mgf_filename, "w") as mgf_file:
+            mgf_file.write("".join(lines))
+
+    with open(os.path.join(output_dir, species, "percolator.log.txt"),
+              "w") as log_file:
+        log_file.write("".join(log_lines))
+    with open(os.path.join(output_dir, species,
+                           "percolator.target.psms.txt"), "w") as psm_file:
+        psm_file.write("".join(psm_lines))
+
+def make_benchmark(output_dir, num_spectra, num_species=3, num_files=4,
+                   num_peaks=100, shared_fraction=0.1, seed=7718):
+    """Generate the synthetic dataset (see DESCRIPTION), with num_spectra
+    spectra in total.  Returns the list of species."""
+
+    rng = np.random.default_rng(seed)
+    species_list = [f"Species-{index}" for index in range(num_species)]
+    peptides_per_species = max(num_spectra // (num_species * 3), 10)
+    pools = make_peptide_pools(rng, species_list, peptides_per_species,
+                               shared_fraction)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "driver.txt"), "w") as driver_file:
+        for index, species in enumerate(species_list):
+            driver_file.write(f"PXD{index:06d}\t{species}\t20\t0.05\n")
+            species_spectra = num_spectra // num_species \
+                + (index < num_spectra % num_species)
+            write_species(rng, output_dir, species, index * num_files,
+                          pools[species], species_spectra, num_files,
+                          num_peaks)
+    return species_list
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global DESCRIPTION
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('output_dir', type=str, help="Output directory")
+    parser.add_argument('--num_spectra', type=int, default=1000,
+                        help="Total number of spectra (default=1000)")
+    parser.add_argument('--num_species', type=int, default=3,
+                        help="Number of species (default=3)")
+    parser.add_argument('--num_files', type=int, default=4,
+                        help="Number of MGFs per species (default=4)")
+    parser.add_argument('--num_peaks', type=int, default=100,
+                        help="Peaks per spectrum (default=100)")
+    parser.add_argument('--shared_fraction', type=float, default=0.1,
+                        help="Fraction of peptides shared between species "
+                        + "(default=0.1)")
+    parser.add_argument('--seed', type=int, default=7718,
+                        help="Random number seed (default=7718)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    with instrument.stage("make_benchmark") as my_stage:
+        make_benchmark(args.output_dir, args.num_spectra, args.num_species,
+                       args.num_files, args.num_peaks, args.shared_fraction,
+                       args.seed)
+        my_stage.add(spectra=args.num_spectra)
+
+if __name__ == "__main__":
+    main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+import filecmp
+import mgf_io
+
+def test_make_benchmark():
+
+    # The output is deterministic.
+    output_dirs = [tempfile.mkdtemp() for index in range(2)]
+    for output_dir in output_dirs:
+        make_benchmark(output_dir, 100, num_species=2, num_files=3,
+                       num_peaks=50, shared_fraction=0.5)
+    comparison = filecmp.dircmp(*output_dirs)
+    assert(comparison.diff_files == [])
+    assert(sorted(comparison.common)
+           == ["Species-0", "Species-1", "data", "driver.txt"])
+
+    # The spectra are readable, and the PSMs refer to them.
+    mgf_dir = os.path.join(output_dirs[0], "data", "Species-1")
+    assert(sum(mgf_io.count_spectra(os.path.join(mgf_dir, mgf_filename))
+               for mgf_filename in os.listdir(mgf_dir)) == 50)
+    spectrum = next(mgf_io.read(os.path.join(mgf_dir, "Species-1-2.mgf")))
+    assert(len(spectrum['m/z array']) >= 50)
+    assert(spectrum['params']['title'].endswith("scan=1\""))
+    with open(os.path.join(output_dirs[0], "Species-1",
+                           "percolator.target.psms.txt")) as psm_file:
+        psms = psm_file.readlines()[1:]
+    assert(len(psms) == 50)
+    assert(psms[0].startswith("target_3_1_"))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# CREATE DATE: 18 Oct 2026
+import sys
+import argparse
+import contextlib
+import os
+import instrument
+import mgf_index
+import mgf_io
+
+DESCRIPTION = """Materialize a virtual benchmark, described by a manifest,
+as a directory of MGF files.
+
+A manifest is a tab-delimited file with one row per spectrum and the
+columns species, mgf, source, offset, length and seq.  The spectrum
+occupies bytes [offset, offset + length) of the source MGF, and belongs
+to file <species>/<mgf> of the virtual benchmark.  If seq is not empty,
+it replaces the value of the SEQ line of the spectrum.  A benchmark
+variant therefore costs one short row per spectrum, instead of a copy
+of its spectra, and can be read directly from the source MGFs."""
+
+COLUMNS = ["species", "mgf", "source", "offset", "length", "seq"]
+MANIFEST_FILENAME = "manifest.tsv"
+
+def is_manifest(path):
+    "Is the given path a manifest (or a directory containing one)?"
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST_FILENAME)
+    if not os.path.isfile(path):
+        return False
+    with open(path, "r") as manifest_file:
+        return manifest_file.readline().rstrip("\n").split("\t") == COLUMNS
+
+def write_manifest(manifest_filename, rows):
+    """Write rows of (species, mgf, source, offset, length, seq) to a
+    manifest.  Source paths are made absolute."""
+
+    with open(manifest_filename, "w") as manifest_file:
+        manifest_file.write("\t".join(COLUMNS) + "\n")
+        for species, mgf, source, offset, length, seq in rows:
+            manifest_file.write(f"{species}\t{mgf}\t{os.path.abspath(source)}"
+                                + f"\t{offset}\t{length}\t{seq}\n")
+
+def read_manifest(manifest_filename, species=None):
+    """Iterate over the rows of a manifest (or of the manifest in a
+    directory), optionally for one species only."""
+
+    if os.path.isdir(manifest_filename):
+        manifest_filename = os.path.join(manifest_filename, MANIFEST_FILENAME)
+    with open(manifest_filename, "r") as manifest_file:
+        if manifest_file.readline().rstrip("\n").split("\t") != COLUMNS:
+            raise ValueError(f"{manifest_filename} is not a manifest.")
+        for line in manifest_file:
+            row = line.rstrip("\n").split("\t")
+            if (species is None) or (row[0] == species):
+                yield (row[0], row[1], row[2], int(row[3]), int(row[4]),
+                       row[5])
+
+def replace_seq(block, seq):
+    "Replace the value of the SEQ line of a raw spectrum block."
+    seq_start = block.find(b"\nSEQ=") + 5
+    if seq_start == 4:
+        raise ValueError("Spectrum has no SEQ line.")
+    seq_end = block.find(b"\n", seq_start)
+    if block[seq_end - 1:seq_end] == b"\r":
+        seq_end -= 1
+    return block[:seq_start] + seq.encode() + block[seq_end:]
+
+def iter_blocks(manifest_filename, species=None):
+    """Iterate over the spectra of a virtual benchmark, reading them from
+    the memory-mapped source MGFs, or through the indexes of compressed
+    ones (see mgf_index.py).  Yields (species, mgf, bytes) tuples."""
+
+    with contextlib.ExitStack() as stack:
+        source_maps = {} # Key = source filename, value = mapped file
+        for row in read_manifest(manifest_filename, species):
+            row_species, mgf, source, offset, length, seq = row
+            if mgf_io.get_compression(source) is not None:
+                block = mgf_index.read_range(source, offset, offset + length)
+            else:
+                if source not in source_maps:
+                    source_maps[source] = stack.enter_context(
+                        mgf_io.open_mgf(source)
+                    )
+                block = source_maps[source][offset:offset + length]
+            if seq != "":
+                block = replace_seq(block, seq)
+            yield row_species, mgf, block
+
+def read(manifest_filename, species=None, fields=None, peaks=True):
+    """Iterate over the parsed spectra of a virtual benchmark (see
+    mgf_io.parse_spectrum)."""
+
+    for row_species, mgf, block in iter_blocks(manifest_filename, species):
+        yield mgf_io.parse_spectrum(block, fields, peaks)
+
+def count_spectra(manifest_filename, species=None):
+    "Count the spectra in a virtual benchmark without reading them."
+    return sum(1 for row in read_manifest(manifest_filename, species))
+
+def materialize(manifest_filename, output_root):
+    """Write the MGF files of a virtual benchmark to output_root, with one
+    subdirectory per species.  Returns the number of spectra written."""
+
+    num_written = 0
+    written = set() # (species, mgf) pairs that have been started
+    current = None
+    output_file = None
+    try:
+        for species, mgf, block in iter_blocks(manifest_filename):
+            if (species, mgf) != current:
+                if output_file is not None:
+                    output_file.close()
+                os.makedirs(os.path.join(output_root, species), exist_ok=True)
+                output_file = mgf_io.open_output(
+                    os.path.join(output_root, species, mgf),
+                    "ab" if (species, mgf) in written else "wb"
+                )
+                current = (species, mgf)
+                written.add(current)
+            output_file.write(block)
+            num_written += 1
+    finally:
+        if output_file is not None:
+            output_file.close()
+    return num_written
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global DESCRIPTION
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('manifest', type=str,
+                        help="Manifest, or directory containing "
+                        + MANIFEST_FILENAME)
+    parser.add_argument('output_root', type=str,
+                        help="Output directory")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    with instrument.stage("materialize") as my_stage:
+        num_written = materialize(args.manifest, args.output_root)
+        my_stage.add(spectra=num_written)
+    print(f"Wrote {num_written} spectra to {args.output_root}.",
+          file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+
+two_spectra = """BEGIN IONS
+TITLE=first
+SEQ=VVQEQGTHPK
+100.0757 10
+END IONS
+
+BEGIN IONS
+TITLE=second
+SEQ=C[57.021]ANFDK
+120.080719 11572.1962890625
+END IONS
+"""
+
+def test_manifest():
+    global two_spectra
+
+    source = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    source.write(two_spectra)
+    source.close()
+    offsets = mgf_io.find_spectra(two_spectra.encode()).tolist()
+    manifest_dir = tempfile.mkdtemp()
+    write_manifest(os.path.join(manifest_dir, MANIFEST_FILENAME), [
+        ("yeast", "a.mgf", source.name, offsets[1], offsets[2] - offsets[1],
+         "C+57.021ANFDK"),
+        ("human", "b.mgf", source.name, offsets[0], offsets[1] - offsets[0],
+         ""),
+        ("yeast", "a.mgf", source.name, offsets[0], offsets[1] - offsets[0],
+         ""),
+    ])
+    assert(is_manifest(manifest_dir))
+    assert(not is_manifest(source.name))
+    assert(count_spectra(manifest_dir, "yeast") == 2)
+    assert([spectrum['params']['seq'] for spectrum
+            in read(manifest_dir, "yeast", peaks=False)]
+           == ["C+57.021ANFDK", "VVQEQGTHPK"])
+
+    # Materializing gives the same spectra.
+    output_root = tempfile.mkdtemp()
+    assert(materialize(manifest_dir, output_root) == 3)
+    with open(os.path.join(output_root, "yeast", "a.mgf"), "r") as mgf_file:
+        assert(mgf_file.read()
+               == two_spectra[offsets[1]:].replace("C[57.021]", "C+57.021")
+               + two_spectra[:offsets[1]])
+    assert(sorted(os.listdir(output_root)) == ["human", "yeast"])
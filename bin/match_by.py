@@ -1,53 +1,215 @@
 #!/usr/bin/env python
 import sys
 import argparse
+import functools
+import json
+import multiprocessing
+import os
+import numpy as np
 import matplotlib.pyplot as plt
 import spectrum_utils.spectrum
 import spectrum_utils.plot
+import pyteomics.mass
 import pyteomics.mgf
+import instrument
+import mgf_index
+import mgf_io
+import peptides
+import spectrum_store
 
-USAGE = """USAGE: match_by.py <mgf>+
+DESCRIPTION = """Given one or more annotated MGFs, compute the proportion
+of intensity matched to b- and y-ions in each spectrum. Prints a list of
+values to stdout.
 
-Given one or more annotated MGFs, compute the proportion of intensity
-matched to b- and y-ions in each spectrum. Prints a list of values to
-stdout."""
+With --feature_dir, the output is instead a directory of binary columns:
+percent matched, number of peaks, total ion current, numbers of peaks
+matched to b- and y-ions, and the fraction of cleavage sites covered by
+a b- or y-ion, for each spectrum.  Histograms of percent matched and
+coverage are stored with them in features.json, so plots need not read
+the columns at all.  Like --output, the directory is checkpointed, so
+that an interrupted run resumes where it stopped."""
 
-def convert_ptms (peptide):
-    "Add brackets around PTMs in a peptide."
+# Parameters of the annotation.
+PRECURSOR_TOLERANCE = 2.0 # Da
+FRAGMENT_TOLERANCE = 0.05 # Da
+ION_TYPES = "by"
+FRAGMENT_CACHE_SIZE = 100000 # Number of peptides
 
-    mod_dict = {
-        "C+57.021":"C[+57.021]",
-        "M+15.995":"M[+15.9949]",
-        "+0.984":"[+0.9840]",
-        "+42.011":"[+42.011]-",
-        "+43.006-17.027":"[+25.980]-",
-        "+43.006":"[+43.006]-",
-        "-17.027":"[-17.027]-"
-    }
-    for dn_mod in mod_dict.keys():
-        peptide = peptide.replace(dn_mod, mod_dict[dn_mod])
+# Columns of the binary output (see write_features), with their types.
+FEATURE_COLUMNS = {
+    "mgf": np.int32, # Index into the list of MGFs.
+    "index": np.int64, # Index of the spectrum in its MGF.
+    "percent_matched": np.float32,
+    "num_peaks": np.int32,
+    "tic": np.float64,
+    "matched_b": np.int32,
+    "matched_y": np.int32,
+    "coverage": np.float32,
+}
+FEATURES_FILENAME = "features.json"
+FEATURES_VERSION = 2
 
-    return peptide
+# Histograms accumulated while the features are computed: (low, high,
+# number of bins).  make_histograms.py bins the text output in the same
+# way.
+HISTOGRAMS = {"percent_matched": (0.0, 100.0, 100),
+              "coverage": (0.0, 1.0, 100)}
+
+# Masses used by the native engine.  These are the same values that
+# spectrum_utils gets from pyteomics, so the two backends agree.
+PROTON_MASS = pyteomics.mass.nist_mass["H+"][0][0]
+WATER_MASS = pyteomics.mass.calculate_mass(formula="H2O")
+ADDUCT_MASS = 1.007825 # Used by spectrum_utils to remove precursor peaks.
+AA_MASS = np.zeros(128) # Indexed by ASCII code.
+for aa, aa_mass in pyteomics.mass.std_aa_mass.items():
+    AA_MASS[ord(aa)] = aa_mass
+
+def convert_ptms(peptide):
+    "Convert PTMs in a peptide from Casanovo to ProForma format."
+    return peptides.convert(peptide, "proforma")
+
+def parse_proforma(peptide):
+    """Convert a ProForma peptide into an array of (modified) residue
+    masses, plus the mass of the N-terminal modification."""
+
+    parsed = peptides.parse(peptide, "proforma")
+    masses = AA_MASS[[ord(residue) for residue in parsed.residues]]
+    nterm_mass = 0.0
+    for position, mod in zip(parsed.positions, parsed.mods):
+        if position == -1:
+            nterm_mass += mod.mass
+        else:
+            masses[position] += mod.mass
+    return masses, nterm_mass
+
+def get_fragment_mz(peptide, max_charge, ion_types=ION_TYPES):
+    """Compute the m/z values of the b- and/or y-ion ladders of a ProForma
+    peptide, for all charges up to and including max_charge."""
+
+    masses, nterm_mass = parse_proforma(peptide)
+    prefix_masses = np.cumsum(masses)[:-1]
+    ladders = []
+    for ion_type in ion_types:
+        if ion_type == "b":
+            ladders.append(prefix_masses + nterm_mass)
+        elif ion_type == "y":
+            ladders.append(masses.sum() - prefix_masses + WATER_MASS)
+        else:
+            raise ValueError(f"Unsupported ion type {ion_type}.")
+    neutral_masses = np.concatenate(ladders)
+
+    charges = np.arange(1, max_charge + 1)[:, np.newaxis]
+    return ((neutral_masses + charges * PROTON_MASS) / charges).ravel()
+
+def match_peaks(mz, query_mz, tolerance):
+    """Return a boolean mask over the sorted array mz, indicating which
+    peaks lie within the given tolerance (Da) of any query m/z."""
+
+    starts = np.searchsorted(mz, query_mz - tolerance, side="left")
+    ends = np.searchsorted(mz, query_mz + tolerance, side="right")
+    coverage = np.zeros(len(mz) + 1, dtype=np.int64)
+    np.add.at(coverage, starts, 1)
+    np.add.at(coverage, ends, -1)
+    return np.cumsum(coverage[:-1]) > 0
+
+def get_precursor_mz(precursor_mz, precursor_charge):
+    "List the precursor m/z values at all charges, as in spectrum_utils."
+
+    neutral_mass = (precursor_mz - ADDUCT_MASS) * precursor_charge
+    charges = np.arange(precursor_charge, 0, -1)
+    return neutral_mass / charges + ADDUCT_MASS
+
+def _get_theoretical_fragments(seq, max_charge, ion_types):
+    """Convert a peptide from the SEQ field to ProForma and compute its
+    fragment m/z values.  Use get_theoretical_fragments, which is cached."""
+
+    peptide = convert_ptms(seq)
+    fragment_mz = get_fragment_mz(peptide, max_charge, ion_types)
+    fragment_mz.flags.writeable = False # Shared between cache hits.
+    return peptide, fragment_mz
+
+get_theoretical_fragments = functools.lru_cache(
+    maxsize=FRAGMENT_CACHE_SIZE
+)(_get_theoretical_fragments)
+
+def set_cache_size(cache_size):
+    "Replace the fragment cache with an empty one of the given size."
+    global get_theoretical_fragments
+
+    get_theoretical_fragments = functools.lru_cache(
+        maxsize=cache_size
+    )(_get_theoretical_fragments)
+
+def get_percent_matched_native(fragment_mz, precursor_mz, precursor_charge,
+                               mz, intensity):
+    """Vectorized equivalent of the spectrum_utils processing in
+    get_percent_matched_spectrum_utils."""
+
+    mz, intensity = preprocess_peaks(precursor_mz, precursor_charge, mz,
+                                     intensity)
+    matched = match_peaks(mz, fragment_mz, FRAGMENT_TOLERANCE)
+
+    return 100 * intensity[matched].sum() / intensity.sum()
+
+def preprocess_peaks(precursor_mz, precursor_charge, mz, intensity):
+    """Sort the peaks, remove the precursor peak(s) and take the square
+    root of the intensities, as spectrum_utils does."""
+
+    order = np.argsort(mz)
+    mz = np.asarray(mz, dtype=np.float64)[order]
+    intensity = np.asarray(intensity, dtype=np.float64)[order]
+
+    keep = ~match_peaks(mz, get_precursor_mz(precursor_mz, precursor_charge),
+                        PRECURSOR_TOLERANCE)
+    return mz[keep], np.sqrt(intensity[keep])
+
+def get_features_native(fragment_mz, max_charge, precursor_mz,
+                        precursor_charge, mz, intensity):
+    """Compute percent matched (as in get_percent_matched_native) and the
+    other features in FEATURE_COLUMNS, in one pass over the peaks.  The
+    numbers of matched b- and y-ions count peaks, and coverage is the
+    fraction of cleavage sites explained by a b- or y-ion of any
+    charge."""
+
+    num_peaks = len(mz)
+    tic = float(np.sum(intensity, dtype=np.float64))
+    mz, intensity = preprocess_peaks(precursor_mz, precursor_charge, mz,
+                                     intensity)
+
+    ladders = fragment_mz.reshape(max_charge, len(ION_TYPES), -1)
+    matched_ions = {}
+    for ion_index, ion_type in enumerate(ION_TYPES):
+        matched_ions[ion_type] = int(match_peaks(
+            mz, ladders[:, ion_index].ravel(), FRAGMENT_TOLERANCE
+        ).sum())
+    matched = match_peaks(mz, fragment_mz, FRAGMENT_TOLERANCE)
+
+    # A fragment is found if any peak lies within the tolerance.
+    found = (np.searchsorted(mz, fragment_mz + FRAGMENT_TOLERANCE,
+                             side="right")
+             > np.searchsorted(mz, fragment_mz - FRAGMENT_TOLERANCE,
+                               side="left"))
+    sites = found.reshape(ladders.shape).any(axis=(0, 1))
+
+    return (100 * intensity[matched].sum() / intensity.sum(), num_peaks, tic,
+            matched_ions.get("b", 0), matched_ions.get("y", 0),
+            sites.mean() if len(sites) > 0 else 0.0)
+
+def get_percent_matched_spectrum_utils(peptide, title, precursor_mz,
+                                       precursor_charge, mz, intensity):
+    "Reference implementation, using spectrum_utils."
 
-def get_percent_matched(spectrum):
-    
-    # Extract the peptide sequence.
-    peptide = convert_ptms(spectrum['params']['seq'])
-    
     # Convert from pyteomics to spectrum_utils format.
     spectrum = spectrum_utils.spectrum.MsmsSpectrum(
-        spectrum['params']['title'],
-        float(spectrum['params']['pepmass'][0]), 
-        int(spectrum['params']['charge'][0]), 
-        spectrum['m/z array'], 
-        spectrum['intensity array']
+        title, precursor_mz, precursor_charge, mz, intensity
     )
-    
+
     # Annotate the spectrum.
     spectrum = (
-        spectrum.remove_precursor_peak(2.0, "Da")
+        spectrum.remove_precursor_peak(PRECURSOR_TOLERANCE, "Da")
         .scale_intensity("root")
-        .annotate_proforma(peptide, 0.05, "Da", ion_types="by")
+        .annotate_proforma(peptide, FRAGMENT_TOLERANCE, "Da",
+                           ion_types=ION_TYPES)
     )
 
     # Compute percent matched intensity.
@@ -58,28 +220,506 @@ def get_percent_matched(spectrum):
         if len(annotation.fragment_annotations) > 0:
             matched_intensity += intensity
 
-    return (peptide, 100 * matched_intensity / total_intensity)
+    return 100 * matched_intensity / total_intensity
+
+def get_percent_matched(spectrum, backend="native"):
+    
+    # Extract the peptide sequence.
+    precursor_mz = float(spectrum['params']['pepmass'][0])
+    precursor_charge = int(spectrum['params']['charge'][0])
+
+    if backend == "native":
+        # Fragments of charge up to the precursor charge minus one.
+        peptide, fragment_mz = get_theoretical_fragments(
+            spectrum['params']['seq'], max(1, precursor_charge - 1), ION_TYPES
+        )
+        matched = get_percent_matched_native(
+            fragment_mz, precursor_mz, precursor_charge,
+            spectrum['m/z array'], spectrum['intensity array']
+        )
+    elif backend == "spectrum_utils":
+        peptide = convert_ptms(spectrum['params']['seq'])
+        matched = get_percent_matched_spectrum_utils(
+            peptide, spectrum['params']['title'], precursor_mz,
+            precursor_charge, spectrum['m/z array'],
+            spectrum['intensity array']
+        )
+    else:
+        raise ValueError(f"Unknown backend {backend}.")
+
+    return (peptide, matched)
+
+def make_chunks(mgf_filenames, chunk_size, first_indices=None):
+    """Split a list of MGFs into chunks of at most chunk_size spectra.
+    Each chunk is a tuple (MGF name, index of first spectrum, start byte,
+    end byte).  Optionally, skip the spectra before a given index in
+    each file.  Compressed MGFs are split using their sidecar indexes
+    (see mgf_index.find_chunk_offsets).
+
+    Spectrum stores (see spectrum_store.py) may be given instead of MGFs.
+    In that case, the start and end of each chunk, as well as the index
+    to start from, are spectrum indices within the store, whereas the
+    index of the first spectrum is relative to the MGF that the spectrum
+    came from."""
+
+    if first_indices is None:
+        first_indices = {}
+    chunks = []
+    for mgf_filename in mgf_filenames:
+        if spectrum_store.is_store(mgf_filename):
+            store = spectrum_store.open_store(mgf_filename)
+            for name, file_start, file_end in spectrum_store.file_ranges(
+                    store):
+                for start in range(
+                        max(file_start, first_indices.get(mgf_filename, 0)),
+                        file_end, chunk_size):
+                    chunks.append((mgf_filename, start - file_start, start,
+                                   min(start + chunk_size, file_end)))
+            continue
+
+        offsets = mgf_index.find_chunk_offsets(mgf_filename).tolist()
+        for first_index in range(first_indices.get(mgf_filename, 0),
+                                 len(offsets) - 1, chunk_size):
+            last_index = min(first_index + chunk_size, len(offsets) - 1)
+            chunks.append((mgf_filename, first_index, offsets[first_index],
+                           offsets[last_index]))
+    return chunks
+
+def process_chunk(chunk, backend="native", group_by_peptide=False):
+    """Compute percent matched for one chunk of an MGF file.  Returns the
+    corresponding lines of output as a single string, plus the number of
+    fragment cache hits and misses.  Optionally, process the spectra in
+    order of peptide, so that repeated peptides are found in the cache."""
+
+    mgf_filename, first_index, start, end = chunk
+    if spectrum_store.is_store(mgf_filename):
+        spectra = list(spectrum_store.read(mgf_filename, start, end))
+    else:
+        spectra = list(mgf_index.read(mgf_filename,
+                                      fields=("title", "pepmass", "charge",
+                                              "seq"),
+                                      start=start, end=end))
+    order = range(len(spectra))
+    if group_by_peptide:
+        order = sorted(order, key=lambda i: spectra[i]['params']['seq'])
+
+    cache_info = get_theoretical_fragments.cache_info()
+    output = [None] * len(spectra)
+    for i in order:
+        peptide, matched = get_percent_matched(spectra[i], backend)
+        output[i] = f"{first_index + i}\t{peptide}\t{matched:.4f}\n"
+    hits = get_theoretical_fragments.cache_info().hits - cache_info.hits
+    misses = get_theoretical_fragments.cache_info().misses - cache_info.misses
+
+    return ("".join(output), hits, misses)
+
+def process_chunk_star(args):
+    "Unpack arguments for use with Pool.imap."
+    return process_chunk(*args)
+
+def process_chunk_features(chunk, group_by_peptide=False):
+    """Same as process_chunk, but compute all of the features in
+    FEATURE_COLUMNS (except the MGF index) with the native engine.
+    Returns a dictionary from column name to array, plus the number of
+    fragment cache hits and misses."""
+
+    mgf_filename, first_index, start, end = chunk
+    if spectrum_store.is_store(mgf_filename):
+        spectra = list(spectrum_store.read(mgf_filename, start, end))
+    else:
+        spectra = list(mgf_index.read(mgf_filename,
+                                      fields=("pepmass", "charge", "seq"),
+                                      start=start, end=end))
+    order = range(len(spectra))
+    if group_by_peptide:
+        order = sorted(order, key=lambda i: spectra[i]['params']['seq'])
+
+    cache_info = get_theoretical_fragments.cache_info()
+    features = [None] * len(spectra)
+    for i in order:
+        params = spectra[i]['params']
+        precursor_charge = int(params['charge'][0])
+        max_charge = max(1, precursor_charge - 1)
+        peptide, fragment_mz = get_theoretical_fragments(
+            params['seq'], max_charge, ION_TYPES
+        )
+        features[i] = get_features_native(
+            fragment_mz, max_charge, float(params['pepmass'][0]),
+            precursor_charge, spectra[i]['m/z array'],
+            spectra[i]['intensity array']
+        )
+    hits = get_theoretical_fragments.cache_info().hits - cache_info.hits
+    misses = get_theoretical_fragments.cache_info().misses - cache_info.misses
+
+    columns = {"index": np.arange(first_index, first_index + len(spectra),
+                                  dtype=FEATURE_COLUMNS["index"])}
+    names = [name for name in FEATURE_COLUMNS if name not in columns
+             and name != "mgf"]
+    for name, values in zip(names, zip(*features) if features
+                            else [[]] * len(names)):
+        columns[name] = np.array(values, dtype=FEATURE_COLUMNS[name])
+    return columns, hits, misses
+
+def process_chunk_features_star(args):
+    "Unpack arguments for use with Pool.imap."
+    return process_chunk_features(*args)
+
+def write_features(mgf_filenames, feature_dir, species=None, workers=1,
+                   chunk_size=5000, group_by_peptide=False,
+                   cache_size=FRAGMENT_CACHE_SIZE):
+    """Compute the features in FEATURE_COLUMNS for all spectra in a list
+    of MGFs (or spectrum stores), and write them to feature_dir, with one
+    binary file per column, in the format of spectrum_store.  The
+    histograms in HISTOGRAMS are accumulated as the chunks arrive and
+    stored, with the list of MGFs and the species, in features.json.
+
+    The output is checkpointed in the same way as that of
+    write_percent_matched, with the number of rows written and the
+    partial histograms, so that an interrupted run resumes where it
+    stopped.  features.json is written last, when all MGFs are done.
+    Returns the number of spectra processed."""
+
+    os.makedirs(feature_dir, exist_ok=True)
+    column_filenames = {name: os.path.join(feature_dir, f"{name}.bin")
+                        for name in FEATURE_COLUMNS}
+    checkpoint = read_checkpoint(feature_dir)
+    if (checkpoint is not None) and \
+       (checkpoint.get("version") != FEATURES_VERSION):
+        checkpoint = None
+    if checkpoint is None:
+        checkpoint = {
+            "version": FEATURES_VERSION,
+            "num_spectra": 0,
+            "histograms": {name: [0] * HISTOGRAMS[name][2]
+                           for name in HISTOGRAMS},
+            "mgfs": {}
+        }
+        mode = "wb"
+    else:
+        print(f"Resuming {feature_dir}.", file=sys.stderr)
+        for name, dtype in FEATURE_COLUMNS.items():
+            os.truncate(column_filenames[name],
+                        checkpoint["num_spectra"] * np.dtype(dtype).itemsize)
+        mode = "ab"
+    features_filename = os.path.join(feature_dir, FEATURES_FILENAME)
+    if os.path.exists(features_filename):
+        os.remove(features_filename)
+
+    todo, first_indices = start_checkpoint(checkpoint, mgf_filenames)
+    mgf_numbers = {mgf_filename: number
+                   for number, mgf_filename in enumerate(checkpoint["mgfs"])}
+    histograms = {name: np.array(counts, dtype=np.int64)
+                  for name, counts in checkpoint["histograms"].items()}
+
+    chunks = make_chunks(todo, chunk_size, first_indices)
+    final_ends = {chunk[0]: chunk[3] for chunk in chunks}
+    print(f"Split {len(todo)} MGFs into {len(chunks)} chunks.",
+          file=sys.stderr)
+    tasks = [(chunk, group_by_peptide) for chunk in chunks]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=set_cache_size,
+                                    initargs=(cache_size,))
+        results = pool.imap(process_chunk_features_star, tasks)
+    else:
+        pool = None
+        results = map(process_chunk_features_star, tasks)
+
+    column_files = {name: open(filename, mode)
+                    for name, filename in column_filenames.items()}
+    total_spectra = 0
+    total_hits = 0
+    total_misses = 0
+    progress = instrument.Progress(len(chunks), "match_by", "chunks")
+    for chunk, (columns, hits, misses) in zip(chunks, results):
+        progress.update()
+        num_spectra = len(columns["index"])
+        columns["mgf"] = np.full(num_spectra, mgf_numbers[chunk[0]],
+                                 dtype=FEATURE_COLUMNS["mgf"])
+        for name, column_file in column_files.items():
+            column_file.write(columns[name].tobytes())
+            column_file.flush()
+        for name, (low, high, num_bins) in HISTOGRAMS.items():
+            histograms[name] += np.histogram(columns[name], num_bins,
+                                             (low, high))[0]
+        total_spectra += num_spectra
+        total_hits += hits
+        total_misses += misses
+
+        checkpoint["num_spectra"] += num_spectra
+        checkpoint["histograms"] = {name: counts.tolist()
+                                    for name, counts in histograms.items()}
+        update_checkpoint(checkpoint, chunk, num_spectra, final_ends)
+        write_checkpoint(feature_dir, checkpoint)
+    for column_file in column_files.values():
+        column_file.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print(f"Fragment cache: {total_hits} hits, {total_misses} misses.",
+          file=sys.stderr)
+    instrument.record_cache("fragment_cache", total_hits, total_misses)
+    metadata = {
+        "version": FEATURES_VERSION,
+        "species": species,
+        "mgfs": list(checkpoint["mgfs"]),
+        "columns": {name: np.dtype(dtype).str
+                    for name, dtype in FEATURE_COLUMNS.items()},
+        "num_spectra": checkpoint["num_spectra"],
+        "histograms": {},
+    }
+    for name, (low, high, num_bins) in HISTOGRAMS.items():
+        metadata["histograms"][name] = {
+            "edges": np.linspace(low, high, num_bins + 1).tolist(),
+            "counts": histograms[name].tolist(),
+        }
+    with open(f"{features_filename}.tmp", "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=1)
+    os.replace(f"{features_filename}.tmp", features_filename)
+    return total_spectra
+
+def read_features(feature_dir):
+    """Open the output of write_features.  Returns the metadata, with a
+    memory-mapped array for each column under "data"."""
+
+    with open(os.path.join(feature_dir, FEATURES_FILENAME), "r") \
+         as metadata_file:
+        metadata = json.load(metadata_file)
+    metadata["data"] = {}
+    for name, dtype in metadata["columns"].items():
+        filename = os.path.join(feature_dir, f"{name}.bin")
+        metadata["data"][name] = (
+            np.memmap(filename, dtype=dtype, mode="r")
+            if metadata["num_spectra"] > 0 else np.zeros(0, dtype=dtype)
+        )
+    return metadata
+
+def get_checkpoint_filename(output_filename):
+    """Return the name of the checkpoint of an output file, or of a
+    feature directory (see write_features)."""
+    if os.path.isdir(output_filename):
+        return os.path.join(output_filename, "checkpoint.json")
+    return f"{output_filename}.checkpoint"
+
+def read_checkpoint(output_filename):
+    """Read the checkpoint of a partially written output file (or feature
+    directory).  The checkpoint records the size of the output file (or
+    the number of rows in each column) and, for each MGF, its size and
+    modification time, the index of the last spectrum written, and
+    whether the MGF is complete.  Returns None if there is no usable
+    checkpoint."""
+
+    checkpoint_filename = get_checkpoint_filename(output_filename)
+    if not (os.path.exists(output_filename)
+            and os.path.exists(checkpoint_filename)):
+        return None
+    with open(checkpoint_filename, "r") as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+
+    if os.path.isdir(output_filename):
+        sizes = {os.path.join(output_filename, f"{name}.bin"):
+                 checkpoint["num_spectra"] * np.dtype(dtype).itemsize
+                 for name, dtype in FEATURE_COLUMNS.items()}
+    else:
+        sizes = {output_filename: checkpoint["output_size"]}
+    for filename, size in sizes.items():
+        if (not os.path.exists(filename)) or \
+           (os.path.getsize(filename) < size):
+            print(f"{filename} is truncated.", file=sys.stderr)
+            return None
+    for mgf_filename, entry in checkpoint["mgfs"].items():
+        if ( (not os.path.exists(mgf_filename)) or
+             (spectrum_store.get_file_stamp(mgf_filename)
+              != entry["stamp"]) ):
+            print(f"{mgf_filename} has changed.", file=sys.stderr)
+            return None
+    return checkpoint
+
+def write_checkpoint(output_filename, checkpoint):
+    "Atomically replace the checkpoint of an output file."
+    checkpoint_filename = get_checkpoint_filename(output_filename)
+    with open(f"{checkpoint_filename}.tmp", "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=1)
+    os.replace(f"{checkpoint_filename}.tmp", checkpoint_filename)
+
+def start_checkpoint(checkpoint, mgf_filenames):
+    """List the MGFs left to process, given a checkpoint: first those
+    that were partially processed, then those not seen before, which are
+    added to the checkpoint.  Returns the list, plus a dictionary from
+    MGF name to the first spectrum to process."""
+
+    todo = []
+    first_indices = {}
+    for mgf_filename, entry in checkpoint["mgfs"].items():
+        if not entry["complete"]:
+            todo.append(mgf_filename)
+            first_indices[mgf_filename] = entry["last_index"] + 1
+    for mgf_filename in mgf_filenames:
+        mgf_filename = os.path.abspath(mgf_filename)
+        if mgf_filename in checkpoint["mgfs"]:
+            if checkpoint["mgfs"][mgf_filename]["complete"]:
+                print(f"Skipping {mgf_filename}.", file=sys.stderr)
+        elif mgf_filename not in todo:
+            todo.append(mgf_filename)
+            checkpoint["mgfs"][mgf_filename] = {
+                "stamp": spectrum_store.get_file_stamp(mgf_filename),
+                "last_index": -1,
+                "complete": False
+            }
+    return todo, first_indices
+
+def update_checkpoint(checkpoint, chunk, num_spectra, final_ends):
+    """Record in a checkpoint that the spectra of a chunk (see make_chunks)
+    have been written.  final_ends gives the end of the last chunk of
+    each MGF."""
+
+    mgf_filename, first_index, start, end = chunk
+    entry = checkpoint["mgfs"][mgf_filename]
+    if spectrum_store.is_store(mgf_filename):
+        entry["last_index"] = start + num_spectra - 1
+    else:
+        entry["last_index"] = first_index + num_spectra - 1
+    entry["complete"] = (end == final_ends[mgf_filename])
+
+def write_percent_matched(mgf_filenames, output_filename=None,
+                          backend="native", workers=1, chunk_size=5000,
+                          group_by_peptide=False,
+                          cache_size=FRAGMENT_CACHE_SIZE):
+    """Compute percent matched for all spectra in a list of MGFs.  If an
+    output filename is given, then the output is checkpointed, and an
+    interrupted run resumes where it stopped.  Otherwise, print to stdout.
+    Returns the number of spectra processed."""
+
+    # Figure out where to start.
+    first_indices = {} # Key = MGF name, value = first spectrum to process.
+    if output_filename is None:
+        checkpoint = None
+        output_file = sys.stdout
+        output_file.write(f"MGF index\tpeptide\t% matched\n")
+        todo = mgf_filenames
+    else:
+        checkpoint = read_checkpoint(output_filename)
+        if checkpoint is None:
+            checkpoint = {"output_size": 0, "mgfs": {}}
+            output_file = open(output_filename, "w")
+            output_file.write(f"MGF index\tpeptide\t% matched\n")
+        else:
+            print(f"Resuming {output_filename}.", file=sys.stderr)
+            os.truncate(output_filename, checkpoint["output_size"])
+            output_file = open(output_filename, "a")
+
+        # Finish partially processed MGFs before starting new ones.
+        todo, first_indices = start_checkpoint(checkpoint, mgf_filenames)
+
+    chunks = make_chunks(todo, chunk_size, first_indices)
+    final_ends = {chunk[0]: chunk[3] for chunk in chunks}
+    print(f"Split {len(todo)} MGFs into {len(chunks)} chunks.",
+          file=sys.stderr)
+
+    # Chunks are returned in order, so the output matches a serial run.
+    tasks = [(chunk, backend, group_by_peptide) for chunk in chunks]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=set_cache_size,
+                                    initargs=(cache_size,))
+        results = pool.imap(process_chunk_star, tasks)
+    else:
+        pool = None
+        results = map(process_chunk_star, tasks)
+
+    total_spectra = 0
+    total_hits = 0
+    total_misses = 0
+    progress = instrument.Progress(len(chunks), "match_by", "chunks")
+    for (mgf_filename, first_index, start, end), (output, hits, misses) \
+        in zip(chunks, results):
+        if first_index == first_indices.get(mgf_filename, 0):
+            print(f"Reading from {mgf_filename}.", file=sys.stderr)
+        output_file.write(output)
+        num_spectra = output.count("\n")
+        progress.update()
+        total_spectra += num_spectra
+        total_hits += hits
+        total_misses += misses
+
+        if checkpoint is not None:
+            output_file.flush()
+            update_checkpoint(checkpoint, (mgf_filename, first_index, start,
+                                           end), num_spectra, final_ends)
+            checkpoint["output_size"] = output_file.tell()
+            write_checkpoint(output_filename, checkpoint)
+
+    if backend == "native":
+        print(f"Fragment cache: {total_hits} hits, {total_misses} misses.",
+              file=sys.stderr)
+        instrument.record_cache("fragment_cache", total_hits, total_misses)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if checkpoint is not None:
+        output_file.close()
+    return total_spectra
 
 ###########################################################################
 # MAIN
 ###########################################################################
 def main():
-    global USAGE
+    global DESCRIPTION
 
     # Parse the command line.
-    if len(sys.argv) == 1:
-        print(USAGE, file=sys.stderr)
-        sys.exit(1)
-
-    print(f"MGF index\tpeptide\t% matched")
-    for this_mgf in sys.argv[1:]:
-        print(f"Reading from {this_mgf}.", file=sys.stderr)
-        with pyteomics.mgf.read(this_mgf, use_index=False) as reader:
-            for mgf_index, spectrum in enumerate(reader):
-                if mgf_index % 1000 == 0 and mgf_index > 0:
-                    print(mgf_index, file=sys.stderr)
-                peptide, matched = get_percent_matched(spectrum)
-                print(f"{mgf_index}\t{peptide}\t{matched:.4f}")
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('mgfs', nargs='+',
+                        help="Annotated MGF files or spectrum stores")
+    parser.add_argument('--backend', choices=["native", "spectrum_utils"],
+                        default="native",
+                        help="Annotation engine (spectrum_utils is the "
+                        + "slower reference implementation)")
+    parser.add_argument('--output', type=str, required=False,
+                        help="Output file, checkpointed so that an "
+                        + "interrupted run can be resumed (default=stdout)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes")
+    parser.add_argument('--chunk_size', type=int, default=5000,
+                        help="Maximum number of spectra per unit of work")
+    parser.add_argument('--cache_size', type=int,
+                        default=FRAGMENT_CACHE_SIZE,
+                        help="Number of peptides in the fragment cache")
+    parser.add_argument('--group_by_peptide',
+                        action=argparse.BooleanOptionalAction,
+                        help="Process the spectra in each chunk in order of "
+                        + "peptide")
+    parser.add_argument('--feature_dir', type=str, default=None,
+                        help="Instead of the text output, write percent "
+                        + "matched and other features of each spectrum, "
+                        + "plus histograms, in binary form to this "
+                        + "directory (native backend only)")
+    parser.add_argument('--species', type=str, default=None,
+                        help="Species name to record with --feature_dir")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+    set_cache_size(args.cache_size)
+    if (args.feature_dir is not None) and (args.backend != "native"):
+        parser.error("--feature_dir requires the native backend")
+    if (args.feature_dir is not None) and (args.output is not None):
+        parser.error("--feature_dir replaces --output")
+
+    with instrument.stage("percent_matched", backend=args.backend) \
+         as my_stage:
+        if args.feature_dir is not None:
+            num_spectra = write_features(
+                args.mgfs, args.feature_dir, args.species, args.workers,
+                args.chunk_size, args.group_by_peptide, args.cache_size
+            )
+        else:
+            num_spectra = write_percent_matched(
+                args.mgfs, args.output, args.backend, args.workers,
+                args.chunk_size, args.group_by_peptide, args.cache_size
+            )
+        my_stage.add(spectra=num_spectra,
+                     bytes=sum(os.path.getsize(mgf_filename)
+                               for mgf_filename in args.mgfs
+                               if os.path.isfile(mgf_filename)))
 
 if __name__ == "__main__":
     main()
@@ -89,6 +729,7 @@ if __name__ == "__main__":
 #############################################################################
 import pytest
 import tempfile
+import io
 
 # Mass of +1 b1 ion is m(V) + m(proton)
 # 99.06841391299 + 1.00727646677 = 100.0757
@@ -426,3 +1067,210 @@ def test_get_percent_matched():
                     (percent_matched == pytest.approx(26.840940309345886))
                 )
             
+
+def test_native_backend():
+    global bitty_mgf, my_mgf, big_mgf
+
+    # The native engine reproduces the spectrum_utils reference.
+    for sample_mgf in [bitty_mgf, my_mgf, big_mgf]:
+        with pyteomics.mgf.read(io.StringIO(sample_mgf),
+                                use_index=False) as reader:
+            for spectrum in reader:
+                native = get_percent_matched(spectrum, "native")
+                reference = get_percent_matched(spectrum, "spectrum_utils")
+                assert(native[0] == reference[0])
+                assert(native[1] == pytest.approx(reference[1], rel=1e-5))
+
+    # Modified peptides, with peaks placed exactly on the fragments.
+    peptide = "+43.006-17.027M+15.995PEPTC+57.021IDEQ+0.984NK"
+    fragment_mz = get_fragment_mz(convert_ptms(peptide), 2)
+    rng = np.random.default_rng(7718)
+    spectrum = {
+        'params': {'title': "test", 'seq': peptide, 'pepmass': (800.0, None),
+                   'charge': [3]},
+        'm/z array': np.concatenate(
+            [fragment_mz[::3] + rng.uniform(-0.04, 0.04, len(fragment_mz[::3])),
+             rng.uniform(100, 1500, 50)]
+        ),
+        'intensity array': rng.uniform(1, 1000, len(fragment_mz[::3]) + 50),
+    }
+    native = get_percent_matched(spectrum, "native")
+    reference = get_percent_matched(spectrum, "spectrum_utils")
+    assert(native[1] == pytest.approx(reference[1], rel=1e-5))
+
+def test_chunks():
+    global bitty_mgf, my_mgf, big_mgf
+
+    my_tempfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    my_tempfile.write(bitty_mgf + my_mgf + big_mgf + "\n" + bitty_mgf)
+    my_tempfile.close()
+
+    assert(mgf_io.count_spectra(my_tempfile.name) == 4)
+
+    # Chunked and parallel runs give the same output as a single chunk.
+    serial = process_chunk(make_chunks([my_tempfile.name], 100)[0])[0]
+    assert(serial.count("\n") == 4)
+    chunks = make_chunks([my_tempfile.name], 3)
+    assert(len(chunks) == 2)
+    with multiprocessing.Pool(2) as pool:
+        assert(serial == "".join(output for output, hits, misses
+                                 in pool.map(process_chunk, chunks)))
+
+def test_fragment_cache():
+    global bitty_mgf, my_mgf, big_mgf
+
+    my_tempfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    my_tempfile.write(bitty_mgf + big_mgf + my_mgf)
+    my_tempfile.close()
+    chunk = make_chunks([my_tempfile.name], 100)[0]
+
+    # The two VVQEQGTHPK spectra (charge 2) share one cache entry.
+    set_cache_size(10)
+    output, hits, misses = process_chunk(chunk)
+    assert((hits, misses) == (1, 2))
+    output, hits, misses = process_chunk(chunk)
+    assert((hits, misses) == (3, 0))
+
+    # With a single cache entry, only grouping by peptide gets a hit.
+    set_cache_size(1)
+    assert(process_chunk(chunk)[1:] == (0, 3))
+    set_cache_size(1)
+    assert(process_chunk(chunk, group_by_peptide=True) == (output, 1, 2))
+    set_cache_size(FRAGMENT_CACHE_SIZE)
+
+def test_checkpoint():
+    global bitty_mgf, my_mgf, big_mgf
+
+    mgf1 = tempfile.NamedTemporaryFile(delete=False, mode='w', suffix=".mgf")
+    mgf1.write(bitty_mgf + my_mgf + big_mgf)
+    mgf1.close()
+    mgf2 = tempfile.NamedTemporaryFile(delete=False, mode='w', suffix=".mgf")
+    mgf2.write(big_mgf + bitty_mgf)
+    mgf2.close()
+    output_dir = tempfile.mkdtemp()
+    expected = os.path.join(output_dir, "expected.txt")
+    output = os.path.join(output_dir, "output.txt")
+
+    # Adding an MGF processes only the new one.
+    assert(write_percent_matched([mgf1.name, mgf2.name], expected,
+                                 chunk_size=1) == 5)
+    assert(write_percent_matched([mgf1.name], output) == 3)
+    assert(write_percent_matched([mgf1.name, mgf2.name], output) == 2)
+    assert(write_percent_matched([mgf1.name, mgf2.name], output) == 0)
+    with open(expected, "r") as file1, open(output, "r") as file2:
+        assert(file1.read() == file2.read())
+
+    # Simulate a run killed in the middle of the first MGF.
+    with open(expected, "r") as expected_file:
+        lines = expected_file.readlines()
+    with open(output, "w") as output_file:
+        output_file.write("".join(lines[:2]) + "1\tVVQ")
+    write_checkpoint(output, {
+        "output_size": len("".join(lines[:2])),
+        "mgfs": { os.path.abspath(mgf1.name): {
+            "stamp": spectrum_store.get_file_stamp(mgf1.name),
+            "last_index": 0,
+            "complete": False
+        }}
+    })
+    assert(write_percent_matched([mgf1.name, mgf2.name], output,
+                                 workers=2, chunk_size=1) == 4)
+    with open(expected, "r") as file1, open(output, "r") as file2:
+        assert(file1.read() == file2.read())
+
+def test_spectrum_store():
+    global bitty_mgf, my_mgf, big_mgf
+
+    # A store gives the same output as the MGFs it was made from.
+    mgf_dir = tempfile.mkdtemp()
+    mgf_filenames = []
+    for name, mgf_text in [("a.mgf", bitty_mgf + my_mgf), ("b.mgf", big_mgf)]:
+        mgf_filenames.append(os.path.join(mgf_dir, name))
+        with open(mgf_filenames[-1], "w") as mgf_file:
+            mgf_file.write(mgf_text)
+    store_dir = os.path.join(mgf_dir, "store")
+    spectrum_store.write_store(mgf_filenames, store_dir, verify=False)
+
+    expected = os.path.join(mgf_dir, "expected.txt")
+    output = os.path.join(mgf_dir, "output.txt")
+    write_percent_matched(mgf_filenames, expected)
+    assert(write_percent_matched([store_dir], output, chunk_size=1) == 3)
+    with open(expected, "r") as file1, open(output, "r") as file2:
+        assert(file1.read() == file2.read())
+    assert(write_percent_matched([store_dir], output) == 0)
+
+def test_write_features():
+    global bitty_mgf, my_mgf, big_mgf
+
+    mgf_dir = tempfile.mkdtemp()
+    mgf_filenames = []
+    for name, mgf_text in [("a.mgf", bitty_mgf + my_mgf), ("b.mgf", big_mgf)]:
+        mgf_filenames.append(os.path.join(mgf_dir, name))
+        with open(mgf_filenames[-1], "w") as mgf_file:
+            mgf_file.write(mgf_text)
+    text_output = os.path.join(mgf_dir, "output.txt")
+    write_percent_matched(mgf_filenames, text_output)
+    with open(text_output, "r") as text_file:
+        text_file.readline()
+        percent_matched = [float(line.split("\t")[2]) for line in text_file]
+
+    serial_dir = os.path.join(mgf_dir, "serial")
+    parallel_dir = os.path.join(mgf_dir, "parallel")
+    assert(write_features(mgf_filenames, serial_dir, "yeast") == 3)
+    assert(write_features(mgf_filenames, parallel_dir, "yeast", workers=2,
+                          chunk_size=1) == 3)
+    features = read_features(serial_dir)
+    parallel = read_features(parallel_dir)
+    for name in FEATURE_COLUMNS:
+        assert(np.array_equal(features["data"][name],
+                              parallel["data"][name]))
+    assert(features["histograms"] == parallel["histograms"])
+
+    # The features agree with the text output.
+    data = features["data"]
+    assert(features["species"] == "yeast")
+    assert(data["mgf"].tolist() == [0, 0, 1])
+    assert(data["index"].tolist() == [0, 1, 0])
+    assert(data["percent_matched"] == pytest.approx(percent_matched,
+                                                    abs=1e-4))
+
+    # bitty_mgf has three peaks, matching b1 and y1 of VVQEQGTHPK.
+    assert(data["num_peaks"][0] == 3)
+    assert(data["tic"][0] == 30)
+    assert((data["matched_b"][0], data["matched_y"][0]) == (1, 1))
+    assert(data["coverage"][0] == pytest.approx(2 / 9))
+
+    for name, (low, high, num_bins) in HISTOGRAMS.items():
+        histogram = features["histograms"][name]
+        assert(len(histogram["edges"]) == num_bins + 1)
+        assert(sum(histogram["counts"]) == 3)
+
+    # Simulate a run killed after the first spectrum, while writing the
+    # second, and resume it with the second MGF added.
+    resume_dir = os.path.join(mgf_dir, "resume")
+    assert(write_features(mgf_filenames[:1], resume_dir, "yeast",
+                          chunk_size=1) == 2)
+    with open(os.path.join(resume_dir, "checkpoint.json"), "r") \
+         as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    checkpoint["num_spectra"] = 1
+    checkpoint["mgfs"][mgf_filenames[0]].update(last_index=0,
+                                                 complete=False)
+    checkpoint["histograms"] = {
+        name: np.histogram(data[name][:1], num_bins, (low, high))[0].tolist()
+        for name, (low, high, num_bins) in HISTOGRAMS.items()
+    }
+    write_checkpoint(resume_dir, checkpoint)
+    for name in FEATURE_COLUMNS:
+        with open(os.path.join(resume_dir, f"{name}.bin"), "ab") \
+             as column_file:
+            column_file.write(b"xyz")
+    os.remove(os.path.join(resume_dir, FEATURES_FILENAME))
+    assert(write_features(mgf_filenames, resume_dir, "yeast", workers=2,
+                          chunk_size=1) == 2)
+    assert(write_features(mgf_filenames, resume_dir, "yeast") == 0)
+    resumed = read_features(resume_dir)
+    for name in FEATURE_COLUMNS:
+        assert(np.array_equal(resumed["data"][name], data[name]))
+    assert(resumed["histograms"] == features["histograms"])
+    assert(resumed["mgfs"] == features["mgfs"])
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# CREATE DATE: 18 Oct 2026
+import sys
+import argparse
+import functools
+import multiprocessing
+import os
+import re
+import numpy as np
+import instrument
+import mgf_io
+
+DESCRIPTION = """Build, or look up spectra in, the sidecar indexes of MGF
+files.
+
+The index of an MGF is stored next to it, as <mgf>.idx.npz.  It lists
+the byte offset of every spectrum, its scan number (from the SCANS
+field, or else from "scan=<n>" in its TITLE) and its title, so that a
+spectrum can be read from a memory-mapped MGF without reading anything
+else.  The index is built in one pass over the bytes of the file, and
+is rebuilt whenever the size or modification time of the MGF changes.
+The index of a compressed MGF (see mgf_io.py) also holds the table of
+its independently compressed blocks, so that a spectrum is read by
+decompressing only the blocks that hold it.  If the index cannot be
+written (e.g., in a read-only directory), it is kept in memory only.
+
+The build command indexes the given MGFs.  The get command prints the
+spectrum with the given scan number or title."""
+
+INDEX_VERSION = 2
+INDEX_SUFFIX = ".idx.npz"
+
+SCANS_REGEX = re.compile(rb"\nSCANS=([0-9]+)")
+TITLE_REGEX = re.compile(rb"\nTITLE=([^\n]*)")
+TITLE_SCAN_REGEX = re.compile(rb"scan=([0-9]+)")
+
+# Number of indexes kept open in each process.
+INDEX_CACHE_SIZE = 64
+
+# Number of compressed files whose last blocks are kept in each process.
+READER_CACHE_SIZE = 8
+
+def find_values(mgf_map, regex, offsets):
+    """Find the first match of a one-group regex in the header of each
+    spectrum.  Returns a list of bytes (or None) per spectrum."""
+
+    values = [None] * (len(offsets) - 1)
+    matches = list(regex.finditer(mgf_map))
+    spectrum_indices = np.searchsorted(
+        offsets, [match.start() + 1 for match in matches], side="right"
+    ) - 1
+    for spectrum_index, match in zip(spectrum_indices.tolist(), matches):
+        if (0 <= spectrum_index < len(values)) and \
+           (values[spectrum_index] is None):
+            values[spectrum_index] = match.group(1).rstrip(b"\r")
+    return values
+
+def get_title_scan(title):
+    "Extract the scan number from a title, or return -1."
+    matches = TITLE_SCAN_REGEX.findall(title)
+    return int(matches[-1]) if matches else -1
+
+def build_index(mgf_filename):
+    """Index an MGF file, reading it one chunk at a time.  Returns a
+    dictionary with the spectrum offsets (as in mgf_io.find_spectra), the
+    SCANS values and the scans given in the titles (-1 if missing), the
+    titles, and the block table of a compressed file (see
+    mgf_io.get_block_table; empty otherwise)."""
+
+    offsets = []
+    scans = []
+    titles = []
+    end = 0
+    block_ends = []
+    for offset, chunk in mgf_io.iter_chunks(mgf_filename, block_ends):
+        chunk_offsets = mgf_io.find_spectra(chunk)
+        offsets.append(chunk_offsets[:-1] + offset)
+        scans += find_values(chunk, SCANS_REGEX, chunk_offsets)
+        titles += find_values(chunk, TITLE_REGEX, chunk_offsets)
+        end = offset + int(chunk_offsets[-1])
+    offsets = np.concatenate(offsets + [np.array([end], dtype=np.int64)])
+    if mgf_io.get_compression(mgf_filename) is None:
+        blocks = np.zeros((2, 0), dtype=np.int64)
+    else:
+        blocks = mgf_io.get_block_table(block_ends)
+    titles = [b"" if title is None else title for title in titles]
+    return {
+        "offsets": offsets,
+        "scans": np.array([-1 if scan is None else int(scan)
+                           for scan in scans], dtype=np.int64),
+        "title_scans": np.array([get_title_scan(title) for title in titles],
+                                dtype=np.int64),
+        "titles": np.array(titles, dtype=np.bytes_),
+        "blocks": blocks,
+    }
+
+def write_index(mgf_filename, index, stamp):
+    """Atomically write the sidecar index of an MGF file, for the given
+    version of it (see mgf_io.get_file_stamp)."""
+    index_filename = mgf_filename + INDEX_SUFFIX
+    with open(f"{index_filename}.tmp", "wb") as index_file:
+        np.savez(index_file, version=INDEX_VERSION,
+                 stamp=[stamp["size"], stamp["mtime"]], **index)
+    os.replace(f"{index_filename}.tmp", index_filename)
+
+def read_index(mgf_filename, stamp):
+    """Read the sidecar index of an MGF file.  Returns None if there is
+    none, or if it is out of date."""
+
+    index_filename = mgf_filename + INDEX_SUFFIX
+    if not os.path.exists(index_filename):
+        return None
+    with np.load(index_filename) as index_file:
+        if (index_file["version"] != INDEX_VERSION) or \
+           (not np.array_equal(index_file["stamp"],
+                               [stamp["size"], stamp["mtime"]])):
+            return None
+        return {name: index_file[name] for name in
+                ("offsets", "scans", "title_scans", "titles",
+                                   "blocks")}
+
+@functools.lru_cache(maxsize=INDEX_CACHE_SIZE)
+def _open_index(mgf_filename, size, mtime):
+    """Read or build the index of one version of an MGF file.  Use
+    open_index, which checks the version."""
+
+    stamp = {"size": size, "mtime": mtime}
+    index = read_index(mgf_filename, stamp)
+    if index is None:
+        index = build_index(mgf_filename)
+        try:
+            write_index(mgf_filename, index, stamp)
+        except OSError as error:
+            print(f"Cannot write index of {mgf_filename}: {error}",
+                  file=sys.stderr)
+
+    # Lookup tables.  Scans come from SCANS, or else from the title.
+    index["effective_scans"] = np.where(index["scans"] >= 0, index["scans"],
+                                        index["title_scans"])
+    index["scan_order"] = np.argsort(index["effective_scans"], kind="stable")
+    index["title_order"] = np.argsort(index["titles"], kind="stable")
+    return index
+
+def open_index(mgf_filename):
+    """Return the index of an MGF file, from its sidecar if that is up to
+    date, and otherwise by indexing the file (and writing the sidecar).
+    Indexes are cached in memory."""
+
+    stamp = mgf_io.get_file_stamp(mgf_filename)
+    return _open_index(os.path.abspath(mgf_filename), stamp["size"],
+                       stamp["mtime"])
+
+def find_sorted(values, order, value):
+    """Return the position of the first occurrence of value in values,
+    given the stable sort order of values, or None."""
+
+    position = np.searchsorted(values[order], value)
+    if (position < len(order)) and (values[order[position]] == value):
+        return int(order[position])
+    return None
+
+def find_spectrum(index, scan=None, title=None):
+    """Return the position in the file of the first spectrum with the given
+    scan number or title, or None."""
+
+    if scan is not None:
+        return find_sorted(index["effective_scans"], index["scan_order"],
+                           scan)
+    return find_sorted(index["titles"], index["title_order"],
+                       title.encode())
+
+@functools.lru_cache(maxsize=READER_CACHE_SIZE)
+def _open_reader(mgf_filename, size, mtime):
+    "Return a RangeReader for one version of a compressed MGF file."
+    return mgf_io.RangeReader(mgf_filename,
+                              _open_index(mgf_filename, size, mtime)["blocks"])
+
+def read_range(mgf_filename, start, end):
+    """Read the bytes [start, end) of an MGF file.  Only the blocks that
+    cover them are decompressed if the file is compressed, and the last
+    blocks read from each file are kept (see mgf_io.RangeReader)."""
+
+    if mgf_io.get_compression(mgf_filename) is None:
+        with mgf_io.open_mgf(mgf_filename) as mgf_map:
+            return mgf_map[start:end]
+    stamp = mgf_io.get_file_stamp(mgf_filename)
+    return _open_reader(os.path.abspath(mgf_filename), stamp["size"],
+                        stamp["mtime"]).read(start, end)
+
+def find_chunk_offsets(mgf_filename):
+    """Return the spectrum offsets of an MGF file that is to be read in
+    chunks by separate processes (see read).  Uncompressed files are
+    scanned, and compressed ones indexed.  Raises ValueError if the blocks
+    of a compressed file are too large to read chunks from (see
+    mgf_io.is_blocked)."""
+
+    if mgf_io.get_compression(mgf_filename) is None:
+        with mgf_io.open_mgf(mgf_filename) as mgf_map:
+            return mgf_io.find_spectra(mgf_map)
+    index = open_index(mgf_filename)
+    if not mgf_io.is_blocked(index["blocks"]):
+        raise ValueError(f"{mgf_filename} is not compressed in blocks; "
+                         + "convert it with compress_mgf.py.")
+    return index["offsets"]
+
+def read(mgf_filename, fields=None, peaks=True, dtype=np.float64, start=0,
+         end=None):
+    """Same as mgf_io.read, but a compressed file is read through its
+    index, decompressing only the blocks that cover [start, end)."""
+
+    if mgf_io.get_compression(mgf_filename) is None:
+        yield from mgf_io.read(mgf_filename, fields, peaks, dtype, start, end)
+        return
+    if end is None:
+        end = int(open_index(mgf_filename)["offsets"][-1])
+    chunk = read_range(mgf_filename, start, end)
+    offsets = mgf_io.find_spectra(chunk).tolist()
+    for block_start, block_end in zip(offsets[:-1], offsets[1:]):
+        yield mgf_io.parse_spectrum(chunk[block_start:block_end], fields,
+                                    peaks, dtype)
+
+def get_block(mgf_filename, scan=None, title=None):
+    """Return the raw bytes of the spectrum with the given scan number (or
+    title) in an MGF file.  Raises KeyError if there is no such
+    spectrum."""
+
+    index = open_index(mgf_filename)
+    position = find_spectrum(index, scan, title)
+    if position is None:
+        raise KeyError(f"{scan if title is None else title} in "
+                       + f"{mgf_filename}")
+    start, end = index["offsets"][position:position + 2].tolist()
+    return read_range(mgf_filename, start, end)
+
+def get_spectrum(mgf_filename, scan=None, title=None, fields=None,
+                 peaks=True):
+    """Read and parse the spectrum with the given scan number (or title)
+    from an MGF file, in the format of mgf_io.parse_spectrum.  Raises
+    KeyError if there is no such spectrum."""
+    return mgf_io.parse_spectrum(get_block(mgf_filename, scan, title),
+                                 fields, peaks)
+
+def build_index_star(mgf_filename):
+    "Index one MGF, and return its number of spectra."
+    return len(open_index(mgf_filename)["offsets"]) - 1
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global DESCRIPTION
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('command', choices=["build", "get"],
+                        help="Index MGFs, or print one spectrum")
+    parser.add_argument('mgfs', nargs="+", help="MGF files")
+    parser.add_argument('--scan', type=int, default=None,
+                        help="Scan number to get")
+    parser.add_argument('--title', type=str, default=None,
+                        help="Title to get")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes (default=1)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    if args.command == "get":
+        if (len(args.mgfs) != 1) or ((args.scan is None)
+                                     == (args.title is None)):
+            parser.error("get requires one MGF and either --scan or "
+                         + "--title.")
+        try:
+            block = get_block(args.mgfs[0], args.scan, args.title)
+        except KeyError as error:
+            print(f"Cannot find {error}.", file=sys.stderr)
+            sys.exit(1)
+        sys.stdout.buffer.write(block)
+        return
+
+    with instrument.stage("build_index") as my_stage:
+        pool = multiprocessing.Pool(args.workers) if args.workers > 1 \
+            else None
+        counts = (pool.imap if pool else map)(build_index_star, args.mgfs)
+        progress = instrument.Progress(len(args.mgfs), "build_index",
+                                       "files")
+        for mgf_filename, num_spectra in zip(args.mgfs, counts):
+            print(f"Indexed {num_spectra} spectra in {mgf_filename}.",
+                  file=sys.stderr)
+            my_stage.add(spectra=num_spectra,
+                         bytes=os.path.getsize(mgf_filename))
+            progress.update()
+        if pool:
+            pool.close()
+            pool.join()
+
+if __name__ == "__main__":
+    main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+import time
+
+raw_mgf = """BEGIN IONS
+TITLE=run.1.1.2 File:"run.raw", NativeID:"controllerType=0 scan=1"
+PEPMASS=500.0
+CHARGE=2+
+100.0 1.0
+END IONS
+
+BEGIN IONS\r
+TITLE=run.7.7.2 File:"run.raw", NativeID:"controllerType=0 scan=7"\r
+SCANS=70\r
+PEPMASS=600.0\r
+100.0 1.0\r
+END IONS\r
+
+BEGIN IONS
+TITLE=untitled
+PEPMASS=700.0
+200.0 1.0
+END IONS
+"""
+
+def test_index():
+    global raw_mgf
+
+    mgf_filename = os.path.join(tempfile.mkdtemp(), "run.mgf")
+    with open(mgf_filename, "w", newline="") as mgf_file:
+        mgf_file.write(raw_mgf)
+
+    index = build_index(mgf_filename)
+    assert(index["scans"].tolist() == [-1, 70, -1])
+    assert(index["title_scans"].tolist() == [1, 7, -1])
+    assert(index["titles"][2] == b"untitled")
+
+    # Lookups by SCANS, by title scan and by title.
+    assert(get_spectrum(mgf_filename, 1)['params']['pepmass'][0] == 500.0)
+    assert(get_spectrum(mgf_filename, 70)['params']['pepmass'][0] == 600.0)
+    assert(get_block(mgf_filename, title="untitled")
+           == raw_mgf[raw_mgf.index("BEGIN IONS\nTITLE=untitled"):]
+           .encode())
+    with pytest.raises(KeyError):
+        get_block(mgf_filename, 7)
+    assert(os.path.exists(mgf_filename + INDEX_SUFFIX))
+
+    # The sidecar is used while the MGF is unchanged, and rebuilt after.
+    assert(read_index(mgf_filename, mgf_io.get_file_stamp(mgf_filename))
+           is not None)
+    time.sleep(0.01)
+    with open(mgf_filename, "a") as mgf_file:
+        mgf_file.write("\nBEGIN IONS\nSCANS=9\nPEPMASS=800.0\nEND IONS\n")
+    assert(read_index(mgf_filename, mgf_io.get_file_stamp(mgf_filename))
+           is None)
+    assert(get_spectrum(mgf_filename, 9)['params']['pepmass'][0] == 800.0)
+    assert(read_index(mgf_filename, mgf_io.get_file_stamp(mgf_filename))
+           is not None)
+
+def test_compressed_index(monkeypatch):
+    global raw_mgf
+
+    # Spectra are read from the blocks of a compressed MGF that hold them.
+    monkeypatch.setattr(mgf_io, "BLOCK_SIZE", 4096)
+    mgf_dir = tempfile.mkdtemp()
+    spectra = raw_mgf.split("\n\n")[0] + "\n\n"
+    text = "".join(spectra.replace("scan=1", f"scan={scan}")
+                   for scan in range(1, 2001))
+    for extension in [".gz", ".xz"]:
+        mgf_filename = os.path.join(mgf_dir, f"run.mgf{extension}")
+        with mgf_io.open_output(mgf_filename) as mgf_file:
+            mgf_file.write(text)
+        index = open_index(mgf_filename)
+        assert(index["blocks"].shape[1] > 40)
+        assert(get_block(mgf_filename, 1234).decode()
+               == spectra.replace("scan=1", "scan=1234"))
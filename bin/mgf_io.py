@@ -0,0 +1,776 @@
+"""Fast, shared reading and writing of MGF files.
+
+Files are memory-mapped, and spectra are located by searching for
+"BEGIN IONS" at the start of a line.  Spectrum i occupies the bytes from
+its BEGIN IONS line up to the BEGIN IONS line of spectrum i + 1 (or the
+end of the file), so blocks can be copied verbatim.  Only the header
+fields that a caller asks for are parsed, and peak lists are decoded
+directly into NumPy arrays.
+
+Parsed spectra are dictionaries in the same format as pyteomics.mgf,
+i.e., with keys 'params', 'm/z array' and 'intensity array'.  Header
+keys are lowercase, PEPMASS is a tuple (m/z, intensity or None), CHARGE
+is a list of integers and RTINSECONDS is a float; all other fields are
+strings.
+
+MGF files may be compressed with gzip, bzip2, xz or Zstandard (if the
+zstandard package is installed), as given by their extension, e.g.,
+.mgf.gz.  Compressed files are decompressed as they are read, a few
+blocks at a time, by iter_chunks, so readers see the same bytes and
+offsets as for the uncompressed file without holding it in memory.
+Files written by open_output are split into independently compressed
+blocks of BLOCK_SIZE bytes, compressed by a pool of threads, and remain
+readable by the standard tools.  gzip and Zstandard blocks record their
+compressed size in a header that the standard tools skip (a gzip extra
+field, as in BGZF, or a Zstandard skippable frame), so they can be
+located without decompressing anything and decompressed in parallel.
+Blocks of other files are found by decompressing them in order.  Given
+the resulting block table (kept in the sidecar index; see mgf_index.py),
+RangeReader decompresses only the blocks that cover a byte range.
+"""
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import io
+import lzma
+import mmap
+import os
+import struct
+import zlib
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BEGIN_IONS = b"BEGIN IONS"
+END_IONS = b"END IONS"
+
+# Key = extension, value = compression.
+COMPRESSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz", ".zst": "zstd"}
+COMPRESSION_LEVELS = {"gzip": 6, "bz2": 9, "xz": 6, "zstd": 9}
+
+# Uncompressed bytes per independently compressed block.
+BLOCK_SIZE = 1 << 20
+
+# Threads used to compress or decompress blocks.
+COMPRESSION_THREADS = min(8, os.cpu_count() or 1)
+
+# A gzip member header with one extra subfield holding the compressed size
+# of the member.
+GZIP_HEADER = struct.Struct("<4sIBBH2sHI")
+GZIP_MAGIC = b"\x1f\x8b\x08\x04"
+GZIP_SUBFIELD = b"MG"
+
+# A Zstandard skippable frame holding the compressed size of the block it
+# starts, including itself.
+ZSTD_HEADER = struct.Struct("<III")
+ZSTD_MAGIC = 0x184D2A5B
+
+# Bytes fed at a time to a decompressor that cannot find block ends from
+# their headers.
+READ_SIZE = 1 << 16
+
+# Largest block that is decompressed to read a byte range.  Files written
+# by the standard tools are often one block, and should be converted (see
+# compress_mgf.py) before being read at random.
+MAX_BLOCK_SIZE = 16 * BLOCK_SIZE
+
+def get_compression(filename):
+    "Return the compression of a file, from its extension, or None."
+    return COMPRESSIONS.get(os.path.splitext(filename)[1])
+
+def strip_compression(filename):
+    "Remove the compression extension, if any, from a filename."
+    root, extension = os.path.splitext(filename)
+    return root if extension in COMPRESSIONS else filename
+
+def is_mgf(filename):
+    "Check whether a filename is that of an MGF, compressed or not."
+    return strip_compression(filename).endswith(".mgf")
+
+def glob_mgfs(mgf_dir):
+    """List the MGF files, compressed or not, in a directory (or in the
+    directories matching a glob pattern), in sorted order."""
+    return sorted(
+        mgf_filename
+        for pattern in ["*.mgf"] + [f"*.mgf{extension}"
+                                    for extension in COMPRESSIONS]
+        for mgf_filename in glob.glob(os.path.join(mgf_dir, pattern))
+    )
+
+def get_file_stamp(filename):
+    """Identify a version of a file by its size and modification time.
+    The stamp can be stored in JSON, and compared with ==."""
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def check_compression(compression):
+    "Raise ValueError if a compression cannot be used."
+    if compression not in COMPRESSION_LEVELS:
+        raise ValueError(f"Unknown compression {compression}.")
+    if (compression == "zstd") and (zstandard is None):
+        raise ValueError("Zstandard compression requires the zstandard "
+                         + "package.")
+
+def compress_block(data, compression):
+    "Compress one block so that it can be decompressed on its own."
+
+    level = COMPRESSION_LEVELS[compression]
+    if compression == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        body = compressor.compress(data) + compressor.flush()
+        size = GZIP_HEADER.size + len(body) + 8
+        return b"".join([
+            GZIP_HEADER.pack(GZIP_MAGIC, 0, 0, 255, 8, GZIP_SUBFIELD, 4,
+                             size),
+            body,
+            struct.pack("<II", zlib.crc32(data), len(data) & 0xffffffff),
+        ])
+    if compression == "bz2":
+        return bz2.compress(data, level)
+    if compression == "xz":
+        return lzma.compress(data, preset=level)
+    frame = zstandard.ZstdCompressor(level).compress(data)
+    return ZSTD_HEADER.pack(ZSTD_MAGIC, 4, ZSTD_HEADER.size + len(frame)) \
+        + frame
+
+def make_decompressor(compression):
+    "Return a decompressor object for one block."
+    if compression == "gzip":
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if compression == "bz2":
+        return bz2.BZ2Decompressor()
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    return zstandard.ZstdDecompressor().decompressobj()
+
+def decompress_block(data, compression):
+    "Decompress one complete block."
+
+    if (compression == "zstd") and (len(data) >= ZSTD_HEADER.size) and \
+       (ZSTD_HEADER.unpack_from(data)[0] == ZSTD_MAGIC):
+        data = data[ZSTD_HEADER.size:]
+    decompressor = make_decompressor(compression)
+    content = decompressor.decompress(data)
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed block.")
+    return content
+
+def get_block_size(data, position, compression):
+    """Return the compressed size recorded in the header of the block that
+    starts at position in a file written by open_output, or None if the
+    block does not record its size."""
+
+    if compression == "gzip":
+        header, magic = GZIP_HEADER, GZIP_MAGIC
+    elif compression == "zstd":
+        header, magic = ZSTD_HEADER, ZSTD_MAGIC
+    else:
+        return None
+    if position + header.size > len(data):
+        return None
+    fields = header.unpack(data[position:position + header.size])
+    if (fields[0] != magic) or \
+       ((compression == "gzip")
+        and (fields[4:7] != (8, GZIP_SUBFIELD, 4))) or \
+       ((compression == "zstd") and (fields[1] != 4)) or \
+       (fields[-1] < header.size) or (position + fields[-1] > len(data)):
+        return None
+    return fields[-1]
+
+def decompress_sized_block(data, start, end, compression):
+    "Decompress the block [start, end) of data.  Returns (end, bytes)."
+    return end, decompress_block(data[start:end], compression)
+
+def split_blocks(data, compression, position, end):
+    """Decompress concatenated blocks (gzip members, bzip2 or xz streams,
+    or Zstandard frames) from position to end in order, a piece at a
+    time.  Yields (block end or None, bytes) pairs, where the offset of
+    the end of each block is given with its last piece."""
+
+    while position < end:
+        decompressor = make_decompressor(compression)
+        while not decompressor.eof:
+            if position >= len(data):
+                raise ValueError("Truncated compressed file.")
+            piece = data[position:position + READ_SIZE]
+            position += len(piece)
+            content = decompressor.decompress(piece)
+            if decompressor.eof:
+                position -= len(decompressor.unused_data)
+                yield position, content
+            else:
+                yield None, content
+
+def iter_decompressed(data, compression, position=0, end=None,
+                      threads=None):
+    """Decompress the blocks of compressed data from offset position up to
+    offset end (both block boundaries), in order.  Yields (block end or
+    None, bytes) pairs, as split_blocks does.  Blocks that record their
+    size are decompressed whole, by a pool of threads; others are
+    decompressed in order, a piece at a time.  Either way, only a few
+    blocks are held in memory."""
+
+    check_compression(compression)
+    if end is None:
+        end = len(data)
+    threads = threads or COMPRESSION_THREADS
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        while position < end:
+            size = get_block_size(data, position, compression)
+            if size is None:
+                break
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+            pending.append(executor.submit(decompress_sized_block, data,
+                                           position, position + size,
+                                           compression))
+            position += size
+        while pending:
+            yield pending.popleft().result()
+    yield from split_blocks(data, compression, position, end)
+
+def is_blocked(blocks):
+    """Check whether the blocks of a compressed file, as given by its block
+    table, are small enough for reading byte ranges."""
+    return (blocks.shape[1] < 2) or \
+        (np.diff(blocks[1]).max() <= MAX_BLOCK_SIZE)
+
+class RangeReader:
+    """Reads byte ranges of a compressed MGF, given its block table (see
+    iter_chunks), decompressing only the blocks that cover them.  The
+    last blocks read are kept, so nearby ranges are decompressed once."""
+
+    def __init__(self, mgf_filename, blocks):
+        self.mgf_filename = mgf_filename
+        self.compression = get_compression(mgf_filename)
+        self.blocks = blocks
+        self.start = 0
+        self.content = b""
+
+    def read(self, start, end):
+        "Return the uncompressed bytes [start, end)."
+        if (start < self.start) or (end > self.start + len(self.content)):
+            first = int(np.searchsorted(self.blocks[1], start,
+                                        side="right")) - 1
+            last = max(int(np.searchsorted(self.blocks[1], end,
+                                           side="left")), first + 1)
+            offsets = self.blocks[0, first:last + 1].tolist()
+            with open(self.mgf_filename, "rb") as mgf_file:
+                mgf_file.seek(offsets[0])
+                data = mgf_file.read(offsets[-1] - offsets[0])
+            self.content = b"".join(
+                decompress_block(data[block_start - offsets[0]:
+                                      block_end - offsets[0]],
+                                 self.compression)
+                for block_start, block_end in zip(offsets[:-1], offsets[1:])
+            )
+            self.start = int(self.blocks[1, first])
+        return self.content[start - self.start:end - self.start]
+
+def read_range(mgf_filename, start, end, blocks):
+    """Read the uncompressed bytes [start, end) of a compressed MGF,
+    decompressing only the blocks that cover them (see RangeReader)."""
+    return RangeReader(mgf_filename, blocks).read(start, end)
+
+@contextlib.contextmanager
+def open_mgf(mgf_filename):
+    """Memory-map an uncompressed MGF file for reading.  Yields a
+    bytes-like object.  Compressed files are read with iter_chunks."""
+
+    if get_compression(mgf_filename) is not None:
+        raise ValueError(f"{mgf_filename} is compressed; read it with "
+                         + "iter_chunks.")
+    with open(mgf_filename, "rb") as mgf_file:
+        if os.fstat(mgf_file.fileno()).st_size == 0:
+            yield b"" # Empty files cannot be mapped.
+            return
+        with mmap.mmap(mgf_file.fileno(), 0, access=mmap.ACCESS_READ) \
+             as mgf_map:
+            yield mgf_map
+
+def iter_chunks(mgf_filename, block_ends=None, threads=None):
+    """Iterate over an MGF file in chunks that hold whole spectra.  Yields
+    (offset, bytes-like) pairs, where offset is the position of the chunk
+    in the uncompressed file.  An uncompressed file is one memory-mapped
+    chunk.  A compressed file is decompressed as it is read (see
+    iter_decompressed), and cut at the last BEGIN IONS line of each
+    block.  If block_ends is a list, the compressed and uncompressed ends
+    of each block are appended to it, giving the block table."""
+
+    compression = get_compression(mgf_filename)
+    if compression is None:
+        with open_mgf(mgf_filename) as mgf_map:
+            yield 0, mgf_map
+        return
+
+    with open(mgf_filename, "rb") as mgf_file, contextlib.ExitStack() \
+         as stack:
+        data = b""
+        if os.fstat(mgf_file.fileno()).st_size > 0:
+            data = stack.enter_context(mmap.mmap(
+                mgf_file.fileno(), 0, access=mmap.ACCESS_READ
+            ))
+        pieces = stack.enter_context(contextlib.closing(
+            iter_decompressed(data, compression, threads=threads)
+        ))
+        offset = 0
+        length = 0
+        carry = b""
+        for block_end, piece in pieces:
+            length += len(piece)
+            if (block_end is not None) and (block_ends is not None):
+                block_ends.append((block_end, length))
+            carry += piece
+            cut = carry.rfind(b"\n" + BEGIN_IONS) + 1
+            if cut > 0:
+                yield offset, carry[:cut]
+                offset += cut
+                carry = carry[cut:]
+        if len(carry) > 0:
+            yield offset, carry
+
+def get_block_table(block_ends):
+    """Convert the block ends found by iter_chunks to a block table: an
+    array whose rows are the compressed and the uncompressed offsets of
+    the blocks, followed by the ends."""
+    return np.array([[0, 0]] + list(block_ends), dtype=np.int64).T.copy()
+
+class BlockWriter(io.RawIOBase):
+    """A binary output file that compresses what is written to it in
+    independent blocks of BLOCK_SIZE bytes, using a pool of threads.
+    Blocks are written in order, and appending adds further blocks."""
+
+    def __init__(self, filename, compression, mode="wb", threads=None):
+        check_compression(compression)
+        self.compression = compression
+        self.threads = threads or COMPRESSION_THREADS
+        self.output_file = open(filename, "ab" if "a" in mode else "wb")
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.num_blocks = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            self.submit(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def submit(self, block):
+        "Compress a block, writing finished blocks to keep memory bounded."
+        if len(self.pending) >= 2 * self.threads:
+            self.output_file.write(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(compress_block, block,
+                                                 self.compression))
+        self.num_blocks += 1
+
+    def close(self):
+        if not self.closed:
+            try:
+                # Even an empty file holds a block, to be valid.
+                if self.buffer or (self.num_blocks == 0):
+                    self.submit(bytes(self.buffer))
+                    self.buffer.clear()
+                while self.pending:
+                    self.output_file.write(self.pending.popleft().result())
+            finally:
+                self.executor.shutdown()
+                self.output_file.close()
+        super().close()
+
+def open_output(filename, mode="w", buffering=-1, compression=None,
+                threads=None):
+    """Open an MGF file for writing (or appending), compressed according to
+    its extension, or to compression if given (e.g., for temporary
+    files).  Returns a file object in text or binary mode."""
+
+    if compression is None:
+        compression = get_compression(filename)
+    if compression is None:
+        return open(filename, mode, buffering=buffering)
+    binary = io.BufferedWriter(
+        BlockWriter(filename, compression, mode, threads),
+        max(buffering, io.DEFAULT_BUFFER_SIZE)
+    )
+    return binary if "b" in mode else io.TextIOWrapper(binary)
+
+def find_spectra(mgf_map, start=0, end=None):
+    """Return the byte offsets of all BEGIN IONS lines in [start, end),
+    followed by the end offset."""
+
+    if end is None:
+        end = len(mgf_map)
+    offsets = []
+    if mgf_map[start:start + len(BEGIN_IONS)] == BEGIN_IONS and \
+       (start == 0 or mgf_map[start - 1:start] == b"\n"):
+        offsets.append(start)
+    offset = mgf_map.find(b"\n" + BEGIN_IONS, start, end)
+    while offset != -1:
+        offsets.append(offset + 1)
+        offset = mgf_map.find(b"\n" + BEGIN_IONS, offset + 1, end)
+    offsets.append(end)
+    return np.array(offsets, dtype=np.int64)
+
+def count_spectra(mgf_filename):
+    "Count the spectra in an MGF file without parsing it."
+    return sum(len(find_spectra(chunk)) - 1
+               for offset, chunk in iter_chunks(mgf_filename))
+
+def iter_blocks(mgf_filename, start=0, end=None):
+    """Iterate over the raw blocks of an MGF file (or of the byte range
+    [start, end)).  Yields (offset, bytes) pairs.  A compressed file is
+    decompressed from its start; see mgf_index.py for random access."""
+
+    for offset, chunk in iter_chunks(mgf_filename):
+        if (end is not None) and (offset >= end):
+            break
+        offsets = find_spectra(
+            chunk, min(max(start - offset, 0), len(chunk)),
+            None if end is None else min(max(end - offset, 0), len(chunk))
+        )
+        for block_start, block_end in zip(offsets[:-1], offsets[1:]):
+            yield offset + int(block_start), chunk[block_start:block_end]
+
+def iter_ranges(mgf_filename, ranges):
+    """Iterate over the bytes of the given sorted (start, end) ranges of an
+    MGF file, each holding one spectrum, reading the file once."""
+
+    ranges = iter(ranges)
+    current = next(ranges, None)
+    for offset, chunk in iter_chunks(mgf_filename):
+        while (current is not None) and \
+              (current[1] <= offset + len(chunk)):
+            yield chunk[current[0] - offset:current[1] - offset]
+            current = next(ranges, None)
+        if current is None:
+            break
+
+def find_field(mgf_map, field):
+    """Iterate over the values of one header field (e.g., "SEQ") in a
+    mapped MGF file, without parsing anything else."""
+
+    key = b"\n" + field.upper().encode() + b"="
+    offset = mgf_map.find(key)
+    while offset != -1:
+        value_start = offset + len(key)
+        value_end = mgf_map.find(b"\n", value_start)
+        if value_end == -1:
+            value_end = len(mgf_map)
+        yield mgf_map[value_start:value_end].rstrip(b"\r").decode()
+        offset = mgf_map.find(key, value_end)
+
+def iter_field(mgf_filename, field):
+    "Same as find_field, but reads the MGF file."
+    for offset, chunk in iter_chunks(mgf_filename):
+        yield from find_field(chunk, field)
+
+def parse_charge(value):
+    "Convert a CHARGE value such as '2+' or '2+ and 3+' to a list of ints."
+    charges = []
+    for word in value.replace(",", " ").split():
+        if word == "and":
+            continue
+        if word.endswith("-"):
+            charges.append(-int(word[:-1]))
+        else:
+            charges.append(int(word.rstrip("+")))
+    return charges
+
+def parse_pepmass(value):
+    "Convert a PEPMASS value to a tuple (m/z, intensity or None)."
+    words = value.split()
+    return (float(words[0]), float(words[1]) if len(words) > 1 else None)
+
+PARSERS = {
+    "pepmass": parse_pepmass,
+    "charge": parse_charge,
+    "rtinseconds": float,
+}
+
+def parse_peaks(peak_bytes, dtype=np.float64):
+    "Decode the peak lines of a spectrum into m/z and intensity arrays."
+
+    first_line = peak_bytes[:peak_bytes.find(b"\n")]
+    num_columns = len(first_line.split())
+    if num_columns == 0:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=dtype)
+    values = np.fromstring(peak_bytes, dtype=np.float64, sep=" ")
+    if num_columns != 2 or len(values) != 2 * peak_bytes.count(b"\n"):
+        # Some lines have a third (charge) column, which is ignored.
+        values = np.array([
+            float(word) for line in peak_bytes.splitlines()
+            for word in line.split()[:2]
+        ], dtype=np.float64)
+    values = values.reshape(-1, 2)
+    return values[:, 0].astype(dtype), values[:, 1].astype(dtype)
+
+def parse_spectrum(block, fields=None, peaks=True, dtype=np.float64):
+    """Parse one raw spectrum block.  If fields is given, then only those
+    (lowercase) header fields are stored.  If peaks is False, then the
+    peak arrays are not decoded."""
+
+    block = bytes(block)
+    end = block.find(b"\n" + END_IONS)
+    if end == -1:
+        raise ValueError("Missing END IONS in spectrum.")
+    end += 1
+
+    # Parse the header.
+    params = {}
+    line_start = block.find(b"\n") + 1
+    while line_start < end:
+        line_end = block.find(b"\n", line_start)
+        line = block[line_start:line_end]
+        if line[:1].isdigit():
+            break
+        line_start = line_end + 1
+        equals = line.find(b"=")
+        if equals == -1:
+            continue
+        key = line[:equals].decode().lower()
+        if (fields is None) or (key in fields):
+            value = line[equals + 1:].rstrip(b"\r").decode()
+            params[key] = PARSERS[key](value) if key in PARSERS else value
+
+    spectrum = {'params': params}
+    if peaks:
+        spectrum['m/z array'], spectrum['intensity array'] = \
+            parse_peaks(block[line_start:end], dtype)
+    return spectrum
+
+def read(mgf_filename, fields=None, peaks=True, dtype=np.float64,
+         start=0, end=None):
+    """Iterate over the spectra in an MGF file (or in the byte range
+    [start, end)), parsing only the requested header fields."""
+
+    for offset, block in iter_blocks(mgf_filename, start, end):
+        yield parse_spectrum(block, fields, peaks, dtype)
+
+def format_param(key, value):
+    "Format one header field for output."
+    if key == "pepmass":
+        if value[1] is None:
+            return f"{value[0]}"
+        return f"{value[0]} {value[1]}"
+    if key == "charge":
+        return " and ".join(f"{abs(charge)}{'+' if charge > 0 else '-'}"
+                            for charge in value)
+    return f"{value}"
+
+# Header fields written first, in this order, as by pyteomics.mgf.write.
+KEY_ORDER = ("title", "pepmass", "rtinseconds", "charge")
+
+def write_spectrum(output_file, spectrum):
+    """Write a spectrum to an open text file, formatted in the same way as
+    pyteomics.mgf.write."""
+
+    params = spectrum['params']
+    lines = ["BEGIN IONS\n"]
+    for key in [key for key in KEY_ORDER if key in params] \
+            + [key for key in params if key not in KEY_ORDER]:
+        lines.append(f"{key.upper()}={format_param(key, params[key])}\n")
+    for mz, intensity in zip(spectrum['m/z array'].tolist(),
+                             spectrum['intensity array'].tolist()):
+        lines.append(f"{mz} {intensity} \n")
+    lines.append("END IONS\n\n")
+    output_file.write("".join(lines))
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+import io
+import gzip
+import sys
+import pyteomics.mgf
+
+two_spectra = """HEADER=ignored
+BEGIN IONS
+TITLE=first
+PEPMASS=561.798400878906
+RTINSECONDS=832.4328
+CHARGE=2+
+SCANS=2475
+SEQ=VVQEQGTHPK
+100.0757 10
+147.1124878 10.5
+END IONS
+
+BEGIN IONS
+TITLE=second
+PEPMASS=828.3374 1234.5
+CHARGE=2+ and 3+
+SEQ=C+57.021ANFDNQDNNHYNHNHNQAR
+120.080719 11572.1962890625 1
+126.0542755 2370.3344726563
+END IONS
+"""
+
+def test_read():
+    global two_spectra
+
+    my_tempfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    my_tempfile.write(two_spectra)
+    my_tempfile.close()
+
+    assert(count_spectra(my_tempfile.name) == 2)
+    assert(list(iter_field(my_tempfile.name, "SEQ"))
+           == ["VVQEQGTHPK", "C+57.021ANFDNQDNNHYNHNHNQAR"])
+
+    spectra = list(read(my_tempfile.name))
+    assert(spectra[0]['params'] == {
+        'title': "first", 'pepmass': (561.798400878906, None),
+        'rtinseconds': 832.4328, 'charge': [2], 'scans': "2475",
+        'seq': "VVQEQGTHPK"
+    })
+    assert(spectra[1]['params']['pepmass'] == (828.3374, 1234.5))
+    assert(spectra[1]['params']['charge'] == [2, 3])
+    assert(spectra[0]['m/z array'].tolist() == [100.0757, 147.1124878])
+    assert(spectra[0]['intensity array'].tolist() == [10, 10.5])
+    assert(spectra[1]['intensity array'].tolist()
+           == [11572.1962890625, 2370.3344726563])
+
+    # Only the requested fields are parsed.
+    spectra = list(read(my_tempfile.name, fields=("seq",), peaks=False,
+                        start=two_spectra.index("BEGIN IONS\nTITLE=second")))
+    assert(spectra == [{'params': {'seq': "C+57.021ANFDNQDNNHYNHNHNQAR"}}])
+
+    # Blocks cover the file from the first BEGIN IONS to the end.
+    blocks = list(iter_blocks(my_tempfile.name))
+    assert(b"".join(block for offset, block in blocks)
+           == two_spectra[two_spectra.index("BEGIN"):].encode())
+
+def test_write():
+    global two_spectra
+
+    # The output is the same as that of pyteomics.mgf.write.
+    my_tempfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    my_tempfile.write(two_spectra)
+    my_tempfile.close()
+    output = io.StringIO()
+    for spectrum in read(my_tempfile.name):
+        write_spectrum(output, spectrum)
+    assert(output.getvalue().split("END IONS\n\n")[0] == """BEGIN IONS
+TITLE=first
+PEPMASS=561.798400878906
+RTINSECONDS=832.4328
+CHARGE=2+
+SCANS=2475
+SEQ=VVQEQGTHPK
+""" + "100.0757 10.0 \n147.1124878 10.5 \n")
+
+    # Round trip.
+    with open(my_tempfile.name, "w") as mgf_file:
+        mgf_file.write(output.getvalue())
+    output2 = io.StringIO()
+    for spectrum in read(my_tempfile.name):
+        write_spectrum(output2, spectrum)
+    assert(output.getvalue() == output2.getvalue())
+
+def test_write_key_order():
+
+    # ThermoRawFileParser field order is rewritten as by pyteomics.
+    thermo_mgf = """BEGIN IONS
+TITLE=run.7.7.2 File:"run.raw", NativeID:"controllerType=0 scan=7"
+SCANS=7
+RTINSECONDS=832.4328
+PEPMASS=561.798400878906 1234.5
+CHARGE=2+
+SEQ=VVQEQGTHPK
+100.0757 10.0
+147.1124878 10.5
+END IONS
+"""
+    my_tempfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    my_tempfile.write(thermo_mgf)
+    my_tempfile.close()
+    output = io.StringIO()
+    for spectrum in read(my_tempfile.name):
+        write_spectrum(output, spectrum)
+    expected = io.StringIO()
+    with pyteomics.mgf.read(my_tempfile.name, use_index=False) as reader:
+        pyteomics.mgf.write(reader, expected)
+    assert(output.getvalue() == expected.getvalue())
+    assert(output.getvalue().startswith("BEGIN IONS\nTITLE=run.7.7.2"))
+
+def read_chunks(mgf_filename):
+    "Return the chunks of an MGF file, and its block table."
+    block_ends = []
+    chunks = [(offset, bytes(chunk))
+              for offset, chunk in iter_chunks(mgf_filename, block_ends)]
+    return chunks, get_block_table(block_ends)
+
+@pytest.mark.parametrize("extension", list(COMPRESSIONS))
+def test_compressed(extension, monkeypatch):
+    global two_spectra
+
+    if (COMPRESSIONS[extension] == "zstd") and (zstandard is None):
+        pytest.skip("zstandard is not installed")
+    monkeypatch.setattr(sys.modules[__name__], "BLOCK_SIZE", 100)
+    mgf_filename = os.path.join(tempfile.mkdtemp(), f"a.mgf{extension}")
+    assert(is_mgf(mgf_filename) and (strip_compression(mgf_filename)
+                                     == mgf_filename[:-len(extension)]))
+    with open_output(mgf_filename) as mgf_file:
+        mgf_file.write(two_spectra)
+
+    # Readers see the uncompressed bytes, which are split into blocks and
+    # into chunks of whole spectra.
+    assert(count_spectra(mgf_filename) == 2)
+    assert(list(iter_field(mgf_filename, "SEQ"))
+           == ["VVQEQGTHPK", "C+57.021ANFDNQDNNHYNHNHNQAR"])
+    second = two_spectra.index("BEGIN IONS\nTITLE=second")
+    chunks, blocks = read_chunks(mgf_filename)
+    content = two_spectra.encode()
+    assert([offset for offset, chunk in chunks]
+           == [0, two_spectra.index("BEGIN"), second])
+    assert(b"".join(chunk for offset, chunk in chunks) == content)
+    assert(blocks[1].tolist() == list(range(0, len(content), 100))
+           + [len(content)])
+    assert(is_blocked(blocks))
+    assert(read_range(mgf_filename, 150, 420, blocks) == content[150:420])
+    assert([offset for offset, block in iter_blocks(mgf_filename, second)]
+           == [second])
+    assert(list(iter_ranges(mgf_filename, [(second, len(content))]))
+           == [content[second:]])
+    with pytest.raises(ValueError):
+        with open_mgf(mgf_filename) as mgf_map:
+            pass
+
+    # Appending adds blocks.
+    with open_output(mgf_filename, "ab") as mgf_file:
+        mgf_file.write(b"\n")
+    assert(b"".join(chunk for offset, chunk in read_chunks(mgf_filename)[0])
+           == content + b"\n")
+
+def test_standard_gzip(monkeypatch):
+    global two_spectra
+
+    # Blocked gzip files are read by the standard tools, and files written
+    # by the standard tools are read, in one block.
+    mgf_filename = os.path.join(tempfile.mkdtemp(), "a.mgf.gz")
+    with open_output(mgf_filename) as mgf_file:
+        mgf_file.write(two_spectra)
+    with gzip.open(mgf_filename, "rt") as mgf_file:
+        assert(mgf_file.read() == two_spectra)
+    with gzip.open(mgf_filename, "wt") as mgf_file:
+        mgf_file.write(two_spectra)
+    monkeypatch.setattr(sys.modules[__name__], "READ_SIZE", 50)
+    chunks, blocks = read_chunks(mgf_filename)
+    assert(b"".join(chunk for offset, chunk in chunks)
+           == two_spectra.encode())
+    assert(blocks.shape == (2, 2))
+
+    # Such a block is too large to read ranges from.
+    monkeypatch.setattr(sys.modules[__name__], "MAX_BLOCK_SIZE", 100)
+    assert(not is_blocked(blocks))
@@ -0,0 +1,223 @@
+"""A compact table of the distinct peptides in a benchmark.
+
+Each peptide is interned once and given an integer ID, in order of first
+appearance.  The species that contain a peptide are stored as a bitmask
+(one bit per species, up to 64 species) in a NumPy uint64 array indexed
+by ID, and the species to which a peptide is finally assigned is stored
+in a small integer array.  This avoids keeping a Python list of species
+names for every peptide, and lets peptides be grouped by species in one
+pass.
+"""
+import hashlib
+import numpy as np
+import mgf_io
+import spectrum_store
+
+MAX_SPECIES = 64
+UNASSIGNED = -1
+
+def iter_seqs(mgf_filename):
+    "Iterate over the SEQ fields of an MGF file or spectrum store."
+    if spectrum_store.is_store(mgf_filename):
+        return spectrum_store.iter_field(
+            spectrum_store.open_store(mgf_filename), "seq"
+        )
+    return mgf_io.iter_field(mgf_filename, "SEQ")
+
+def choose_species(peptide, species_list, seed):
+    """Select one of several species for a shared peptide (or for a group
+    of leaking peptides, represented by one of them), using a hash of the
+    seed and the peptide.  The choice does not depend on the order of the
+    species."""
+
+    digest = hashlib.blake2b(f"{seed}:{peptide}".encode(),
+                             digest_size=8).digest()
+    species_list = sorted(species_list)
+    return species_list[int.from_bytes(digest, "little") % len(species_list)]
+
+class PeptideTable:
+    """Distinct peptides, with the species that contain them.  After a
+    call to assign(), the table can be used as a read-only mapping from
+    peptide to assigned species name."""
+
+    def __init__(self, species_list):
+        if len(species_list) > MAX_SPECIES:
+            raise ValueError(f"At most {MAX_SPECIES} species are supported.")
+        self.species = list(species_list)
+        self.species_index = {species: index for index, species
+                              in enumerate(self.species)}
+        self.ids = {} # Key = peptide, value = ID
+        self.peptides = [] # Indexed by ID
+        self.masks = np.zeros(1024, dtype=np.uint64)
+        self.owners = None
+
+    def __len__(self):
+        return len(self.peptides)
+
+    def add(self, peptides, species):
+        "Record that the given peptides occur in the given species."
+
+        bit = np.uint64(1) << np.uint64(self.species_index[species])
+        new_ids = []
+        for peptide in peptides:
+            peptide_id = self.ids.get(peptide)
+            if peptide_id is None:
+                peptide_id = len(self.peptides)
+                self.ids[peptide] = peptide_id
+                self.peptides.append(peptide)
+            new_ids.append(peptide_id)
+        if len(self.peptides) > len(self.masks):
+            self.masks = np.concatenate((
+                self.masks,
+                np.zeros(max(len(self.peptides), len(self.masks)) * 2
+                         - len(self.masks), dtype=np.uint64)
+            ))
+        self.masks[np.array(new_ids, dtype=np.int64)] |= bit
+        self.owners = None
+
+    def add_files(self, mgf_filenames, species, clean_peptide):
+        "Add the (cleaned) peptides from a list of MGFs or spectrum stores."
+        for mgf_filename in mgf_filenames:
+            self.add((clean_peptide(seq) for seq in iter_seqs(mgf_filename)),
+                     species)
+
+    def remove(self, peptides, species):
+        """Record that the given peptides should not be taken from the given
+        species.  Peptides that are not in the table are ignored."""
+
+        bit = np.uint64(1) << np.uint64(self.species_index[species])
+        ids = [self.ids[peptide] for peptide in peptides
+               if peptide in self.ids]
+        self.masks[np.array(ids, dtype=np.int64)] &= ~bit
+        self.owners = None
+
+    def species_counts(self):
+        "Return the number of species that contain each peptide."
+        masks = self.masks[:len(self)]
+        counts = np.zeros(len(self), dtype=np.int64)
+        for index in range(len(self.species)):
+            counts += ((masks >> np.uint64(index)) & np.uint64(1)) \
+                .astype(np.int64)
+        return counts
+
+    def species_of(self, peptide):
+        "List the species that contain a peptide, in species-list order."
+        mask = int(self.masks[self.ids[peptide]])
+        return [species for index, species in enumerate(self.species)
+                if mask >> index & 1]
+
+    def assign(self, choose_species=None):
+        """Assign each peptide to one species.  Peptides found in a single
+        species are assigned to it; for the others, choose_species(peptide,
+        species_list) selects one.  Peptides that have been removed from
+        every species stay unassigned.  Returns the number of shared
+        peptides."""
+
+        self.owners = np.full(len(self), UNASSIGNED, dtype=np.int8)
+        masks = self.masks[:len(self)]
+        for index in range(len(self.species)):
+            self.owners[masks == np.uint64(1) << np.uint64(index)] = index
+        shared = np.flatnonzero(self.species_counts() > 1).tolist()
+        for peptide_id in shared:
+            peptide = self.peptides[peptide_id]
+            self.owners[peptide_id] = self.species_index[
+                choose_species(peptide, self.species_of(peptide))
+            ]
+        return len(shared)
+
+    def group_by_species(self):
+        """Return a dictionary from species name to the list of peptides
+        assigned to it (or contained in it, if assign() has not been
+        called), in order of first appearance."""
+
+        if self.owners is None:
+            masks = self.masks[:len(self)]
+            return {
+                species: [self.peptides[peptide_id] for peptide_id in
+                          np.flatnonzero(masks & (np.uint64(1)
+                                                  << np.uint64(index)))]
+                for index, species in enumerate(self.species)
+            }
+        order = np.argsort(self.owners, kind="stable")
+        bounds = np.searchsorted(self.owners[order],
+                                 np.arange(len(self.species) + 1))
+        return {
+            species: [self.peptides[peptide_id] for peptide_id
+                      in order[bounds[index]:bounds[index + 1]].tolist()]
+            for index, species in enumerate(self.species)
+        }
+
+    def __getitem__(self, peptide):
+        """Return the species to which a peptide is assigned, or None if it
+        was removed from every species."""
+        owner = self.owners[self.ids[peptide]]
+        return None if owner == UNASSIGNED else self.species[owner]
+
+    def __contains__(self, peptide):
+        return peptide in self.ids
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+
+def test_choose_species():
+
+    # The choice depends only on the peptide, the seed and the set of
+    # species.
+    assert(choose_species("PEPTLDEK", ["yeast", "human"], 7718)
+           == choose_species("PEPTLDEK", ["human", "yeast"], 7718))
+    choices = {choose_species(f"PEPTIDE{i}", ["yeast", "human"], 7718)
+               for i in range(100)}
+    assert(choices == {"yeast", "human"})
+
+def test_peptide_table():
+
+    table = PeptideTable(["yeast", "human", "mouse"])
+    table.add(["PEPTLDEK", "LLQNAYK", "PEPTLDEK"], "yeast")
+    table.add(["AAAK", "LLQNAYK"], "human")
+    table.add(["LLQNAYK", "CCCK"], "mouse")
+    assert(len(table) == 4)
+    assert(table.species_of("LLQNAYK") == ["yeast", "human", "mouse"])
+    assert(table.species_counts().tolist() == [1, 3, 1, 1])
+    assert(table.group_by_species() == {
+        "yeast": ["PEPTLDEK", "LLQNAYK"],
+        "human": ["LLQNAYK", "AAAK"],
+        "mouse": ["LLQNAYK", "CCCK"],
+    })
+
+    # Shared peptides are assigned by the callback.
+    assert(table.assign(lambda peptide, species_list: species_list[-1]) == 1)
+    assert(table["LLQNAYK"] == "mouse")
+    assert(table["AAAK"] == "human")
+    assert(table.group_by_species() == {
+        "yeast": ["PEPTLDEK"],
+        "human": ["AAAK"],
+        "mouse": ["LLQNAYK", "CCCK"],
+    })
+    with pytest.raises(KeyError):
+        table["MISSING"]
+
+    # Removed peptides are assigned among the remaining species, if any.
+    table.remove(["LLQNAYK", "MISSING"], "mouse")
+    table.remove(["CCCK"], "mouse")
+    assert(table.assign(lambda peptide, species_list: species_list[-1]) == 1)
+    assert(table["LLQNAYK"] == "human")
+    assert(table["CCCK"] is None)
+    assert(table.group_by_species()["mouse"] == [])
+
+def test_growth():
+
+    # More peptides than the initial capacity.
+    table = PeptideTable(["yeast", "human"])
+    table.add((f"PEPTIDE{i}" for i in range(3000)), "yeast")
+    table.add((f"PEPTIDE{i}" for i in range(2000, 5000)), "human")
+    assert(len(table) == 5000)
+    assert(table.species_counts().sum() == 6000)
+    table.assign(lambda peptide, species_list: species_list[0])
+    groups = table.group_by_species()
+    assert(len(groups["yeast"]) == 3000)
+    assert(len(groups["human"]) == 2000)
+
+    with pytest.raises(ValueError):
+        PeptideTable([f"species{i}" for i in range(MAX_SPECIES + 1)])
@@ -0,0 +1,217 @@
+"""Parsing and rendering of modified peptides, shared by all scripts.
+
+The pipeline writes peptides in three formats:
+
+ o Tide, as in the Percolator output and the annotated MGFs, e.g.,
+   "M[15.9949]PEPTCK" or "H[43.0058]HVLK", where carbamidomethylation of
+   cysteine is a fixed modification that is not written, and N-terminal
+   modifications follow the first residue;
+ o Casanovo, as in the cleaned MGFs, e.g., "M+15.995PEPTC+57.021K" or
+   "+43.006HHVLK"; and
+ o ProForma, as used by spectrum_utils, e.g., "M[+15.9949]PEPTC[+57.021]K"
+   or "[+43.006]-HHVLK".
+
+A peptide in any of these formats is tokenized by one compiled grammar
+into a Peptide: its residues, plus the positions (-1 for the N-terminus)
+and Modifications of its PTMs.  From that structure, convert() renders
+any format, including the stripped sequence and the stripped sequence
+with isoleucines changed to leucines.  Both parse() and convert() are
+memoized, so each distinct SEQ value is parsed once per process.
+"""
+import collections
+import functools
+import re
+
+# Number of distinct (peptide, format) pairs to remember.
+PEPTIDE_CACHE_SIZE = 1 << 20
+
+FORMATS = ["tide", "casanovo", "proforma", "stripped", "i2l"]
+
+Modification = collections.namedtuple(
+    "Modification", ["name", "mass", "tide", "casanovo", "proforma", "nterm"]
+)
+Peptide = collections.namedtuple("Peptide", ["residues", "positions", "mods"])
+
+def make_modification(name, tide, casanovo, proforma, nterm=False):
+    "The mass of a modification is that of its ProForma representation."
+    return Modification(name, float(proforma), tide, casanovo, proforma,
+                        nterm)
+
+# The modifications searched by Tide.  Carbamidomethylation has no Tide
+# representation because it is a fixed modification.
+MODIFICATIONS = [
+    make_modification("Carbamidomethyl", "", "+57.021", "+57.021"),
+    make_modification("Oxidation", "15.9949", "+15.995", "+15.9949"),
+    make_modification("Deamidated", "0.9840", "+0.984", "+0.9840"),
+    make_modification("Acetyl", "42.0106", "+42.011", "+42.011", True),
+    make_modification("Carbamyl", "43.0058", "+43.006", "+43.006", True),
+    make_modification("Ammonia-loss", "-17.0265", "-17.027", "-17.027",
+                      True),
+    make_modification("Carbamyl+Ammonia-loss", "25.9803", "+43.006-17.027",
+                      "+25.980", True),
+]
+MODIFICATIONS_BY_NAME = {mod.name: mod for mod in MODIFICATIONS}
+
+# Key = mass as written in any format (without a "+" sign), value =
+# modification.
+MODIFICATION_MASSES = {"57.0215": MODIFICATIONS_BY_NAME["Carbamidomethyl"],
+                       "57.02146": MODIFICATIONS_BY_NAME["Carbamidomethyl"],
+                       "25.98": MODIFICATIONS_BY_NAME["Carbamyl+Ammonia-loss"]}
+for mod in MODIFICATIONS:
+    for value in (mod.tide, mod.proforma, mod.casanovo):
+        if re.fullmatch(r"[+-]?[0-9.]+", value):
+            MODIFICATION_MASSES[value.lstrip("+")] = mod
+
+# A residue, a bracketed modification (Tide or ProForma, with a trailing
+# "-" for a ProForma N-terminal modification) or a signed modification
+# (Casanovo).
+TOKEN_REGEX = re.compile(r"([A-Z])|\[([+-]?[0-9.]+)\](-?)|([+-][0-9.]+)")
+
+def get_modification(value):
+    """Look up a modification by its mass, as written in a peptide.
+    Unknown masses give a new Modification that is rendered as written."""
+
+    mod = MODIFICATION_MASSES.get(value.lstrip("+"))
+    if mod is not None:
+        return mod
+    signed = value if value[0] in "+-" else f"+{value}"
+    return make_modification(None, value.lstrip("+"), f"[{value}]", signed)
+
+@functools.lru_cache(maxsize=PEPTIDE_CACHE_SIZE)
+def parse(peptide, input_format="casanovo"):
+    """Parse a peptide in Tide, Casanovo or ProForma format into a
+    Peptide.  The format matters only for cysteines without a written
+    modification, which are carbamidomethylated in Tide format.  Raises
+    ValueError if the peptide cannot be parsed."""
+
+    residues = []
+    positions = []
+    mods = []
+    end = 0
+    for match in TOKEN_REGEX.finditer(peptide):
+        if match.start() != end:
+            break
+        end = match.end()
+        residue, bracketed, nterm, signed = match.groups()
+        if residue:
+            residues.append(residue)
+            continue
+        mod = get_modification(bracketed or signed)
+        positions.append(-1 if (mod.nterm or nterm or not residues)
+                         else len(residues) - 1)
+        mods.append(mod)
+    if end != len(peptide):
+        raise ValueError(f"Cannot parse peptide {peptide}.")
+
+    # Casanovo writes the combined N-terminal modification as two.
+    nterm_mods = [mod.name for position, mod in zip(positions, mods)
+                  if position == -1]
+    if sorted(nterm_mods) == ["Ammonia-loss", "Carbamyl"]:
+        mods = [mod for position, mod in zip(positions, mods)
+                if position != -1]
+        positions = [position for position in positions if position != -1]
+        positions.insert(0, -1)
+        mods.insert(0, MODIFICATIONS_BY_NAME["Carbamyl+Ammonia-loss"])
+
+    # Add Tide's fixed modification.
+    if input_format == "tide":
+        modified = {position for position, mod in zip(positions, mods)
+                    if mod.name == "Carbamidomethyl"}
+        for position, residue in enumerate(residues):
+            if (residue == "C") and (position not in modified):
+                positions.append(position)
+                mods.append(MODIFICATIONS_BY_NAME["Carbamidomethyl"])
+
+    order = sorted(range(len(mods)), key=lambda index: positions[index])
+    return Peptide("".join(residues), tuple(positions[index]
+                                            for index in order),
+                   tuple(mods[index] for index in order))
+
+def render(peptide, output_format):
+    "Write a Peptide in one of FORMATS."
+
+    if output_format == "stripped":
+        return peptide.residues
+    if output_format == "i2l":
+        return peptide.residues.replace("I", "L")
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown peptide format {output_format}.")
+
+    nterm_mods = []
+    residues = list(peptide.residues)
+    for position, mod in zip(peptide.positions, peptide.mods):
+        if position == -1:
+            nterm_mods.append(mod)
+        elif output_format == "tide":
+            residues[position] += f"[{mod.tide}]" if mod.tide else ""
+        elif output_format == "casanovo":
+            residues[position] += mod.casanovo
+        else:
+            residues[position] += f"[{mod.proforma}]"
+
+    if output_format == "casanovo":
+        return "".join(mod.casanovo for mod in nterm_mods) + "".join(residues)
+    if output_format == "proforma":
+        return "".join(f"[{mod.proforma}]-" for mod in nterm_mods) \
+            + "".join(residues)
+
+    # Tide writes N-terminal modifications after the first residue.
+    if residues:
+        residues[0] += "".join(f"[{mod.tide}]" for mod in nterm_mods)
+    return "".join(residues)
+
+@functools.lru_cache(maxsize=PEPTIDE_CACHE_SIZE)
+def convert(peptide, output_format, input_format="casanovo"):
+    """Convert a peptide from one format to another (see FORMATS).  The
+    stripped formats do not depend on the input format."""
+    return render(parse(peptide, input_format), output_format)
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+
+def test_parse():
+
+    peptide = parse("I[43.0058]IQ[0.9840]CN[0.9840]AYK", "tide")
+    assert(peptide.residues == "IIQCNAYK")
+    assert(peptide.positions == (-1, 2, 3, 4))
+    assert([mod.name for mod in peptide.mods]
+           == ["Carbamyl", "Deamidated", "Carbamidomethyl", "Deamidated"])
+    assert(peptide.mods[1].mass == 0.984)
+
+    # The same peptide, written in every format.
+    for text, input_format in [("I[43.0058]IQ[0.9840]CN[0.9840]AYK", "tide"),
+                               ("+43.006IIQ+0.984C+57.021N+0.984AYK",
+                                "casanovo"),
+                               ("[+43.006]-IIQ[+0.9840]C[+57.021]N[+0.9840]"
+                                + "AYK", "proforma")]:
+        assert(parse(text, input_format) == peptide)
+        assert(convert(text, input_format, input_format) == text)
+
+    # Only Tide peptides have implicit modifications.
+    assert(parse("PEPTCK").mods == ())
+    with pytest.raises(ValueError):
+        parse("PEP[TIDE")
+
+def test_convert():
+
+    # Conversions made by clean-benchmark.py, then match_by.py.
+    for tide, casanovo, proforma in [
+            ("H[43.0058]HVLHHQTVDK", "+43.006HHVLHHQTVDK",
+             "[+43.006]-HHVLHHQTVDK"),
+            ("M[15.9949][25.9803]CPEPTIDEK", "+43.006-17.027M+15.995C+57.021"
+             + "PEPTIDEK", "[+25.980]-M[+15.9949]C[+57.021]PEPTIDEK"),
+            ("A[-17.0265]S[79.9663]K", "-17.027AS[79.9663]K",
+             "[-17.027]-AS[+79.9663]K"),
+            ("VVQEQGTHPK", "VVQEQGTHPK", "VVQEQGTHPK")]:
+        assert(convert(tide, "casanovo", "tide") == casanovo)
+        assert(convert(casanovo, "proforma") == proforma)
+        assert(convert(proforma, "tide", "proforma") == tide)
+        for text, input_format in [(tide, "tide"), (casanovo, "casanovo"),
+                                   (proforma, "proforma")]:
+            assert(convert(text, "stripped", input_format)
+                   == re.sub(r"[0-9\.\[\]\+\-]+", "", text))
+    assert(convert("+43.006IIQ+0.984N+0.984AYK", "i2l") == "LLQNAYK")
+    with pytest.raises(ValueError):
+        convert("PEPTIDE", "mzTab")
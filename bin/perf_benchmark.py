@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# CREATE DATE: 18 Oct 2026
+import sys
+import argparse
+import contextlib
+import datetime
+import glob
+import importlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import annotate_mgf
+import downsample_benchmark
+import instrument
+import make_synthetic_benchmark
+import match_by
+import mgf_io
+import summarize_benchmark
+clean_benchmark = importlib.import_module("clean-benchmark")
+
+DESCRIPTION = """Time the stages of the benchmark pipeline on synthetic
+data (see make_synthetic_benchmark.py) of one or more sizes, and write
+the timings to a JSON file.
+
+For each size, the stages are run in pipeline order: annotate_mgf.py,
+summarize_benchmark.py, both passes of clean-benchmark.py (parse and
+block copy), downsample_benchmark.py (by spectrum), and
+get_percent_matched over the cleaned spectra, both directly and through
+match_by.py.  Each stage is timed as a function call, without the cost
+of starting Python, and the best of --repeats runs is reported.
+
+With --baseline, the timings are compared to those in an earlier JSON
+file, e.g., from another commit."""
+
+def get_commit():
+    "Return the current git commit, or None outside a git checkout."
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def time_call(function, repeats=1):
+    """Call a function repeatedly, hiding its progress messages.  Returns
+    the shortest time in seconds."""
+
+    best = None
+    for repeat in range(repeats):
+        with contextlib.redirect_stderr(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def run_size(work_dir, num_spectra, num_peaks=100, workers=1, repeats=1,
+             seed=7718):
+    """Generate a dataset of num_spectra spectra and time every stage on it.
+    Returns a list of result dictionaries."""
+
+    data_dir = os.path.join(work_dir, f"synthetic-{num_spectra}")
+    results = []
+    def record(task, seconds):
+        results.append({"task": task, "num_spectra": num_spectra,
+                        "seconds": seconds,
+                        "spectra_per_second": num_spectra / seconds})
+        print(f"{task}: {num_spectra} spectra in {seconds:.3f}s.",
+              file=sys.stderr)
+
+    species_list = []
+    record("make_synthetic_benchmark", time_call(lambda: species_list.extend(
+        make_synthetic_benchmark.make_benchmark(data_dir, num_spectra,
+                                                num_peaks=num_peaks,
+                                                seed=seed)
+    )))
+    mgf_filenames = {species: sorted(glob.glob(os.path.join(data_dir, "data",
+                                                            species, "*.mgf")))
+                     for species in species_list}
+
+    # Annotate.
+    annotated_dir = os.path.join(data_dir, "annotated")
+    def annotate():
+        shutil.rmtree(annotated_dir, ignore_errors=True)
+        for species in species_list:
+            annotate_mgf.annotate_batch(
+                [0.01], os.path.join(data_dir, species, "percolator.log.txt"),
+                os.path.join(data_dir, species,
+                             "percolator.target.psms.txt"),
+                mgf_filenames[species], os.path.join(annotated_dir, species),
+                min_psms=0, workers=workers
+            )
+    record("annotate_mgf", time_call(annotate, repeats))
+    annotated_filenames = {
+        species: sorted(glob.glob(os.path.join(annotated_dir, species,
+                                               "*.mgf")))
+        for species in species_list
+    }
+
+    # Summarize.
+    def summarize():
+        stats = summarize_benchmark.gather_stats(
+            [mgf_filename for species in species_list
+             for mgf_filename in mgf_filenames[species]
+             + annotated_filenames[species]], None, workers
+        )
+        for species in species_list:
+            summarize_benchmark.count_peptides(
+                [stats[mgf_filename]["peptides"]
+                 for mgf_filename in annotated_filenames[species]],
+                os.path.join(annotated_dir, species, "peptides.txt")
+            )
+    record("summarize_benchmark", time_call(summarize, repeats))
+
+    # Clean, by parsing and by block copying.
+    cleaned_dir = os.path.join(data_dir, "cleaned")
+    for task, block_copy in (("clean_benchmark.parse", False),
+                             ("clean_benchmark.block_copy", True)):
+        def clean():
+            shutil.rmtree(cleaned_dir, ignore_errors=True)
+            clean_benchmark.clean_benchmark(annotated_dir, cleaned_dir, True,
+                                            block_copy, workers, seed)
+        record(task, time_call(clean, repeats))
+    cleaned_filenames = sorted(glob.glob(os.path.join(cleaned_dir, "*",
+                                                      "*.mgf")))
+
+    # Downsample to half of the spectra of each species.
+    balanced_dir = os.path.join(data_dir, "balanced")
+    def downsample():
+        shutil.rmtree(balanced_dir, ignore_errors=True)
+        for species in species_list:
+            species_filenames = sorted(glob.glob(os.path.join(
+                cleaned_dir, species, "*.mgf"
+            )))
+            os.makedirs(os.path.join(balanced_dir, species))
+            sample = downsample_benchmark.sample_spectra(
+                species_filenames, num_spectra // (2 * len(species_list)),
+                ["charge"]
+            )
+            downsample_benchmark.write_sample(
+                species_filenames, sample, os.path.join(balanced_dir, species)
+            )
+    record("downsample_benchmark.by_spectrum", time_call(downsample, repeats))
+
+    # Percent matched, on spectra that are already parsed, and end to end.
+    spectra = [spectrum for mgf_filename in cleaned_filenames
+               for spectrum in mgf_io.read(mgf_filename)]
+    def percent_matched():
+        match_by.get_theoretical_fragments.cache_clear()
+        for spectrum in spectra:
+            match_by.get_percent_matched(spectrum)
+    record("get_percent_matched", time_call(percent_matched, repeats))
+    match_by_output = os.path.join(data_dir, "match_by.txt")
+    def write_percent_matched():
+        for filename in (match_by_output, f"{match_by_output}.checkpoint"):
+            if os.path.exists(filename):
+                os.remove(filename)
+        match_by.get_theoretical_fragments.cache_clear()
+        match_by.write_percent_matched(cleaned_filenames, match_by_output,
+                                       workers=workers)
+    record("match_by", time_call(write_percent_matched, repeats))
+    return results
+
+def compare(results, baseline_filename):
+    "Print the speedup of each task relative to an earlier run."
+
+    with open(baseline_filename, "r") as baseline_file:
+        baseline = json.load(baseline_file)
+    previous = {(result["task"], result["num_spectra"]): result["seconds"]
+                for result in baseline["results"]}
+    print(f"Speedup relative to {baseline.get('commit')}:", file=sys.stderr)
+    for result in results:
+        key = (result["task"], result["num_spectra"])
+        if key in previous:
+            print(f"  {result['task']} ({result['num_spectra']} spectra): "
+                  + f"{previous[key] / result['seconds']:.2f}x",
+                  file=sys.stderr)
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global DESCRIPTION
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--sizes', type=str, default="1000,10000",
+                        help="Comma-separated numbers of spectra, e.g., "
+                        + "1000,10000,100000,1000000 (default=1000,10000)")
+    parser.add_argument('--num_peaks', type=int, default=100,
+                        help="Peaks per spectrum (default=100)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Worker processes for each stage (default=1)")
+    parser.add_argument('--repeats', type=int, default=1,
+                        help="Runs per stage; the best is kept (default=1)")
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help="Directory for the synthetic data (default: a "
+                        + "temporary directory, deleted afterwards)")
+    parser.add_argument('--output', type=str, required=True,
+                        help="JSON output file")
+    parser.add_argument('--baseline', type=str, default=None,
+                        help="JSON output of an earlier run to compare to")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        for num_spectra in [int(size) for size in args.sizes.split(",")]:
+            with instrument.stage("run_size", num_spectra=num_spectra) \
+                 as my_stage:
+                results += run_size(work_dir, num_spectra, args.num_peaks,
+                                    args.workers, args.repeats)
+                my_stage.add(spectra=num_spectra)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    with open(args.output, "w") as output_file:
+        json.dump({
+            "commit": get_commit(),
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parameters": {"num_peaks": args.num_peaks,
+                           "workers": args.workers,
+                           "repeats": args.repeats},
+            "results": results,
+        }, output_file, indent=1)
+    if args.baseline is not None:
+        compare(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+
+def test_run_size():
+
+    results = run_size(tempfile.mkdtemp(), 120, num_peaks=30)
+    assert([result["task"] for result in results] == [
+        "make_synthetic_benchmark", "annotate_mgf", "summarize_benchmark",
+        "clean_benchmark.parse", "clean_benchmark.block_copy",
+        "downsample_benchmark.by_spectrum", "get_percent_matched", "match_by"
+    ])
+    assert(all(result["seconds"] > 0 for result in results))
@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+# CREATE DATE: 18 Oct 2026
+import sys
+import argparse
+import concurrent.futures
+import hashlib
+import instrument
+import json
+import mgf_io
+import os
+import shutil
+import subprocess
+import threading
+import time
+import pandas
+
+DESCRIPTION = """Build the benchmark, as in the runall script of
+results/wnoble/2024-05-12pipeline, by running each stage (tide-index,
+tide-search, percolator, annotation, cleaning, summarizing,
+downsampling and export to mzSpecLib) as a node in a dependency graph.
+The spectral library of each species in the last two benchmarks is
+written to <benchmark>.mzlib/<species>.mzlib.txt.
+
+Stages whose dependencies are complete run in parallel, as long as the
+total number of CPUs used by running stages stays within the CPU
+budget.  A stage is rebuilt only when the content of its inputs, its
+command and parameters, or the scripts it runs have changed since it
+last succeeded; its outputs are deleted before it is rebuilt.  The
+state, per-stage logs and timings are kept in the .pipeline
+subdirectory of the working directory.
+
+The Crux binary can be replaced by any command that accepts the same
+arguments, so that the pipeline can be run locally with stubs."""
+
+STATE_DIRNAME = ".pipeline"
+STATE_FILENAME = "state.json"
+TIMINGS_FILENAME = "timings.txt"
+
+# Names of the benchmark directories, as in runall.
+BENCHMARK1 = "nine-species-overlap"
+BENCHMARK2 = "nine-species-main-no-i2l"
+BENCHMARK3 = "nine-species-main"
+BENCHMARK4 = "nine-species-balanced"
+
+class Stage:
+    """One step of the pipeline.  The command is a list of arguments, run
+    in the working directory.  Inputs, outputs and scripts are paths
+    (files or directories) relative to the working directory.  Files
+    named in ignore are left out of the hashes of input directories,
+    e.g., files that the stage itself writes into them."""
+
+    def __init__(self, name, command, inputs=(), outputs=(), scripts=(),
+                 deps=(), cpus=1, ignore=()):
+        self.name = name
+        self.command = [str(word) for word in command]
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.scripts = list(scripts)
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.ignore = list(ignore)
+
+class FileHasher:
+    """Hash file contents, reusing the hash of a file whose size and
+    modification time have not changed."""
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else {}
+        self.lock = threading.Lock()
+
+    def hash_file(self, filename):
+        stat = os.stat(filename)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        key = os.path.abspath(filename)
+        with self.lock:
+            entry = self.cache.get(key)
+        if (entry is not None) and (entry["stamp"] == stamp):
+            return entry["hash"]
+        digest = hashlib.sha256()
+        with open(filename, "rb") as my_file:
+            for chunk in iter(lambda: my_file.read(1 << 24), b""):
+                digest.update(chunk)
+        with self.lock:
+            self.cache[key] = {"stamp": stamp, "hash": digest.hexdigest()}
+        return digest.hexdigest()
+
+    def hash_path(self, path, ignore=()):
+        """Hash a file, or all of the files in a directory, except those
+        with names in ignore."""
+        if os.path.isfile(path):
+            return self.hash_file(path)
+        if not os.path.isdir(path):
+            return "missing"
+        digest = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename in ignore:
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(full_path, path).encode())
+                digest.update(self.hash_file(full_path).encode())
+        return digest.hexdigest()
+
+def get_stage_key(stage, hasher):
+    """Hash everything that determines the outputs of a stage: its command
+    and the content of its inputs and scripts."""
+    description = {
+        "command": stage.command,
+        "inputs": {path: hasher.hash_path(path, stage.ignore)
+                   for path in stage.inputs},
+        "scripts": {path: hasher.hash_path(path) for path in stage.scripts},
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True)
+                          .encode()).hexdigest()
+
+def remove_outputs(stage):
+    "Delete the outputs of a stage before it is rebuilt."
+    for path in stage.outputs:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def run_stage(stage, hasher, previous_key, log_dir, dry_run=False):
+    """Run one stage if it is out of date.  Returns (status, key, start
+    time, seconds), where status is "up to date", "ran", "dry run" or
+    "failed"."""
+
+    start = time.time()
+    key = get_stage_key(stage, hasher)
+    if ( (key == previous_key) and
+         all(os.path.exists(path) for path in stage.outputs) ):
+        return "up to date", key, start, time.time() - start
+    if dry_run:
+        print(f"Would run {stage.name}: {' '.join(stage.command)}",
+              file=sys.stderr)
+        return "dry run", key, start, time.time() - start
+
+    remove_outputs(stage)
+    print(f"Running {stage.name}.", file=sys.stderr)
+    with open(os.path.join(log_dir, f"{stage.name}.log"), "w") as log_file:
+        return_code = subprocess.call(stage.command, stdout=log_file,
+                                      stderr=subprocess.STDOUT)
+    if return_code != 0:
+        print(f"{stage.name} failed with exit code {return_code}; see "
+              + f"{log_dir}/{stage.name}.log.", file=sys.stderr)
+        return "failed", key, start, time.time() - start
+
+    # Inputs that changed while the stage ran will be noticed next time.
+    return "ran", key, start, time.time() - start
+
+def run_pipeline(stages, cpu_budget, dry_run=False):
+    """Run a list of stages in the current directory, respecting their
+    dependencies and the CPU budget.  Returns a dictionary from stage name
+    to status."""
+
+    os.makedirs(os.path.join(STATE_DIRNAME, "logs"), exist_ok=True)
+    state_filename = os.path.join(STATE_DIRNAME, STATE_FILENAME)
+    state = {"keys": {}, "files": {}}
+    if os.path.exists(state_filename):
+        with open(state_filename, "r") as state_file:
+            state = json.load(state_file)
+    hasher = FileHasher(state["files"])
+
+    statuses = {} # Key = stage name, value = status
+    pending = list(stages)
+    running = {} # Key = future, value = stage
+    cpus_in_use = 0
+    progress = instrument.Progress(len(stages), "run_pipeline", "stages")
+    with concurrent.futures.ThreadPoolExecutor(len(stages) or 1) as executor:
+        while pending or running:
+
+            # Start all the stages that can run now, in order.
+            for stage in list(pending):
+                if any(statuses.get(dep) in ("failed", "skipped")
+                       for dep in stage.deps):
+                    statuses[stage.name] = "skipped"
+                    pending.remove(stage)
+                    continue
+                if not all(dep in statuses for dep in stage.deps):
+                    continue
+                cpus = min(stage.cpus, cpu_budget)
+                if cpus_in_use + cpus > cpu_budget:
+                    continue
+                cpus_in_use += cpus
+                pending.remove(stage)
+                running[executor.submit(
+                    run_stage, stage, hasher,
+                    state["keys"].get(stage.name),
+                    os.path.join(STATE_DIRNAME, "logs"), dry_run
+                )] = stage
+            if not running:
+                break
+
+            done, not_done = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                stage = running.pop(future)
+                cpus_in_use -= min(stage.cpus, cpu_budget)
+                status, key, start, seconds = future.result()
+                statuses[stage.name] = status
+                if status in ("ran", "up to date"):
+                    state["keys"][stage.name] = key
+                elif status == "failed":
+                    state["keys"].pop(stage.name, None)
+                print(f"{stage.name}: {status} ({seconds:.1f}s).",
+                      file=sys.stderr)
+                progress.update()
+                instrument.record("pipeline_stage", stage=stage.name,
+                                  status=status, cpus=stage.cpus,
+                                  wall_seconds=seconds)
+                with open(os.path.join(STATE_DIRNAME, TIMINGS_FILENAME),
+                          "a") as timings_file:
+                    timings_file.write(f"{stage.name}\t{status}\t"
+                                       + f"{time.ctime(start)}\t"
+                                       + f"{seconds:.3f}\n")
+
+                # Save the state after every stage, so that an interrupted
+                # run keeps its progress.
+                with open(f"{state_filename}.tmp", "w") as state_file:
+                    json.dump(state, state_file)
+                os.replace(f"{state_filename}.tmp", state_filename)
+
+    for stage in pending:
+        statuses[stage.name] = "skipped"
+    return statuses
+
+def make_stages(driver_filename, data_dir, bin_dir, crux, num_spectra=100000,
+                min_psms=100, fdr_threshold=0.01, search_threads=8):
+    """Create the stages of runall for the species in the driver file.
+    Paths are relative to the working directory."""
+
+    driver = pandas.read_csv(driver_filename, sep="\t", header=None)
+    python = sys.executable
+    def script(name):
+        return os.path.join(bin_dir, name)
+    stages = []
+
+    annotate_stages = []
+    for species, precursor, fragment in zip(driver[1], driver[2], driver[3]):
+        mgf_filenames = mgf_io.glob_mgfs(os.path.join(data_dir, species))
+        fasta_filename = os.path.join(data_dir, "proteomes",
+                                      f"{species}.fasta")
+        index = os.path.join(species, "tide-index")
+        search_output = os.path.join(species, "tide-search.target.txt")
+        percolator_output = os.path.join(species,
+                                         "percolator.target.psms.txt")
+        percolator_log = os.path.join(species, "percolator.log.txt")
+
+        stages.append(Stage(
+            f"{species}.tide-index",
+            [crux, "tide-index",
+             "--mods-spec", "1M+15.994915,1N+0.984016,1Q+0.984016",
+             "--nterm-peptide-mods-spec",
+             "1X+42.010565,1X+43.005814,1X-17.026549,1X+25.980265",
+             "--max-mods", 3, "--output-dir", index, "--peptide-list", "T",
+             "--overwrite", "T", fasta_filename, index],
+            inputs=[fasta_filename], outputs=[index]
+        ))
+        stages.append(Stage(
+            f"{species}.tide-search",
+            [crux, "tide-search", "--isotope-error", 1,
+             "--output-dir", species, "--num-threads", search_threads,
+             "--use-tailor-calibration", "T",
+             "--precursor-window", precursor, "--mz-bin-width", fragment,
+             "--overwrite", "T"] + mgf_filenames + [index],
+            inputs=mgf_filenames + [index], outputs=[search_output],
+            deps=[f"{species}.tide-index"], cpus=search_threads
+        ))
+        stages.append(Stage(
+            f"{species}.percolator",
+            [crux, "percolator", "--output-dir", species, "--overwrite", "T",
+             search_output],
+            inputs=[search_output],
+            outputs=[percolator_output, percolator_log],
+            deps=[f"{species}.tide-search"]
+        ))
+        stages.append(Stage(
+            f"{species}.annotate",
+            [python, script("annotate_mgf.py"),
+             "--output_dir", os.path.join(BENCHMARK1, species),
+             "--min_psms", min_psms, "--workers", 4,
+             fdr_threshold, percolator_log, percolator_output]
+            + mgf_filenames,
+            inputs=[percolator_log, percolator_output] + mgf_filenames,
+            outputs=[os.path.join(BENCHMARK1, species)],
+            scripts=[script("annotate_mgf.py"), script("mgf_index.py"),
+                     script("mgf_io.py")],
+            deps=[f"{species}.percolator"], cpus=4
+        ))
+        annotate_stages.append(f"{species}.annotate")
+
+    def summarize(benchmark, deps):
+        "Summarize a benchmark.  Also writes its peptides.txt files."
+        return Stage(
+            f"{benchmark}.summarize",
+            [python, script("summarize_benchmark.py"),
+             "--data_dir", data_dir, "--driver_filename", driver_filename,
+             "--benchmark_dir", benchmark, "--root", benchmark,
+             "--cache_filename",
+             os.path.join(STATE_DIRNAME, "summary-cache.json"),
+             "--workers", 4],
+            inputs=[driver_filename, benchmark],
+            outputs=[f"{benchmark}.txt", f"{benchmark}.html"],
+            scripts=[script("summarize_benchmark.py"), script("mgf_io.py"),
+                     script("peptide_table.py")],
+            deps=deps, cpus=4, ignore=["peptides.txt"]
+        )
+
+    # The summaries write peptides.txt into the benchmark directories, so
+    # later stages wait for them to keep their input hashes stable.
+    stages.append(summarize(BENCHMARK1, annotate_stages))
+    for benchmark, options in ((BENCHMARK2, []), (BENCHMARK3, ["--i2l"])):
+        stages.append(Stage(
+            f"{benchmark}.clean",
+            [python, script("clean-benchmark.py"), "--old_root", BENCHMARK1,
+             "--new_root", benchmark, "--workers", 4] + options,
+            inputs=[BENCHMARK1], outputs=[benchmark],
+            scripts=[script("clean-benchmark.py"), script("mgf_io.py"),
+                     script("peptide_table.py")],
+            deps=[f"{BENCHMARK1}.summarize"], cpus=4
+        ))
+        stages.append(summarize(benchmark, [f"{benchmark}.clean"]))
+    stages.append(Stage(
+        f"{BENCHMARK4}.downsample",
+        [python, script("downsample_benchmark.py"),
+         "--num_spectra", num_spectra, "--root", BENCHMARK4]
+        + [os.path.join(BENCHMARK3, species) for species in driver[1]],
+        inputs=[BENCHMARK3], outputs=[BENCHMARK4],
+        scripts=[script("downsample_benchmark.py"), script("mgf_io.py")],
+        deps=[f"{BENCHMARK3}.summarize"]
+    ))
+    stages.append(summarize(BENCHMARK4, [f"{BENCHMARK4}.downsample"]))
+
+    # Spectral libraries are written outside the benchmark directories,
+    # which are the inputs of other stages.
+    for benchmark in (BENCHMARK3, BENCHMARK4):
+        for species in driver[1]:
+            stages.append(Stage(
+                f"{benchmark}.{species}.mzlib",
+                [python, script("export_mzspeclib.py"), "--workers", 4,
+                 "--output", os.path.join(f"{benchmark}.mzlib",
+                                          f"{species}.mzlib.txt"),
+                 os.path.join(benchmark, species)],
+                inputs=[os.path.join(benchmark, species)],
+                outputs=[os.path.join(f"{benchmark}.mzlib",
+                                      f"{species}.mzlib.txt")],
+                scripts=[script("export_mzspeclib.py"), script("mgf_io.py"),
+                         script("peptides.py")],
+                deps=[f"{benchmark}.summarize"], cpus=4
+            ))
+    return stages
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global DESCRIPTION
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--driver_filename', type=str, required=True,
+                        help="Driver file, such as nine-species.txt.  "
+                        + "Columns are PXD ID, species name, precursor "
+                        + "tolerance (ppm), fragment bin size (m/z)")
+    parser.add_argument('--data_dir', type=str, required=True,
+                        help="Directory with one MGF directory per species "
+                        + "and proteomes/<species>.fasta")
+    parser.add_argument('--work_dir', type=str, default=".",
+                        help="Output directory (default=.)")
+    parser.add_argument('--crux', type=str, default="crux",
+                        help="Crux binary, or a stub (default=crux)")
+    parser.add_argument('--cpus', type=int, default=os.cpu_count(),
+                        help="Maximum number of CPUs used at once")
+    parser.add_argument('--num_spectra', type=int, default=100000,
+                        help="Spectra per species in the balanced benchmark")
+    parser.add_argument('--min_psms', type=int, default=100,
+                        help="Minimum number of PSMs per annotated MGF")
+    parser.add_argument('--dry_run', action=argparse.BooleanOptionalAction,
+                        help="List the stages that would run")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if args.metrics_out is not None:
+        args.metrics_out = os.path.abspath(args.metrics_out)
+    instrument.setup(args)
+
+    # Stages run in the working directory.
+    bin_dir = os.path.dirname(os.path.abspath(__file__))
+    driver_filename = os.path.abspath(args.driver_filename)
+    data_dir = os.path.abspath(args.data_dir)
+    os.makedirs(args.work_dir, exist_ok=True)
+    os.chdir(args.work_dir)
+
+    stages = make_stages(driver_filename, data_dir, bin_dir, args.crux,
+                         args.num_spectra, args.min_psms)
+    with instrument.stage("run_pipeline"):
+        statuses = run_pipeline(stages, args.cpus, args.dry_run)
+    if any(status in ("failed", "skipped") for status in statuses.values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+
+def test_run_pipeline(monkeypatch):
+
+    # Three stages: b and c each copy a, and d waits for both.
+    work_dir = tempfile.mkdtemp()
+    monkeypatch.chdir(work_dir)
+    with open("a.txt", "w") as a_file:
+        a_file.write("a\n")
+    copy = lambda source, target: ["sh", "-c", f"cat {source} > {target}"]
+    stages = [
+        Stage("b", copy("a.txt", "b.txt"), ["a.txt"], ["b.txt"]),
+        Stage("c", copy("a.txt", "c.txt"), ["a.txt"], ["c.txt"], cpus=2),
+        Stage("d", ["sh", "-c", "cat b.txt c.txt > d.txt"],
+              ["b.txt", "c.txt"], ["d.txt"], deps=["b", "c"]),
+    ]
+    assert(run_pipeline(stages, 2)
+           == {"b": "ran", "c": "ran", "d": "ran"})
+    with open("d.txt") as d_file:
+        assert(d_file.read() == "a\na\n")
+
+    # Nothing changed.
+    assert(set(run_pipeline(stages, 2).values()) == {"up to date"})
+
+    # A stage whose outputs do not change does not rebuild its dependents.
+    stages[0].command = copy("a.txt", "b.txt") + ["# new version"]
+    assert(run_pipeline(stages, 2)
+           == {"b": "ran", "c": "up to date", "d": "up to date"})
+
+    # An input changes.
+    with open("a.txt", "w") as a_file:
+        a_file.write("A\n")
+    assert(run_pipeline(stages, 2)
+           == {"b": "ran", "c": "ran", "d": "ran"})
+
+    # A failed stage skips its dependents, and is retried next time.
+    stages[1].command = ["false"]
+    assert(run_pipeline(stages, 2)
+           == {"b": "up to date", "c": "failed", "d": "skipped"})
+    assert(not os.path.exists("c.txt"))
+    assert(run_pipeline(stages, 2)["c"] == "failed")
+    with open(os.path.join(STATE_DIRNAME, TIMINGS_FILENAME)) as timings:
+        assert(len(timings.readlines()) == 16)
+
+# A stand-in for Crux.  tide-search lists every spectrum, and percolator
+# assigns the same peptide to every spectrum of each file.
+STUB_CRUX = """#!/usr/bin/env python
+import os, sys
+command, args = sys.argv[1], sys.argv[2:]
+output_dir = args[args.index("--output-dir") + 1]
+os.makedirs(output_dir, exist_ok=True)
+if command == "tide-index":
+    open(os.path.join(output_dir, "index.txt"), "w").write(args[-2])
+elif command == "tide-search":
+    mgfs = [arg for arg in args if arg.endswith(".mgf")]
+    with open(os.path.join(output_dir, "tide-search.target.txt"), "w") as out:
+        for file_index, mgf in enumerate(mgfs):
+            out.write(f"{file_index}\\t{mgf}\\n")
+elif command == "percolator":
+    log = open(os.path.join(output_dir, "percolator.log.txt"), "w")
+    psms = open(os.path.join(output_dir, "percolator.target.psms.txt"), "w")
+    psms.write("PSMId\\tq-value\\tpeptide\\n")
+    for line in open(args[-1]):
+        file_index, mgf = line.split()
+        log.write(f"INFO: Assigning index {file_index} to {mgf}.\\n")
+        for scan in range(1, 4):
+            peptide = f"PEPT{os.path.basename(mgf)[0].upper()}IDEK"
+            psms.write(f"target_{file_index}_{scan}_2_1\\t0.001\\t"
+                       + f"K.{peptide}.A\\n")
+"""
+
+def test_make_stages(monkeypatch):
+
+    # Two species, with one MGF each.
+    data_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(data_dir, "proteomes"))
+    driver_filename = os.path.join(data_dir, "driver.txt")
+    with open(driver_filename, "w") as driver_file:
+        driver_file.write("PXD1\tyeast\t20\t0.05\nPXD2\thuman\t20\t0.02\n")
+    for species in ("yeast", "human"):
+        os.makedirs(os.path.join(data_dir, species))
+        with open(os.path.join(data_dir, "proteomes", f"{species}.fasta"),
+                  "w") as fasta_file:
+            fasta_file.write(f">{species}\nPEPTIDEK\n")
+        with open(os.path.join(data_dir, species, f"{species}.mgf"),
+                  "w") as mgf_file:
+            for scan in range(1, 4):
+                mgf_file.write("BEGIN IONS\nPEPMASS=500.0\nCHARGE=2+\n"
+                               + f"SCANS={scan}\n100.0 1.0\nEND IONS\n\n")
+    crux = os.path.join(data_dir, "crux")
+    with open(crux, "w") as crux_file:
+        crux_file.write(STUB_CRUX)
+    os.chmod(crux, 0o755)
+
+    work_dir = tempfile.mkdtemp()
+    monkeypatch.chdir(work_dir)
+    bin_dir = os.path.dirname(os.path.abspath(__file__))
+    stages = make_stages(driver_filename, data_dir, bin_dir, crux,
+                         num_spectra=2, min_psms=1)
+    statuses = run_pipeline(stages, 8)
+    assert(set(statuses.values()) == {"ran"})
+    assert(len(statuses) == 4 * 2 + 7 + 2 * 2)
+
+    # Nothing is rerun when nothing has changed.
+    statuses = run_pipeline(stages, 8)
+    assert(set(statuses.values()) == {"up to date"})
+    summary = pandas.read_csv(f"{BENCHMARK4}.txt", sep="\t")
+    assert(list(summary["#PSMs"]) == [3, 3, 6])
+    with open(os.path.join(f"{BENCHMARK4}.mzlib", "yeast.mzlib.txt")) \
+         as library_file:
+        assert(library_file.read().count("<Spectrum=") == 3)
+
+    # Only the stages downstream of a changed MGF are rerun.
+    with open(os.path.join(data_dir, "human", "human.mgf"), "a") as mgf_file:
+        mgf_file.write("\n")
+    statuses = run_pipeline(stages, 8)
+    assert(statuses["yeast.tide-search"] == "up to date")
+    assert(statuses["human.tide-search"] == "ran")
+    assert(statuses["human.annotate"] == "ran")
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# CREATE DATE: 18 Oct 2026
+import sys
+import argparse
+import io
+import json
+import os
+import numpy as np
+import instrument
+import mgf_io
+
+DESCRIPTION = """Convert a directory of (cleaned) MGF files, such as one
+species of a benchmark, to a columnar spectrum store, or convert a
+store back to MGF files.
+
+A store is a directory of memory-mappable binary columns: contiguous m/z
+and intensity arrays with an array of peak offsets, and per-spectrum
+columns for the title, precursor m/z and intensity, charge, retention
+time, scan and peptide.  The order of the header fields of each spectrum
+is recorded, so that converting back reproduces the MGF files written
+by clean-benchmark.py byte for byte.  The conversion checks this."""
+
+STORE_VERSION = 1
+METADATA_FILENAME = "store.json"
+
+# Per-spectrum numeric columns and their types.
+NUMERIC_COLUMNS = {
+    "pepmass": np.float64,
+    "pepmass_intensity": np.float64, # NaN if absent
+    "charge": np.int8,
+    "rtinseconds": np.float64,
+    "layout": np.uint16, # Index into the list of header field orders.
+}
+STRING_COLUMNS = ["title", "scans", "seq"]
+HEADER_FIELDS = ["title", "pepmass", "charge", "rtinseconds", "scans", "seq"]
+
+def is_store(path):
+    "Is the given path a spectrum store?"
+    return os.path.isfile(os.path.join(path, METADATA_FILENAME))
+
+def get_file_stamp(filename):
+    """Identify a version of a file, or of a spectrum store by that of its
+    metadata file (see mgf_io.get_file_stamp)."""
+    if is_store(filename):
+        filename = os.path.join(filename, METADATA_FILENAME)
+    return mgf_io.get_file_stamp(filename)
+
+def write_store(mgf_filenames, store_dir, verify=True):
+    """Convert a list of MGF files to a spectrum store.  Raises ValueError
+    if a spectrum cannot be stored losslessly."""
+
+    os.makedirs(store_dir, exist_ok=True)
+    metadata = {
+        "version": STORE_VERSION,
+        "files": [],
+        "layouts": [],
+        "columns": {name: np.dtype(dtype).str
+                    for name, dtype in NUMERIC_COLUMNS.items()},
+    }
+    layouts = {} # Key = tuple of header fields, value = index.
+
+    def open_column(name):
+        return open(os.path.join(store_dir, f"{name}.bin"), "wb",
+                    buffering=1 << 20)
+
+    columns = {name: open_column(name) for name in
+               ["mz", "intensity", "peak_offsets"]
+               + list(NUMERIC_COLUMNS.keys()) + STRING_COLUMNS
+               + [f"{name}_offsets" for name in STRING_COLUMNS]}
+    num_peaks = 0
+    string_sizes = {name: 0 for name in STRING_COLUMNS}
+    columns["peak_offsets"].write(np.int64(0).tobytes())
+    for name in STRING_COLUMNS:
+        columns[f"{name}_offsets"].write(np.int64(0).tobytes())
+
+    for mgf_filename in mgf_filenames:
+        num_spectra = 0
+        for offset, block in mgf_io.iter_blocks(mgf_filename):
+            spectrum = mgf_io.parse_spectrum(block)
+            params = spectrum['params']
+
+            # Check that the spectrum can be stored.
+            layout = tuple(params.keys())
+            if not set(layout) <= set(HEADER_FIELDS):
+                raise ValueError(f"Unsupported fields in {mgf_filename} "
+                                 + f"at byte {offset}.")
+            if len(params.get("charge", [0])) != 1:
+                raise ValueError(f"Multiple charges in {mgf_filename} "
+                                 + f"at byte {offset}.")
+            if verify:
+                rendered = render_spectrum(spectrum)
+                if rendered != bytes(block):
+                    raise ValueError(f"Cannot store spectrum in "
+                                     + f"{mgf_filename} at byte {offset} "
+                                     + "losslessly.")
+            if layout not in layouts:
+                layouts[layout] = len(layouts)
+                metadata["layouts"].append(list(layout))
+
+            # Write the columns.
+            pepmass, pepmass_intensity = params.get("pepmass", (np.nan, None))
+            values = {
+                "pepmass": pepmass,
+                "pepmass_intensity": (np.nan if pepmass_intensity is None
+                                      else pepmass_intensity),
+                "charge": params.get("charge", [0])[0],
+                "rtinseconds": params.get("rtinseconds", np.nan),
+                "layout": layouts[layout],
+            }
+            for name, dtype in NUMERIC_COLUMNS.items():
+                columns[name].write(dtype(values[name]).tobytes())
+            for name in STRING_COLUMNS:
+                value = params.get(name, "").encode()
+                columns[name].write(value)
+                string_sizes[name] += len(value)
+                columns[f"{name}_offsets"].write(
+                    np.int64(string_sizes[name]).tobytes()
+                )
+            columns["mz"].write(spectrum['m/z array'].tobytes())
+            columns["intensity"].write(spectrum['intensity array'].tobytes())
+            num_peaks += len(spectrum['m/z array'])
+            columns["peak_offsets"].write(np.int64(num_peaks).tobytes())
+            num_spectra += 1
+
+        metadata["files"].append({"name": os.path.basename(mgf_filename),
+                                  "num_spectra": num_spectra})
+        print(f"Stored {num_spectra} spectra from {mgf_filename}.",
+              file=sys.stderr)
+
+    for column in columns.values():
+        column.close()
+    with open(os.path.join(store_dir, METADATA_FILENAME), "w") \
+         as metadata_file:
+        json.dump(metadata, metadata_file, indent=1)
+
+def open_store(store_dir):
+    """Open a spectrum store.  Returns a dictionary with the metadata and
+    a memory-mapped array for each column."""
+
+    with open(os.path.join(store_dir, METADATA_FILENAME), "r") \
+         as metadata_file:
+        metadata = json.load(metadata_file)
+    if metadata["version"] != STORE_VERSION:
+        raise ValueError(f"Unsupported store version in {store_dir}.")
+
+    def map_column(name, dtype):
+        filename = os.path.join(store_dir, f"{name}.bin")
+        if os.path.getsize(filename) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode="r")
+
+    store = {"metadata": metadata}
+    store["mz"] = map_column("mz", np.float64)
+    store["intensity"] = map_column("intensity", np.float64)
+    store["peak_offsets"] = map_column("peak_offsets", np.int64)
+    for name, dtype in metadata["columns"].items():
+        store[name] = map_column(name, np.dtype(dtype))
+    for name in STRING_COLUMNS:
+        store[name] = map_column(name, np.uint8)
+        store[f"{name}_offsets"] = map_column(f"{name}_offsets", np.int64)
+    return store
+
+def count_spectra(store):
+    "Total number of spectra in a store."
+    return len(store["layout"])
+
+def file_ranges(store):
+    """List the MGF files in a store, as tuples (name, index of first
+    spectrum, index after last spectrum)."""
+
+    ranges = []
+    start = 0
+    for entry in store["metadata"]["files"]:
+        ranges.append((entry["name"], start, start + entry["num_spectra"]))
+        start += entry["num_spectra"]
+    return ranges
+
+def get_string(store, name, index):
+    "Get one value of a string column."
+    offsets = store[f"{name}_offsets"]
+    return bytes(store[name][offsets[index]:offsets[index + 1]]).decode()
+
+def iter_field(store, name, start=0, end=None):
+    "Iterate over the values of one string column."
+    if end is None:
+        end = count_spectra(store)
+    for index in range(start, end):
+        yield get_string(store, name, index)
+
+def get_spectrum(store, index, peaks=True):
+    """Get one spectrum, in the same format as mgf_io.parse_spectrum.  The
+    peak arrays are views into the store."""
+
+    params = {}
+    for field in store["metadata"]["layouts"][store["layout"][index]]:
+        if field == "pepmass":
+            pepmass_intensity = float(store["pepmass_intensity"][index])
+            params[field] = (float(store["pepmass"][index]),
+                             None if np.isnan(pepmass_intensity)
+                             else pepmass_intensity)
+        elif field == "charge":
+            params[field] = [int(store["charge"][index])]
+        elif field == "rtinseconds":
+            params[field] = float(store["rtinseconds"][index])
+        else:
+            params[field] = get_string(store, field, index)
+
+    spectrum = {'params': params}
+    if peaks:
+        peak_start = store["peak_offsets"][index]
+        peak_end = store["peak_offsets"][index + 1]
+        spectrum['m/z array'] = store["mz"][peak_start:peak_end]
+        spectrum['intensity array'] = store["intensity"][peak_start:peak_end]
+    return spectrum
+
+def read(store_dir, start=0, end=None, peaks=True):
+    "Iterate over the spectra of a store, optionally in a range of indices."
+    store = open_store(store_dir)
+    if end is None:
+        end = count_spectra(store)
+    for index in range(start, end):
+        yield get_spectrum(store, index, peaks)
+
+def render_spectrum(spectrum):
+    "Format a spectrum as the bytes of an MGF block."
+    buffer = io.StringIO()
+    mgf_io.write_spectrum(buffer, spectrum)
+    return buffer.getvalue().encode()
+
+def write_mgfs(store_dir, output_dir):
+    "Convert a store back to a directory of MGF files."
+
+    os.makedirs(output_dir, exist_ok=True)
+    store = open_store(store_dir)
+    for name, start, end in file_ranges(store):
+        with mgf_io.open_output(os.path.join(output_dir, name), "w",
+                                1 << 20) as mgf_file:
+            for index in range(start, end):
+                mgf_io.write_spectrum(mgf_file, get_spectrum(store, index))
+        print(f"Wrote {end - start} spectra to {name}.", file=sys.stderr)
+
+###########################################################################
+# MAIN
+###########################################################################
+def main():
+    global DESCRIPTION
+
+    # Parse the command line.
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('command', choices=["to_store", "to_mgf"],
+                        help="Direction of the conversion")
+    parser.add_argument('input', help="MGF directory or store")
+    parser.add_argument('output', help="Store or MGF directory")
+    parser.add_argument('--verify', action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="Check that the conversion is lossless")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    with instrument.stage(args.command) as my_stage:
+        if args.command == "to_store":
+            mgf_filenames = sorted(
+                os.path.join(args.input, f.name)
+                for f in os.scandir(args.input)
+                if f.is_file() and mgf_io.is_mgf(f.name)
+            )
+            write_store(mgf_filenames, args.output, args.verify)
+            my_stage.add(bytes=sum(os.path.getsize(mgf_filename)
+                                   for mgf_filename in mgf_filenames))
+            store = open_store(args.output)
+        else:
+            write_mgfs(args.input, args.output)
+            store = open_store(args.input)
+        my_stage.add(spectra=count_spectra(store))
+
+if __name__ == "__main__":
+    main()
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+
+cleaned_mgf = """BEGIN IONS
+TITLE=controllerType=0 controllerNumber=1 scan=2475
+PEPMASS=561.798400878906
+RTINSECONDS=832.4328
+CHARGE=2+
+SCANS=2475
+SEQ=VVQEQGTHPK
+100.0757 10.0
+147.1124878 10.0
+1033.7346191 10.0
+END IONS
+
+BEGIN IONS
+TITLE=controllerType=0 controllerNumber=1 scan=3919
+PEPMASS=828.3374 1234.5
+CHARGE=3+
+SEQ=+43.006-17.027C+57.021ANFDNQDNNHYNHNHNQAR
+120.080719 11572.1962890625
+END IONS
+
+"""
+
+def write_cleaned_mgf(mgf_filename):
+    "Write the test spectra in the format written by clean-benchmark.py."
+    global cleaned_mgf
+
+    with open(mgf_filename, "w") as mgf_file:
+        mgf_file.write(cleaned_mgf)
+    spectra = list(mgf_io.read(mgf_filename))
+    with open(mgf_filename, "w") as mgf_file:
+        for spectrum in spectra:
+            mgf_io.write_spectrum(mgf_file, spectrum)
+
+def test_round_trip():
+    mgf_dir = tempfile.mkdtemp()
+    for name in ["a.mgf", "b.mgf"]:
+        write_cleaned_mgf(os.path.join(mgf_dir, name))
+    with open(os.path.join(mgf_dir, "empty.mgf"), "w") as mgf_file:
+        pass
+    mgf_filenames = [os.path.join(mgf_dir, name)
+                     for name in ["a.mgf", "empty.mgf", "b.mgf"]]
+    store_dir = os.path.join(tempfile.mkdtemp(), "store")
+    write_store(mgf_filenames, store_dir)
+
+    store = open_store(store_dir)
+    assert(is_store(store_dir))
+    assert(count_spectra(store) == 4)
+    assert(file_ranges(store) == [("a.mgf", 0, 2), ("empty.mgf", 2, 2),
+                                  ("b.mgf", 2, 4)])
+    assert(list(iter_field(store, "seq", 2, 4))[1]
+           == "+43.006-17.027C+57.021ANFDNQDNNHYNHNHNQAR")
+    spectrum = get_spectrum(store, 3)
+    assert(list(spectrum['params'].keys())
+           == ["title", "pepmass", "charge", "seq"])
+    assert(spectrum['params']['pepmass'] == (828.3374, 1234.5))
+    assert(spectrum['m/z array'].tolist() == [120.080719])
+
+    output_dir = tempfile.mkdtemp()
+    write_mgfs(store_dir, output_dir)
+    for name in ["a.mgf", "b.mgf", "empty.mgf"]:
+        with open(os.path.join(mgf_dir, name), "r") as file1, \
+             open(os.path.join(output_dir, name), "r") as file2:
+            assert(file1.read() == file2.read())
+
+def test_lossy():
+
+    # Integer intensities would not be reproduced.
+    mgf_filename = os.path.join(tempfile.mkdtemp(), "lossy.mgf")
+    write_cleaned_mgf(mgf_filename)
+    with open(mgf_filename, "r") as mgf_file:
+        mgf_text = mgf_file.read()
+    with open(mgf_filename, "w") as mgf_file:
+        mgf_file.write(mgf_text.replace(" 11572.1962890625 ", " 11572 "))
+    with pytest.raises(ValueError):
+        write_store([mgf_filename], os.path.join(tempfile.mkdtemp(), "s"))
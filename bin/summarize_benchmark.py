@@ -3,25 +3,28 @@
 # CREATE DATE: 10 May 2024, Branford, CT
 import sys
 import argparse
+import json
+import multiprocessing
 import pandas
 import os
-import glob
-import re
+import instrument
+import mgf_io
+import peptide_table
+import peptides
+import spectrum_store
 
 DESCRIPTION = """Write text and HTML tables describing a given
-benchmark dataset."""
+benchmark dataset.
 
-def count_spectra(mgf_filenames):
-    "Count number of spectra in a set of MGF files."
-    return_value = 0
+Each MGF file (or spectrum store) is read once, to count its spectra and
+list its distinct peptides.  The results are cached, keyed by the path,
+size and modification time of the file, so summarizing again after a
+change only reads the files that changed.  The cache is written next to
+the outputs, not in the data directory, and is skipped with a warning
+if it cannot be written."""
 
-    for mgf_filename in mgf_filenames:
-        with open(mgf_filename, "r") as mgf_file:
-            for line in mgf_file:
-                if line.rstrip() == "BEGIN IONS":
-                    return_value += 1
-
-    return return_value
+# Increment when the contents of a cache entry change.
+CACHE_VERSION = 1
 
 def count_lines(filename):
     if os.path.exists(filename):
@@ -29,34 +32,110 @@ def count_lines(filename):
             return(len(my_file.readlines()))
     return 0
 
-def i2l(peptide):
-    "Leucines to isoleucines."
-    return re.sub("I", "L", peptide)
+def clean_peptide(peptide):
+    "Remove PTMs and change isoleucines to leucines."
+    return peptides.convert(peptide, "i2l")
+
+def get_file_stats(mgf_filename):
+    """Count the spectra in an MGF file (or spectrum store) and list its
+    distinct cleaned peptides, in one pass."""
+
+    if spectrum_store.is_store(mgf_filename):
+        store = spectrum_store.open_store(mgf_filename)
+        num_spectra = spectrum_store.count_spectra(store)
+        seqs = spectrum_store.iter_field(store, "seq")
+        file_peptides = list(dict.fromkeys(clean_peptide(seq)
+                                           for seq in seqs))
+    else:
+        num_spectra = 0
+        file_peptides = {}
+        for offset, chunk in mgf_io.iter_chunks(mgf_filename):
+            num_spectra += len(mgf_io.find_spectra(chunk)) - 1
+            file_peptides.update(dict.fromkeys(
+                clean_peptide(seq) for seq in mgf_io.find_field(chunk, "SEQ")
+            ))
+        file_peptides = list(file_peptides)
+    return {"spectra": num_spectra, "peptides": file_peptides}
 
-def clean_peptide (peptide):
-    "Remove PTMs."
+def get_file_stats_star(mgf_filename):
+    "Compute the stats of a file, along with its stamp."
+    stamp = spectrum_store.get_file_stamp(mgf_filename)
+    return mgf_filename, stamp, get_file_stats(mgf_filename)
 
-    return i2l(re.sub(r"[0-9\.\[\]\+\-]+", "", peptide))
-    
+def read_cache(cache_filename):
+    """Read the cache of per-file stats.  Returns an empty cache if the file
+    does not exist or was written by another version."""
 
-def count_peptides(mgf_filenames, output_filename):
-    """Count number of distinct peptides in a set of MGF files.  Eliminates
-    modifications and converts isoleucines first.  Prints a list of peptides
-    to the given file."""
+    if (cache_filename is None) or (not os.path.exists(cache_filename)):
+        return {}
+    with open(cache_filename, "r") as cache_file:
+        cache = json.load(cache_file)
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache["files"]
 
-    peptides = {} # Key = peptide, value = True
+def write_cache(cache_filename, cache):
+    "Atomically replace the cache of per-file stats."
+    with open(f"{cache_filename}.tmp", "w") as cache_file:
+        json.dump({"version": CACHE_VERSION, "files": cache}, cache_file)
+    os.replace(f"{cache_filename}.tmp", cache_filename)
+
+def gather_stats(mgf_filenames, cache_filename=None, workers=1):
+    """Return a dictionary from filename to stats (see get_file_stats),
+    reading only those files that are missing from the cache or have
+    changed since they were cached.  The cache is updated in place."""
+
+    cache = read_cache(cache_filename)
+    stats = {}
+    stale = []
     for mgf_filename in mgf_filenames:
-        with open(mgf_filename, "r") as mgf_file:
-            for line in mgf_file:
-                if line.startswith("SEQ="):
-                    peptides[clean_peptide(line.rstrip().split("=")[1])] = True
+        entry = cache.get(os.path.abspath(mgf_filename))
+        if ( (entry is not None) and
+             (entry["stamp"]
+              == spectrum_store.get_file_stamp(mgf_filename)) ):
+            stats[mgf_filename] = entry["stats"]
+        else:
+            stale.append(mgf_filename)
+    print(f"Reading {len(stale)} of {len(mgf_filenames)} files.",
+          file=sys.stderr)
+    instrument.record_cache("summary_cache", len(stats), len(stale))
+
+    if workers > 1 and len(stale) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = list(pool.imap_unordered(get_file_stats_star, stale))
+    else:
+        results = map(get_file_stats_star, stale)
+    progress = instrument.Progress(len(stale), "summarize_benchmark", "files")
+    for mgf_filename, stamp, file_stats in results:
+        progress.update()
+        stats[mgf_filename] = file_stats
+        cache[os.path.abspath(mgf_filename)] = {
+            "stamp": stamp, "stats": file_stats
+        }
+
+    if (cache_filename is not None) and (len(stale) > 0):
+        try:
+            write_cache(cache_filename, cache)
+        except OSError as error:
+            print(f"Cannot write cache {cache_filename}: {error}",
+                  file=sys.stderr)
+    return stats
+
+def count_peptides(peptide_lists, output_filename):
+    """Count number of distinct peptides in a set of lists (one per MGF
+    file) of cleaned peptides.  Prints a list of peptides to the given
+    file."""
+
+    table = peptide_table.PeptideTable(["all"])
+    for peptide_list in peptide_lists:
+        table.add(peptide_list, "all")
 
     with open(output_filename, "w") as output_file:
-        print("\n".join(sorted(list(peptides.keys()))), file=output_file)
+        print("\n".join(sorted(table.peptides)), file=output_file)
+
+    return len(table)
+
 
-    return len(peptides)
-                            
-    
 ###########################################################################
 # MAIN
 ###########################################################################
@@ -72,13 +151,54 @@ def main():
     parser.add_argument('--data_dir', type=str, required=True,
                         help="Directory containing original data")
     parser.add_argument('--benchmark_dir', type=str, required=True,
-                        help="Directory containing benchmark")
-    parser.add_argument('--root', type=str, required=True, 
+                        help="Directory containing benchmark, with one "
+                        + "MGF directory or spectrum store per species")
+    parser.add_argument('--root', type=str, required=True,
                         help="Output directory and filename root")
+    parser.add_argument('--cache_filename', type=str, default=None,
+                        help="Cache of per-file statistics, shared between "
+                        + "benchmarks (default=<root>.summary-cache.json)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes (default=1)")
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.setup(args)
 
     driver = pandas.read_csv(args.driver_filename, sep="\t", header=None)
     all_species = list(driver[1])
+    if args.cache_filename is None:
+        args.cache_filename = f"{args.root}.summary-cache.json"
+
+    # Find the files for each species.
+    data_mgfs = {} # Key = species, value = list of raw MGFs
+    benchmark_mgfs = {} # Key = species, value = list of benchmark MGFs
+    num_benchmark_mgfs = {} # Key = species, value = number of MGFs
+    for species in all_species:
+        data_mgfs[species] = mgf_io.glob_mgfs(
+            os.path.join(args.data_dir, species)
+        )
+        benchmark_mgfs[species] = mgf_io.glob_mgfs(
+            os.path.join(args.benchmark_dir, species)
+        )
+        num_benchmark_mgfs[species] = len(benchmark_mgfs[species])
+
+        # The benchmark may be a spectrum store instead of MGFs.
+        species_dir = os.path.join(args.benchmark_dir, species)
+        if spectrum_store.is_store(species_dir):
+            benchmark_mgfs[species] = [species_dir]
+            num_benchmark_mgfs[species] = len(spectrum_store.file_ranges(
+                spectrum_store.open_store(species_dir)
+            ))
+
+    # Read all the files that are not already cached.
+    with instrument.stage("gather_stats") as my_stage:
+        stats = gather_stats(
+            [mgf_filename for species in all_species
+             for mgf_filename in data_mgfs[species] + benchmark_mgfs[species]],
+            args.cache_filename, args.workers
+        )
+        my_stage.add(spectra=sum(file_stats["spectra"]
+                                 for file_stats in stats.values()))
 
     output = {} # Key = column name, value = list of entries.
     output["species"] = all_species
@@ -90,20 +210,20 @@ def main():
     for species in all_species:
         print(species, file=sys.stderr)
 
-        data_mgfs = glob.glob(os.path.join(args.data_dir, species, "*.mgf"))
-        benchmark_mgfs = glob.glob(
-            os.path.join(args.benchmark_dir, species, "*.mgf")
-        )
-        
-        output["#raw"].append(len(data_mgfs))
-        output["#mgf"].append(len(benchmark_mgfs))
-        output["#spectra"].append(count_spectra(data_mgfs))
-        output["#PSMs"].append(count_spectra(benchmark_mgfs))
-        output["#peptides"].append(
-            count_peptides(benchmark_mgfs,
-                           os.path.join(args.benchmark_dir, species,
-                                        "peptides.txt"))
-        )
+        output["#raw"].append(len(data_mgfs[species]))
+        output["#mgf"].append(num_benchmark_mgfs[species])
+        output["#spectra"].append(sum(stats[mgf_filename]["spectra"]
+                                      for mgf_filename in data_mgfs[species]))
+        output["#PSMs"].append(sum(stats[mgf_filename]["spectra"]
+                                   for mgf_filename
+                                   in benchmark_mgfs[species]))
+        with instrument.stage("count_peptides", species=species):
+            output["#peptides"].append(
+                count_peptides([stats[mgf_filename]["peptides"]
+                                for mgf_filename in benchmark_mgfs[species]],
+                               os.path.join(args.benchmark_dir, species,
+                                            "peptides.txt"))
+            )
 
     output["precursor"] = list(driver[2])
     output["fragment"] = list(driver[3])
@@ -123,3 +243,38 @@ def main():
 if __name__ == "__main__":
     main()
     sys.exit(0)
+
+#############################################################################
+# TESTING
+#############################################################################
+import pytest
+import tempfile
+
+def test_gather_stats():
+
+    mgf_dir = tempfile.mkdtemp()
+    mgf_filename = os.path.join(mgf_dir, "a.mgf")
+    spectrum = "BEGIN IONS\nSEQ={}\n100.0 1.0\nEND IONS\n"
+    with open(mgf_filename, "w") as mgf_file:
+        mgf_file.write("".join(spectrum.format(seq) for seq in
+                               ["PEPTIDEK", "PEPTLDEK", "M[15.9949]AK"]))
+    cache_filename = os.path.join(mgf_dir, "cache.json")
+    assert(gather_stats([mgf_filename], cache_filename)[mgf_filename]
+           == {"spectra": 3, "peptides": ["PEPTLDEK", "MAK"]})
+
+    # Cached results are used until the file changes.
+    cache = read_cache(cache_filename)
+    cache[os.path.abspath(mgf_filename)]["stats"]["spectra"] = 7
+    write_cache(cache_filename, cache)
+    assert(gather_stats([mgf_filename], cache_filename)[mgf_filename]
+           ["spectra"] == 7)
+    with open(mgf_filename, "a") as mgf_file:
+        mgf_file.write(spectrum.format("AAAK"))
+    assert(gather_stats([mgf_filename], cache_filename, 2)[mgf_filename]
+           == {"spectra": 4, "peptides": ["PEPTLDEK", "MAK", "AAAK"]})
+
+    # A cache that cannot be written is skipped.
+    missing_filename = os.path.join(mgf_dir, "missing", "cache.json")
+    assert(gather_stats([mgf_filename], missing_filename)[mgf_filename]
+           ["spectra"] == 4)
+    assert(not os.path.exists(missing_filename))
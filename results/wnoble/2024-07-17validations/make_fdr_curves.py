@@ -2,11 +2,72 @@
 # AUTHOR: WSN
 # CREATE DATE: 17 July 2024
 import sys
+import multiprocessing
+import numpy as np
 import pandas
 import re
 import os.path
 import matplotlib.pyplot as plt
 
+# Plotted range, and number of points per curve across the x axis.
+MAX_FDR = 0.1
+MAX_PSMS = 2e6
+RESOLUTION = 2000
+
+# The curve of each Percolator file is cached next to it.
+CACHE_SUFFIX = ".fdr-curve.npz"
+
+def get_file_stamp(filename):
+    "Return the size and modification time of a file."
+    stat = os.stat(filename)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def compute_curve(percolator_filename):
+    """Read the q-values from a Percolator file and return the step
+    function (q-values, accepted PSMs), with one point per distinct
+    q-value."""
+
+    qvalues = pandas.read_csv(percolator_filename, sep="\t",
+                              usecols=["q-value"], dtype=np.float64,
+                              engine="c")["q-value"].values
+    qvalues, counts = np.unique(qvalues, return_counts=True)
+    return qvalues, np.cumsum(counts)
+
+def read_curve(percolator_filename):
+    """Return the step function of a Percolator file, from its cache if
+    the file has not changed since the cache was written."""
+
+    cache_filename = percolator_filename + CACHE_SUFFIX
+    stamp = get_file_stamp(percolator_filename)
+    if os.path.exists(cache_filename):
+        with np.load(cache_filename) as cache:
+            if np.array_equal(cache["stamp"], stamp):
+                return cache["qvalues"], cache["accepted"]
+
+    qvalues, accepted = compute_curve(percolator_filename)
+    try:
+        with open(f"{cache_filename}.tmp", "wb") as cache_file:
+            np.savez(cache_file, stamp=stamp, qvalues=qvalues,
+                     accepted=accepted)
+        os.replace(f"{cache_filename}.tmp", cache_filename)
+    except OSError as error:
+        print(f"Cannot cache {percolator_filename}: {error}",
+              file=sys.stderr)
+    return qvalues, accepted
+
+def decimate(qvalues, accepted, max_fdr=MAX_FDR, resolution=RESOLUTION):
+    """Keep the first and last points of a step function in each of
+    resolution bins across [0, max_fdr], and the first point beyond it."""
+
+    in_range = np.searchsorted(qvalues, max_fdr, side="right")
+    bins = np.floor(qvalues[:in_range] * (resolution / max_fdr))
+    changes = bins[1:] != bins[:-1]
+    keep = np.flatnonzero(np.append(True, changes)
+                          | np.append(changes, True))[:in_range]
+    keep = np.append(keep, np.arange(in_range,
+                                     min(in_range + 1, len(qvalues))))
+    return qvalues[keep], accepted[keep]
+
 ###########################################################################
 # MAIN
 ###########################################################################
@@ -20,8 +81,8 @@ def main():
 
     fig = plt.figure(figsize=(4,8), tight_layout=True)
     ax = plt.gca()
-    ax.set_xlim(0, 0.1)
-    ax.set_ylim(0, 2e6)
+    ax.set_xlim(0, MAX_FDR)
+    ax.set_ylim(0, MAX_PSMS)
     plt.xlabel("FDR threshold")
     plt.ylabel("Accepted PSMs")
 
@@ -29,18 +90,27 @@ def main():
     colors = ['tab:blue', 'tab:orange', 'tab:green', 'tab:red', 'tab:purple',
               'tab:brown', 'tab:pink', 'tab:gray', 'tab:olive']
 
-    i = 0
-    for percolator_filename in sys.argv[2:]:
-        species = re.sub(
-            "-", " ", os.path.split(os.path.dirname(percolator_filename))[-1]
-        )
-        print(f"Reading {species}.", file=sys.stderr)
+    # Read the species in parallel (Pool needs at least one process).
+    percolator_filenames = sys.argv[2:]
+    num_processes = max(1, min(len(percolator_filenames),
+                               os.cpu_count() or 1))
+    with multiprocessing.Pool(num_processes) as pool:
+        curves = pool.imap(read_curve, percolator_filenames)
 
-        percolator_df = pandas.read_csv(percolator_filename, sep="\t")
-        qvalues = percolator_df["q-value"].values.tolist()
+        i = 0
+        for percolator_filename, (qvalues, accepted) in zip(
+                percolator_filenames, curves):
+            species = re.sub(
+                "-", " ",
+                os.path.split(os.path.dirname(percolator_filename))[-1]
+            )
+            print(f"Read {accepted[-1] if len(accepted) else 0} PSMs for "
+                  + f"{species}.", file=sys.stderr)
 
-        plt.plot(qvalues, range(len(qvalues)), label=species, color=colors[i])
-        i += 1
+            qvalues, accepted = decimate(qvalues, accepted)
+            plt.step(qvalues, accepted, where="post", label=species,
+                     color=colors[i])
+            i += 1
 
     plt.legend(loc='center right')
     plt.savefig(sys.argv[1])
@@ -2,9 +2,15 @@
 # AUTHOR: WSN
 # CREATE DATE: 17 July 2024
 import sys
+import json
+import os
 import re
 import matplotlib.pyplot as plt
 
+# Bins of the match percentages, the same as those of the histogram stored
+# by match_by.py --feature_dir, so that both outputs give the same plot.
+NUM_BINS = 100
+
 ###########################################################################
 # MAIN
 ###########################################################################
@@ -15,9 +21,27 @@ def main():
         print("USAGE: make_histograms <output plot> <mgf>+", file=sys.stderr)
         sys.exit(1)
     
-    # Read all the match percentages from species-specific files.
+    # Read all the match percentages from species-specific files.  Each
+    # is either the text output of match_by.py, or a --feature_dir
+    # directory, from which only the pre-binned histogram is read.
     match_df = {} # Key = species, value = list of match percentages.
+    histograms = {} # Key = species, value = (bin edges, counts).
     for match_filename in sys.argv[2:]:
+        if os.path.isdir(match_filename):
+            with open(os.path.join(match_filename, "features.json"), "r") \
+                 as features_file:
+                features = json.load(features_file)
+            # match_by.<species> unless the species was recorded.
+            species = features["species"] or \
+                ".".join(os.path.basename(match_filename.rstrip("/"))
+                         .split(".")[1:])
+            histogram = features["histograms"]["percent_matched"]
+            histograms[species] = (histogram["edges"], histogram["counts"])
+            match_df[species] = None
+            print(f"Read {sum(histogram['counts'])} match percentages from "
+                  + f"{species}.", file=sys.stderr)
+            continue
+
         # match_by.<species>.txt (H.-sapiens special case)
         species = ".".join(match_filename.split(".")[1:-1]) 
         with open(match_filename, "r") as match_file:
@@ -35,7 +59,13 @@ def main():
     fig.set_size_inches(4,8)
     i = 0
     for species in match_df.keys():
-        axs[i].hist(match_df[species], density=True, bins=100, color=colors[i])
+        if species in histograms:
+            edges, counts = histograms[species]
+            axs[i].hist(edges[:-1], bins=edges, weights=counts, density=True,
+                        color=colors[i])
+        else:
+            axs[i].hist(match_df[species], density=True, bins=NUM_BINS,
+                        range=(0, 100), color=colors[i])
         axs[i].set_title(re.sub("-", " ", species), loc='right')
         axs[i].set_xlim(0,60)
         axs[i].set_ylim(0,0.1)